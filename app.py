@@ -1,5 +1,23 @@
 # app.py
-from groq import Groq
+from llm import create_llm_client, LLMBusyError
+from graph_stream import GraphStreamParser
+from graph_mapreduce import split_text, merge_subgraphs
+from graph_patches import diff_graphs, edge_signature, PatchLog
+from collab import CollaborationHub
+from pubsub import create_pubsub
+from graph_cache import GraphCache, CachedGraph
+from storage import create_engines, read_snapshot
+from migrations import run_migrations
+from search import search_nodes
+from graph_versions import apply_delta, decode_payload, encode_version, reconstruct, reencode
+from graph_analytics import AnalyticsCache, DEFAULT_METRICS, METRICS, GraphAnalytics
+from graph_sparse import SPARSE_AVAILABLE, load_sparse_analytics
+from ingest import FINISHED as INGEST_FINISHED, IngestBusyError, IngestQueue
+from text_cache import ExtractedTextCache
+from prompt_graph import ALIAS_INSTRUCTIONS, PromptGraph, token_report
+from graph_context import find_nodes, node_tokens, select_context
+from relevance import NodeIndex
+from quiz_pool import QuizPoolManager
 # Cargar variables de entorno desde un archivo .env local durante desarrollo.
 # Esto permite ejecutar `python app.py` o `uvicorn app:app` sin tener que
 # exportar variables manualmente en cada terminal. En producción puedes usar
@@ -13,27 +31,28 @@ except Exception:
     pass
 from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
 import os
 import json
+import asyncio
+import time
 import re
 import uuid
-from typing import Dict, List, Optional
-import PyPDF2
-import speech_recognition as sr
-from PIL import Image
-import pytesseract
-from collections import defaultdict
-from sqlalchemy import create_engine, Column, String, Text, ForeignKey, JSON as SQLJSON, event, Integer
+import base64
+from typing import Dict, List, Optional, Set
+from sqlalchemy import Column, String, Text, ForeignKey, JSON as SQLJSON, Integer, Index, LargeBinary, insert, update, select, func, or_, tuple_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session
-import networkx as nx
 import random
 import datetime
 from sqlalchemy import DateTime
 # Usamos un nuevo nombre de archivo para la base de datos relacional.
-DATABASE_URL = "sqlite:///./knowledge_graphs_relational.db"
-DB_FILE = "./knowledge_graphs_relational.db"
+# DATABASE_URL permite usar otra DB (p. ej. PostgreSQL) con los mismos modelos
+# y DATABASE_READ_URL mandar las lecturas a una réplica (ver storage.py).
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./knowledge_graphs_relational.db")
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+DB_FILE = DATABASE_URL
 
 # Elimina tu antigua base de datos .db si existe
 OLD_DB_FILE = "./knowledge_graphs_session.db"
@@ -41,18 +60,11 @@ if os.path.exists(OLD_DB_FILE):
     print(f"Eliminando base de datos antigua (formato JSON): {OLD_DB_FILE}")
     os.remove(OLD_DB_FILE)
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}
-)
-
-# Habilitar claves foráneas (FK) para SQLite para que funcione ON DELETE CASCADE
-@event.listens_for(engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
+# Motor de escritura y motor de lectura (en SQLite: WAL, pragmas y FK activadas)
+engine, read_engine = create_engines(DATABASE_URL, DATABASE_READ_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 Base = declarative_base()
 
 
@@ -71,6 +83,8 @@ class User(Base):
 
 class QuizRequest(BaseModel):
     graph_id: str
+    topic: Optional[str] = None # Centrar el quiz en un tema; si no, cubrir todo el grafo
+    bypass_cache: bool = False
 
 class UserStatsUpdate(BaseModel):
     user_id: str
@@ -93,12 +107,23 @@ class KnowledgeGraph(Base):
     id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     title = Column(String, nullable=True)
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    # Revisión: crece con cada escritura; la usan los parches de colaboración
+    revision = Column(Integer, nullable=False, default=0, server_default="0")
+    # Resumen para el historial, mantenido por bump_revision (sin contar filas)
+    node_count = Column(Integer, nullable=False, default=0, server_default="0")
+    edge_count = Column(Integer, nullable=False, default=0, server_default="0")
+    updated_at = Column(DateTime, nullable=True, default=datetime.datetime.utcnow)
     
     user = relationship("User", back_populates="graphs")
     # Relaciones en cascada: si borras un grafo, se borran todos sus nodos y ejes.
     nodes = relationship("GraphNode", back_populates="graph", cascade="all, delete-orphan")
     edges = relationship("GraphEdge", back_populates="graph", cascade="all, delete-orphan")
 
+# Clave de orden del historial (título, id): paginación por cursor sobre un índice
+GRAPH_TITLE_KEY = func.coalesce(KnowledgeGraph.title, "")
+Index("ix_knowledge_graphs_title_key", GRAPH_TITLE_KEY, KnowledgeGraph.id)
+Index("ix_knowledge_graphs_user_title_key", KnowledgeGraph.user_id, GRAPH_TITLE_KEY, KnowledgeGraph.id)
+
 # graphNode
 class GraphNode(Base):
     __tablename__ = "graph_nodes"
@@ -110,7 +135,7 @@ class GraphNode(Base):
     comments = Column(SQLJSON, nullable=True, default=[])
     
     # Clave foránea al grafo al que pertenece
-    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False)
+    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False, index=True)
     # Clave foránea al usuario propietario (para permisos)
     owner_id = Column(String, ForeignKey("users.id"), nullable=False)
     
@@ -128,24 +153,51 @@ class GraphEdge(Base):
     label = Column(String, nullable=True)
     
     # Clave foránea al grafo al que pertenece
-    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False)
+    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False, index=True)
     # Clave foránea al nodo de origen
-    source_node_id = Column(String, ForeignKey("graph_nodes.id", ondelete="CASCADE"), nullable=False)
+    source_node_id = Column(String, ForeignKey("graph_nodes.id", ondelete="CASCADE"), nullable=False, index=True)
     # Clave foránea al nodo de destino
-    target_node_id = Column(String, ForeignKey("graph_nodes.id", ondelete="CASCADE"), nullable=False)
+    target_node_id = Column(String, ForeignKey("graph_nodes.id", ondelete="CASCADE"), nullable=False, index=True)
 
     graph = relationship("KnowledgeGraph", back_populates="edges")
     source_node = relationship("GraphNode", foreign_keys=[source_node_id], back_populates="edges_from")
     target_node = relationship("GraphNode", foreign_keys=[target_node_id], back_populates="edges_to")
 
 
-# Crear todas las tablas
-Base.metadata.create_all(bind=engine)
+class GraphVersion(Base):
+    __tablename__ = "graph_versions"
+    # El historial se lista por grafo y en orden cronológico; la cadena se recorre por seq
+    __table_args__ = (Index("ix_graph_versions_graph_id_created_at", "graph_id", "created_at"),
+                      Index("ix_graph_versions_graph_id_seq", "graph_id", "seq", unique=True))
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False)
+    content = Column(SQLJSON, nullable=True) # Solo versiones antiguas: el JSON completo {nodes, edges}
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Cadena keyframe + deltas comprimidos (ver graph_versions.py)
+    seq = Column(Integer, nullable=False, default=0, server_default="0")
+    kind = Column(String, nullable=True) # "keyframe" | "delta"
+    payload = Column(LargeBinary, nullable=True)
+    # Metadatos para listar sin descomprimir nada
+    node_count = Column(Integer, nullable=False, default=0, server_default="0")
+    edge_count = Column(Integer, nullable=False, default=0, server_default="0")
+    byte_size = Column(Integer, nullable=False, default=0, server_default="0")
+    author_id = Column(String, nullable=True)
+    
+    graph = relationship("KnowledgeGraph", back_populates="versions")
+
+#
+KnowledgeGraph.versions = relationship("GraphVersion", back_populates="graph", cascade="all, delete-orphan", order_by="GraphVersion.created_at")
+
+
+# Crear las tablas que falten y aplicar las migraciones pendientes (migrations.py)
+run_migrations(engine, Base.metadata)
 print(f"Base de datos relacional ({DB_FILE}) creada/lista.")
 
 # --- FIN DE CAMBIOS EN MODELOS ---
 
-# Dependencia de DB (sin cambios)
+# Dependencias de DB. Los endpoints que solo consultan usan get_read_db.
+# Los endpoints que solo hablan con la DB se declaran con `def` (no `async def`)
+# para que FastAPI los ejecute en su pool de hilos y no bloqueen el event loop.
 def get_db():
     db = SessionLocal()
     try:
@@ -153,16 +205,26 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # Cliente Groq
 groq_key = os.environ.get("GROQ_API_KEY")
 groq_key = "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"
 if not groq_key:
     # Mensaje más amigable y guía rápida para desarrollo local
     print("ADVERTENCIA: La variable de entorno GROQ_API_KEY no está configurada. Si estás en desarrollo, crea un archivo .env con: GROQ_API_KEY=tu_clave")
-    # Inicializar cliente sin clave (el paquete puede lanzar error más adelante si la requiere)
-    client = Groq(api_key="")
-else:
-    client = Groq(api_key=groq_key)
+# Cliente asíncrono con concurrencia limitada por modelo (ver llm.py).
+# Con LLM_BACKEND=stub se usa un backend local sin red.
+llm = create_llm_client(groq_key)
+
+def looks_like_json(text: str) -> bool:
+    """Solo se guardan en caché las respuestas que contienen un objeto JSON."""
+    return bool(text and re.search(r'\{[\s\S]*\}', text))
 
 # SYSTEM_PROMPT 
 SYSTEM_PROMPT = """
@@ -202,7 +264,20 @@ Responde ÚNICAMENTE con un objeto JSON válido en el siguiente formato, sin tex
 app = FastAPI()
 origins = ["http://localhost:5173", "http://127.0.0.1:5173", "http://10.1.16.61:5173"] # Añadida IP de ejemplo
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-collaborations: Dict[str, List[WebSocket]] = defaultdict(list)
+# Colaboradores conectados por grafo; cada uno con su cola de envío (ver collab.py)
+collaborations = CollaborationHub(
+    queue_size=int(os.environ.get("COLLAB_QUEUE_SIZE", "64")),
+    slow_policy=os.environ.get("COLLAB_SLOW_POLICY", "coalesce"),  # "coalesce" | "resync"
+    send_timeout=float(os.environ.get("COLLAB_SEND_TIMEOUT", "5")),
+    max_coalesced_patches=int(os.environ.get("COLLAB_MAX_COALESCED_PATCHES", "500")),
+)
+# Bus de eventos entre procesos (ver pubsub.py): "local" con un solo worker,
+# "sqlite" para varios workers de uvicorn en la misma máquina.
+collab_bus = create_pubsub(
+    os.environ.get("COLLAB_PUBSUB", "local"),
+    db_path=os.environ.get("COLLAB_PUBSUB_DB", "./collab_events.db"),
+    poll_interval=float(os.environ.get("COLLAB_PUBSUB_POLL", "0.05")),
+)
 
 
 
@@ -215,6 +290,9 @@ class GraphRequest(BaseModel):
     title: Optional[str] = None
     user_id: str
     context: Optional[str] = None
+    bypass_cache: bool = False # True para forzar una respuesta nueva del LLM
+    stream: bool = False # True para recibir nodos/ejes incrementalmente (NDJSON + WebSocket)
+    node_id: Optional[str] = None # Nodo sobre el que se pregunta (expand_node, contextual_help)
 class FeedbackRequest(BaseModel): feedback: str; graph_id: str; user_id: str
 class ExportRequest(BaseModel): graph_id: str; format: str
 class UserRequest(BaseModel): user_id: Optional[str] = None
@@ -230,7 +308,7 @@ class UpdateGraphTitleRequest(BaseModel):
 
 # /create_user
 @app.post("/create_user")
-async def create_user(request: UserRequest, db: Session = Depends(get_db)):
+def create_user(request: UserRequest, db: Session = Depends(get_db)):
     user_id = request.user_id
     user = None
     if user_id: user = db.query(User).filter(User.id == user_id).first()
@@ -240,183 +318,597 @@ async def create_user(request: UserRequest, db: Session = Depends(get_db)):
         db.add(new_user); db.commit(); db.refresh(new_user)
         return {"user_id": new_user.id}
 
-# /upload 
-@app.post("/upload")
+# /upload: la extracción corre en segundo plano (ver ingest.py)
+ingest_queue = IngestQueue(
+    workers=int(os.environ.get("INGEST_WORKERS", "2")),
+    max_pending=int(os.environ.get("INGEST_MAX_PENDING", "32")),
+    ttl=float(os.environ.get("INGEST_RESULT_TTL", "600")),
+    pdf_pages_per_task=int(os.environ.get("PDF_PAGES_PER_TASK", "8")),
+    cache=ExtractedTextCache(
+        db_path=os.environ.get("EXTRACT_CACHE_DB", "./extract_cache.db"),
+        max_bytes=int(os.environ.get("EXTRACT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    ) if os.environ.get("EXTRACT_CACHE", "1") != "0" else None,
+)
+
+@app.post("/upload", status_code=202)
 async def upload_file(file: UploadFile = File(...)):
-    
+    """Encola la extracción de texto del archivo y devuelve el trabajo al momento."""
+    try:
+        job = await ingest_queue.submit(file.filename, file.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IngestBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return job.snapshot()
+
+@app.get("/upload_jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    """Estado, progreso y (al terminar) texto extraído o error del trabajo."""
+    job = ingest_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado")
+    return job.snapshot()
+
+@app.get("/upload_jobs/{job_id}/text")
+async def stream_upload_text(job_id: str):
+    """Texto extraído en streaming, en orden de página, a medida que avanza el trabajo."""
+    job = ingest_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado")
+
+    async def chunks():
+        events = ingest_queue.watch(job)
+        try:
+            sent = 0
+            while True:
+                while sent < len(job.chunks):
+                    yield job.chunks[sent]
+                    sent += 1
+                if job.status in INGEST_FINISHED:
+                    return
+                await events.get()
+        finally:
+            ingest_queue.unwatch(job, events)
+
+    return StreamingResponse(chunks(), media_type="text/plain; charset=utf-8")
+
+@app.delete("/upload_jobs/{job_id}")
+async def cancel_upload_job(job_id: str):
+    job = ingest_queue.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado o expirado")
+    return job.snapshot()
+
+@app.websocket("/ws/upload_jobs/{job_id}")
+async def upload_job_events(websocket: WebSocket, job_id: str):
+    """Envía el estado del trabajo en cada cambio y cierra al terminar."""
+    await websocket.accept()
+    job = ingest_queue.get(job_id)
+    if not job:
+        await websocket.close(code=1008, reason="Job not found")
+        return
+    events = ingest_queue.watch(job)
     try:
-        if file.filename.endswith('.pdf'):
-            pdf_reader = PyPDF2.PdfReader(file.file); text = "".join(page.extract_text() + "\n" for page in pdf_reader.pages)
-            return {"extracted_text": text, "notification": None}
-        elif file.filename.endswith('.txt'):
-            text = await file.read(); return {"extracted_text": text.decode('utf-8'), "notification": None}
-        elif file.filename.endswith(('.wav', '.mp3')):
-            r = sr.Recognizer();
-            with sr.AudioFile(file.file) as source: audio = r.record(source)
-            text = r.recognize_google(audio, language="es-ES")
-            return {"extracted_text": text, "notification": None}
-        elif file.filename.endswith(('.-', '.jpg', '.jpeg')):
-            image = Image.open(file.file); text = pytesseract.image_to_string(image, lang='spa')
-            return {"extracted_text": text, "notification": None}
-        else: raise HTTPException(status_code=400, detail="Tipo de archivo no soportado")
-    except Exception as e: return {"extracted_text": None, "notification": f"Error procesando archivo: {str(e)}"}
+        snapshot = job.snapshot()
+        await websocket.send_json(snapshot)
+        while snapshot["status"] not in INGEST_FINISHED:
+            snapshot = await events.get()
+            await websocket.send_json(snapshot)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        ingest_queue.unwatch(job, events)
+
+@app.get("/upload_stats")
+async def upload_stats():
+    return ingest_queue.stats()
+
+@app.on_event("shutdown")
+async def stop_ingest_queue():
+    ingest_queue.shutdown()
 
 # 
 # Esta función lee las tablas de la DB y crea el JSON que espera el frontend
+def node_to_json(node: "GraphNode") -> Dict:
+    return {
+        "id": node.id,
+        "label": node.label,
+        "description": node.description,
+        "type": node.node_type,
+        "color": node.color,
+        "comments": node.comments or [],
+        "owner_id": node.owner_id
+    }
+
+def edge_to_json(edge: "GraphEdge") -> Dict:
+    return {
+        "id": edge.id,
+        "from": edge.source_node_id,
+        "to": edge.target_node_id,
+        "label": edge.label
+    }
+
 def assemble_graph_json(graph_id: str, db: Session) -> Dict:
     nodes_db = db.query(GraphNode).filter(GraphNode.graph_id == graph_id).all()
     edges_db = db.query(GraphEdge).filter(GraphEdge.graph_id == graph_id).all()
 
-    nodes_json = [
-        {
-            "id": node.id,
-            "label": node.label,
-            "description": node.description,
-            "type": node.node_type,
-            "color": node.color,
-            "comments": node.comments or [],
-            "owner_id": node.owner_id
-        } for node in nodes_db
-    ]
-    
-    edges_json = [
-        {
-            "from": edge.source_node_id,
-            "to": edge.target_node_id,
-            "label": edge.label
-        } for edge in edges_db
-    ]
+    nodes_json = [node_to_json(node) for node in nodes_db]
+    edges_json = [edge_to_json(edge) for edge in edges_db]
     
     return {"nodes": nodes_json, "edges": edges_json}
 
+# Caché por revisión del grafo ensamblado y serializado (ver graph_cache.py).
+# Se invalida al difundirse los parches de cada escritura (deliver_collab_event).
+graph_cache = GraphCache(
+    max_entries=int(os.environ.get("GRAPH_CACHE_ENTRIES", "256")),
+    max_bytes=int(os.environ.get("GRAPH_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    max_floors=int(os.environ.get("GRAPH_CACHE_FLOORS", "4096")),
+)
+
+def load_graph(graph_id: str, db: Session) -> Optional[CachedGraph]:
+    """Grafo ensamblado desde la caché; solo consulta la DB si no está o cambió."""
+    entry = graph_cache.get(graph_id)
+    if entry is not None:
+        return entry
+    graph = db.query(KnowledgeGraph.revision, KnowledgeGraph.title).filter(KnowledgeGraph.id == graph_id).first()
+    if graph is None:
+        return None
+    return graph_cache.put(graph_id, CachedGraph(graph.revision, assemble_graph_json(graph_id, db), graph.title))
+
+def graph_response(entry: CachedGraph, **fields) -> Response:
+    """Respuesta JSON {**fields, "graph": ...} reutilizando los bytes ya serializados."""
+    head = json.dumps(fields)[:-1] + (", " if fields else "")
+    return Response(content=head.encode("utf-8") + b'"graph": ' + entry.body + b"}", media_type="application/json")
+
 # --- 3. ENDPOINT /get_graph ACTUALIZADO ---
 @app.get("/get_graph/{graph_id}")
-async def get_graph(graph_id: str, db: Session = Depends(get_db)):
-    # Comprobar si el grafo existe
-    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).first()
-    if not graph: 
+def get_graph(graph_id: str, db: Session = Depends(get_read_db)):
+    # Comprobar si el grafo existe y ensamblar el JSON (o tomarlo de la caché)
+    entry = load_graph(graph_id, db)
+    if not entry: 
         raise HTTPException(status_code=404, detail="Grafo no encontrado")
-    
-    # Ensamblar el JSON desde las tablas
-    graph_json = assemble_graph_json(graph_id, db)
-    return {"graph": graph_json}
+    return graph_response(entry, revision=entry.revision)
+
+# Campos del nodo que la IA puede modificar: clave en el JSON -> columna
+LLM_NODE_FIELDS = {"label": "label", "description": "description", "type": "node_type", "color": "color"}
+
+def reconcile_edges(db: Session, graph_id: str, edges: List[Dict], scope: Optional[Set[str]] = None) -> Dict:
+    """Deja en la DB exactamente los ejes `edges` ({"from", "to", "label"}).
+
+    Compara con los ejes guardados por (origen, destino, etiqueta), como un
+    multiconjunto: los que coinciden se conservan con su ID y solo se escriben
+    los INSERT y DELETE necesarios. Con `scope` (IDs de nodo) solo se comparan
+    los ejes guardados con ambos extremos dentro; el resto no se toca.
+    Devuelve el diff aplicado.
+    """
+    stored: Dict[tuple, List[str]] = {}
+    rows = db.query(GraphEdge.id, GraphEdge.source_node_id, GraphEdge.target_node_id, GraphEdge.label) \
+             .filter(GraphEdge.graph_id == graph_id).all()
+    for row in rows:
+        if scope is not None and not (row.source_node_id in scope and row.target_node_id in scope):
+            continue
+        stored.setdefault((row.source_node_id, row.target_node_id, row.label), []).append(row.id)
+
+    added: List[Dict] = []
+    unchanged = 0
+    for edge in edges:
+        ids = stored.get(edge_signature(edge))
+        if ids:
+            ids.pop()
+            unchanged += 1
+        else:
+            added.append(edge)
+    removed = [({"from": source, "to": target, "label": label}, edge_id)
+               for (source, target, label), ids in stored.items() for edge_id in ids]
+
+    removed_ids = [edge_id for _, edge_id in removed]
+    for start in range(0, len(removed_ids), 500):  # Límite de parámetros de SQLite
+        db.query(GraphEdge).filter(GraphEdge.id.in_(removed_ids[start:start + 500])).delete(synchronize_session=False)
+    if added:
+        db.execute(insert(GraphEdge), [
+            {"id": str(uuid.uuid4()), "label": edge["label"], "graph_id": graph_id,
+             "source_node_id": edge["from"], "target_node_id": edge["to"]}
+            for edge in added
+        ])
+    return {"added": added, "removed": [edge for edge, _ in removed], "unchanged": unchanged}
+
+def persist_llm_graph(db: Session, parsed_json: Dict, graph_id: str, user_id: str, refine: bool,
+                      scope: Optional[Set[str]] = None) -> Dict:
+    """Vuelca el grafo de la IA en la DB con operaciones en bloque.
+
+    Una consulta carga los nodos existentes; después hay un INSERT en bloque
+    para los nodos nuevos, un UPDATE en bloque (por clave primaria) solo para
+    los nodos que cambian; los ejes se concilian con reconcile_edges (dentro
+    de `scope` si la IA solo vio una parte del grafo).
+    Devuelve el diff de ejes aplicado.
+    """
+    # Mapeo para rastrear los ID temporales (ej. "concepto_1") a los nuevos UUID de la DB
+    temp_id_to_new_uuid_map: Dict[str, str] = {}
+    existing: Dict[str, Dict] = {}
+
+    # Si es un grafo existente, precargamos el mapa con los nodos existentes
+    if refine:
+        rows = db.query(GraphNode.id, GraphNode.label, GraphNode.description, GraphNode.node_type, GraphNode.color) \
+                 .filter(GraphNode.graph_id == graph_id).all()
+        for row in rows:
+            existing[row.id] = {"id": row.id, "label": row.label, "description": row.description,
+                                "node_type": row.node_type, "color": row.color}
+            temp_id_to_new_uuid_map[row.id] = row.id # El ID ya es un UUID
+
+    new_nodes: List[Dict] = []
+    updated: Dict[str, Dict] = {}
+    for node_data in parsed_json.get("nodes", []):
+        temp_id = node_data.get("id")
+        if temp_id in temp_id_to_new_uuid_map:
+            # Modificar nodo existente (un ID temporal repetido no corresponde a
+            # ningún nodo guardado y se ignora)
+            current = updated.get(temp_id) or existing.get(temp_id)
+            if current is None:
+                continue
+            changed = dict(current)
+            for key, column in LLM_NODE_FIELDS.items():
+                changed[column] = node_data.get(key, changed[column])
+            if changed != existing[temp_id]:
+                updated[temp_id] = changed
+            else:
+                updated.pop(temp_id, None)
+        else:
+            new_id = str(uuid.uuid4())
+            new_nodes.append({
+                "id": new_id,
+                "label": node_data.get("label"),
+                "description": node_data.get("description"),
+                "node_type": node_data.get("type"),
+                "color": node_data.get("color"),
+                "comments": node_data.get("comments", []),
+                "owner_id": user_id,
+                "graph_id": graph_id,
+            })
+            temp_id_to_new_uuid_map[temp_id] = new_id
+
+    if new_nodes:
+        db.execute(insert(GraphNode), new_nodes)
+    if updated:
+        db.execute(update(GraphNode), list(updated.values()))
+
+    # Ejes: el conjunto devuelto por la IA reemplaza al anterior, pero solo se
+    # escriben las diferencias (los ejes que no cambian conservan su ID)
+    edges: List[Dict] = []
+    for edge_data in parsed_json.get("edges", []):
+        source_real_id = temp_id_to_new_uuid_map.get(edge_data.get("from"))
+        target_real_id = temp_id_to_new_uuid_map.get(edge_data.get("to"))
+        if source_real_id and target_real_id:
+            edges.append({"from": source_real_id, "to": target_real_id, "label": edge_data.get("label")})
+        else:
+            print(f"Advertencia: No se pudo crear eje, ID de nodo no encontrado: {edge_data.get('from')} -> {edge_data.get('to')}")
+    if refine:
+        return reconcile_edges(db, graph_id, edges, scope)
+    if edges:
+        db.execute(insert(GraphEdge), [
+            {"id": str(uuid.uuid4()), "label": edge["label"], "graph_id": graph_id,
+             "source_node_id": edge["from"], "target_node_id": edge["to"]}
+            for edge in edges
+        ])
+    return {"added": edges, "removed": [], "unchanged": 0}
+
+def parse_graph_response(json_response: str) -> Dict:
+    """Extrae y valida el objeto {nodes, edges} de la respuesta de la IA."""
+    json_match = re.search(r'\{[\s\S]*\}', json_response)
+    if not json_match: raise HTTPException(status_code=500, detail=f"Respuesta de IA no es JSON: {json_response}")
+
+    parsed_json = json.loads(json_match.group(0))
+    if "nodes" not in parsed_json or "edges" not in parsed_json:
+        raise ValueError("Estructura de grafo inválida de IA")
+    return parsed_json
+
+# Map-reduce para documentos largos (ver graph_mapreduce.py)
+MAPREDUCE_THRESHOLD = int(os.environ.get("MAPREDUCE_THRESHOLD", "12000"))  # caracteres
+MAPREDUCE_CHUNK_SIZE = int(os.environ.get("MAPREDUCE_CHUNK_SIZE", "8000"))
+MAPREDUCE_OVERLAP = int(os.environ.get("MAPREDUCE_OVERLAP", "800"))
+MAPREDUCE_PARALLELISM = int(os.environ.get("MAPREDUCE_PARALLELISM", "4"))
+
+async def extract_graph_in_chunks(text: str, use_cache: bool = True) -> Dict:
+    """Extrae un subgrafo por fragmento (en paralelo acotado) y los fusiona."""
+    chunks = split_text(text, MAPREDUCE_CHUNK_SIZE, MAPREDUCE_OVERLAP)
+    semaphore = asyncio.Semaphore(MAPREDUCE_PARALLELISM)
+
+    async def extract(index: int, chunk: str) -> Optional[Dict]:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Fragmento {index + 1} de {len(chunks)} de un documento más largo. Extrae el conocimiento de ESTE texto:\n\n{chunk}"},
+        ]
+        async with semaphore:
+            try:
+                content = await llm.complete(
+                    "meta-llama/llama-4-maverick-17b-128e-instruct", messages, temperature=0.7, max_tokens=8000, max_completion_tokens=8192,
+                    use_cache=use_cache, validate=looks_like_json,
+                )
+                return parse_graph_response(content)
+            except LLMBusyError:
+                raise
+            except Exception as e:
+                print(f"Advertencia: fragmento {index + 1}/{len(chunks)} descartado: {e}")
+                return None
+
+    subgraphs = await asyncio.gather(*(extract(i, chunk) for i, chunk in enumerate(chunks)))
+    subgraphs = [g for g in subgraphs if g]
+    if not subgraphs:
+        raise ValueError("Ningún fragmento del documento produjo un grafo válido")
+    return merge_subgraphs(subgraphs)
+
+# Caracteres máximos de cada descripción del grafo anterior en el prompt (0 = sin recortar)
+PROMPT_DESCRIPTION_CHARS = int(os.environ.get("PROMPT_DESCRIPTION_CHARS", "0"))
+
+# Micro-lotes del streaming: se hace commit (y se difunde una revisión) cada
+# STREAM_BATCH_SIZE nodos/ejes o cada STREAM_FLUSH_INTERVAL segundos.
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "10"))
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", "0.25"))
+
+async def stream_graph_generation(request: "GraphRequest", graph_id: str, messages: List[Dict],
+                                  prompt_graph: Optional[PromptGraph] = None, prompt_tokens: Optional[Dict] = None,
+                                  scope: Optional[Set[str]] = None):
+    """Genera el grafo consumiendo la completion como stream (respuesta NDJSON).
+
+    Cada nodo/eje se envía a quien hizo la petición en cuanto el parser lo
+    completa; se guarda en micro-lotes y cada lote se difunde como una revisión
+    a los colaboradores del WebSocket.
+    """
+    db = SessionLocal()
+    def line(event: Dict) -> str:
+        return json.dumps(event, ensure_ascii=False) + "\n"
+    try:
+        yield line({"type": "start", "graph_id": graph_id, "prompt_tokens": prompt_tokens})
+
+        id_map: Dict[str, str] = {}
+        batch: List[Dict] = []   # Parches aún no confirmados en la DB
+        # Filas pendientes del lote: se escriben todas en el hilo de flush(), de
+        # modo que el bucle de eventos nunca consulta ni toma el bloqueo de escritura
+        new_nodes: List[Dict] = []
+        node_updates: Dict[str, Dict] = {}
+        new_edges: List[Dict] = []
+        # Nodos guardados (refine), para resolver las modificaciones sin consultar
+        stored_nodes: Dict[str, Dict] = {}
+        # En un refine, ejes guardados aún no reclamados por la IA: los que la IA
+        # repite se conservan y los que sobren se borran al final
+        stored_edges: Dict[tuple, List[Dict]] = {}
+        def read_stored():
+            for node in db.query(GraphNode).filter(GraphNode.graph_id == graph_id):
+                id_map[node.id] = node.id
+                stored_nodes[node.id] = node_to_json(node)
+            for edge in db.query(GraphEdge).filter(GraphEdge.graph_id == graph_id):
+                if scope is not None and not (edge.source_node_id in scope and edge.target_node_id in scope):
+                    continue  # La IA no vio este eje: se conserva
+                edge_json = edge_to_json(edge)
+                stored_edges.setdefault(edge_signature(edge_json), []).append(edge_json)
+        if request.previous_graph:
+            await asyncio.to_thread(read_stored)
+
+        parser = GraphStreamParser()
+        pending_edges: List[Dict] = [] # Ejes cuyos nodos aún no han llegado
+        batch_started = time.monotonic()
+
+        def handle(kind: str, item: Dict) -> Optional[Dict]:
+            if prompt_graph is not None:
+                item = prompt_graph.node(item) if kind == "node" else prompt_graph.edge(item)
+            if kind == "node":
+                temp_id = item.get("id")
+                if temp_id in stored_nodes:
+                    # Modificar nodo existente (mismos campos que persist_llm_graph)
+                    node = stored_nodes[temp_id]
+                    for key, column in (("label", "label"), ("description", "description"),
+                                        ("type", "node_type"), ("color", "color")):
+                        if key in item:
+                            node[key] = item[key]
+                            node_updates.setdefault(temp_id, {"id": temp_id})[column] = item[key]
+                    patch = {"op": "node_updated", "node": dict(node)}
+                elif temp_id in id_map:
+                    return None  # ID temporal repetido: el nodo ya se creó en este stream
+                else:
+                    node = {"id": str(uuid.uuid4()), "label": item.get("label"), "description": item.get("description"),
+                            "type": item.get("type"), "color": item.get("color"),
+                            "comments": item.get("comments") or [], "owner_id": request.user_id}
+                    id_map[temp_id] = node["id"]
+                    new_nodes.append(node)
+                    patch = {"op": "node_added", "node": node}
+            else:
+                source, target = id_map.get(item.get("from")), id_map.get(item.get("to"))
+                if not (source and target):
+                    pending_edges.append(item)
+                    return None
+                kept = stored_edges.get((source, target, item.get("label")))
+                if kept:
+                    kept.pop()
+                    return None
+                edge_id = str(uuid.uuid4())
+                new_edges.append({"id": edge_id, "label": item.get("label"), "graph_id": graph_id,
+                                  "source_node_id": source, "target_node_id": target})
+                patch = {"op": "edge_added", "edge": {"id": edge_id, "from": source, "to": target, "label": item.get("label")}}
+            batch.append(patch)
+            return patch
+
+        committed = False  # Algún lote llegó a la DB
+
+        async def flush():
+            nonlocal batch, batch_started, committed
+            if batch:
+                committed = True
+                ops = [patch["op"] for patch in batch]
+                nodes, updates, edges = list(new_nodes), list(node_updates.values()), list(new_edges)
+                new_nodes.clear(); node_updates.clear(); new_edges.clear()
+                def commit() -> int:
+                    # Nodos antes que ejes (claves foráneas), en bloque
+                    if nodes:
+                        db.execute(insert(GraphNode), [
+                            {"id": n["id"], "label": n["label"], "description": n["description"], "node_type": n["type"],
+                             "color": n["color"], "comments": n["comments"], "owner_id": n["owner_id"], "graph_id": graph_id}
+                            for n in nodes
+                        ])
+                    if updates:
+                        db.execute(update(GraphNode), updates)
+                    if edges:
+                        db.execute(insert(GraphEdge), edges)
+                    revision = bump_revision(db, graph_id, nodes=ops.count("node_added"),
+                                             edges=ops.count("edge_added") - ops.count("edge_removed"))
+                    db.commit()
+                    return revision
+                # El commit (con la espera de escritura de SQLite) va a un hilo
+                revision = await asyncio.to_thread(commit)
+                await publish_patches(graph_id, revision, batch)
+            batch, batch_started = [], time.monotonic()
+
+        async for chunk in llm.stream(
+            "meta-llama/llama-4-maverick-17b-128e-instruct", messages, temperature=0.7, max_tokens=8000, max_completion_tokens=8192,
+            use_cache=not request.bypass_cache, validate=looks_like_json,
+        ):
+            for kind, item in parser.feed(chunk):
+                patch = handle(kind, item)
+                if patch:
+                    yield line({"type": patch["op"], **{k: v for k, v in patch.items() if k != "op"}})
+            if len(batch) >= STREAM_BATCH_SIZE or (batch and time.monotonic() - batch_started >= STREAM_FLUSH_INTERVAL):
+                await flush()
+
+        if parser.emitted == 0:
+            # El stream no tenía la forma esperada: intentar con el texto completo.
+            json_match = re.search(r'\{[\s\S]*\}', parser.text)
+            if not json_match:
+                raise ValueError("Respuesta de IA no es JSON")
+            parsed_json = json.loads(json_match.group(0))
+            for node_data in parsed_json.get("nodes", []):
+                handle("node", node_data)
+            pending_edges.extend(parsed_json.get("edges", []))
+
+        edges_left, pending_edges = pending_edges, []
+        for edge_data in edges_left:
+            handle("edge", edge_data)
+        for edge_data in pending_edges:
+            print(f"Advertencia: No se pudo crear eje, ID de nodo no encontrado: {edge_data.get('from')} -> {edge_data.get('to')}")
+        # Ejes guardados que la IA ya no devolvió
+        removed_ids = []
+        for edges in stored_edges.values():
+            for edge in edges:
+                removed_ids.append(edge["id"])
+                batch.append({"op": "edge_removed", "edge": edge})
+        def delete_removed():
+            for start in range(0, len(removed_ids), 500):  # Límite de parámetros de SQLite
+                db.query(GraphEdge).filter(GraphEdge.id.in_(removed_ids[start:start + 500])).delete(synchronize_session=False)
+        await asyncio.to_thread(delete_removed)
+        await flush()
+
+        def final_state() -> CachedGraph:
+            # Desde la DB y no desde la caché, que puede no haber visto aún otras escrituras
+            if committed:
+                lock_graph(db, graph_id)
+            graph = db.query(KnowledgeGraph.revision, KnowledgeGraph.title).filter(KnowledgeGraph.id == graph_id).first()
+            final = CachedGraph(graph.revision, assemble_graph_json(graph_id, db), graph.title)
+            if committed:
+                # Una sola versión en el historial por generación, no una por lote
+                save_graph_snapshot(db, graph_id, graph_json=final.graph, author_id=request.user_id)
+                db.commit()
+            return final
+        entry = graph_cache.put(graph_id, await asyncio.to_thread(final_state))
+        yield line({"type": "done", "graph_id": graph_id, "graph": entry.graph, "revision": entry.revision})
+    except Exception as e:
+        db.rollback()
+        print(f"Error en stream_graph_generation: {e}")
+        yield line({"type": "error", "detail": f"Error al generar/guardar grafo: {str(e)}"})
+    finally:
+        db.close()
 
 # --- 4. ENDPOINT /generate_graph ACTUALIZADO ---
 @app.post("/generate_graph")
 async def generate_graph(request: GraphRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == request.user_id).first()
-    if not user: 
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
-
-    # Si es un grafo existente, lo cargamos. Si no, creamos uno nuevo.
-    if request.graph_id:
-        graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
-        if not graph:
-            raise HTTPException(status_code=404, detail="Grafo no encontrado para modificar")
-        graph_id = graph.id
-    else:
-        # Es un grafo nuevo
-        graph = KnowledgeGraph(title=request.title, user_id=request.user_id)
-        db.add(graph)
-        db.commit() # Commit para obtener el graph.id
-        db.refresh(graph)
-        graph_id = graph.id
+    return await run_graph_generation(request, db)
+
+async def run_graph_generation(request: GraphRequest, db: Session, scope: Optional[Set[str]] = None):
+    """Genera o modifica el grafo. Con `scope`, `request.previous_graph` es solo
+    esa parte del grafo y los ejes se concilian dentro de ella."""
+    def prepare():
+        user = db.query(User).filter(User.id == request.user_id).first()
+        if not user: 
+            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+        # Si es un grafo existente, lo cargamos. Si no, creamos uno nuevo.
+        if request.graph_id:
+            graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
+            if not graph:
+                raise HTTPException(status_code=404, detail="Grafo no encontrado para modificar")
+        else:
+            # Es un grafo nuevo
+            graph = KnowledgeGraph(title=request.title, user_id=request.user_id)
+            db.add(graph)
+            db.commit() # Commit para obtener el graph.id
+            db.refresh(graph)
+        return graph.id, graph.title
+
+    # El trabajo con la DB (síncrono) va a un hilo para no bloquear el bucle de eventos
+    graph_id, title = await asyncio.to_thread(prepare)
 
     # 1. Preparar y llamar a Groq 
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    prompt_graph = None
     if request.previous_graph:
-        user_content = f"Grafo Anterior: {json.dumps(request.previous_graph)}\n\nInstrucción del Usuario: {request.message}"
+        # Grafo anterior compacto, con alias cortos en lugar de UUIDs (ver prompt_graph.py)
+        prompt_graph = PromptGraph(request.previous_graph, description_chars=PROMPT_DESCRIPTION_CHARS)
+        user_content = f"Grafo Anterior ({ALIAS_INSTRUCTIONS}): {prompt_graph.text}\n\nInstrucción del Usuario: {request.message}"
     else:
         user_content = request.message
     messages.append({"role": "user", "content": user_content})
+    prompt_tokens = token_report(messages, prompt_graph)
+    print(f"Tokens de prompt (aprox.) para {graph_id}: {prompt_tokens}")
+
+    if request.stream:
+        return StreamingResponse(stream_graph_generation(request, graph_id, messages, prompt_graph, prompt_tokens, scope),
+                                 media_type="application/x-ndjson")
 
     try:
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-maverick-17b-128e-instruct", messages=messages, temperature=0.7, max_tokens=8000, max_completion_tokens=8192,
-        )
-        json_response = completion.choices[0].message.content
-        json_match = re.search(r'\{[\s\S]*\}', json_response)
-        if not json_match: raise HTTPException(status_code=500, detail=f"Respuesta de IA no es JSON: {json_response}")
-        
-        parsed_json = json.loads(json_match.group(0))
-        if "nodes" not in parsed_json or "edges" not in parsed_json:
-            raise ValueError("Estructura de grafo inválida de IA")
+        if not request.previous_graph and len(request.message) > MAPREDUCE_THRESHOLD:
+            # Documento largo: extracción por fragmentos y fusión determinista
+            parsed_json = await extract_graph_in_chunks(request.message, use_cache=not request.bypass_cache)
+        else:
+            json_response = await llm.complete(
+                "meta-llama/llama-4-maverick-17b-128e-instruct", messages, temperature=0.7, max_tokens=8000, max_completion_tokens=8192,
+                use_cache=not request.bypass_cache, validate=looks_like_json,
+            )
+            parsed_json = parse_graph_response(json_response)
+            if prompt_graph is not None:
+                parsed_json = prompt_graph.decode(parsed_json)
 
         # 2. Lógica para des-serializar el JSON en la DB Relacional
+        def save():
+            # Estado previo, para difundir solo la diferencia a los colaboradores. Se lee
+            # de la DB con el bloqueo ya tomado: la caché puede ir por detrás
+            lock_graph(db, graph_id)
+            previous_state = assemble_graph_json(graph_id, db) if request.graph_id else {"nodes": [], "edges": []}
+
+            # Guardar nodos y ejes con inserciones/actualizaciones en bloque
+            edge_diff = persist_llm_graph(db, parsed_json, graph_id, request.user_id, refine=bool(request.previous_graph),
+                                          scope=scope)
+
+            db.flush()
+            final_graph_json = assemble_graph_json(graph_id, db)
+            patches = diff_graphs(previous_state, final_graph_json)
+            revision = bump_revision(db, graph_id, recount=True) if patches else current_revision(db, graph_id)
+            if patches:
+                # Nueva versión en el historial, con quién hizo el cambio
+                save_graph_snapshot(db, graph_id, graph_json=final_graph_json, author_id=request.user_id)
+            db.commit() # Guardar todos los cambios
+            return edge_diff, patches, CachedGraph(revision, final_graph_json, title)
+
+        edge_diff, patches, entry = await asyncio.to_thread(save)
+        revision = entry.revision
+
+        # 3. Difundir los cambios y devolver el grafo completo y actualizado
+        await publish_patches(graph_id, revision, patches)
+        entry = graph_cache.put(graph_id, entry)
         
-        # Mapeo para rastrear los ID temporales (ej. "concepto_1") a los nuevos UUID de la DB
-        temp_id_to_new_uuid_map = {}
-        
-        # Si es un grafo existente, precargamos el mapa con los nodos existentes
-        if request.previous_graph:
-            existing_nodes = db.query(GraphNode).filter(GraphNode.graph_id == graph_id).all()
-            for node in existing_nodes:
-                temp_id_to_new_uuid_map[node.id] = node.id # El ID ya es un UUID
-
-        # Bucle 1: Crear Nodos
-        new_nodes_from_json = parsed_json.get("nodes", [])
-        for node_data in new_nodes_from_json:
-            temp_id = node_data.get("id")
-            
-            # Chequear si es un nodo que la IA quiere modificar o uno nuevo
-            # (Asumimos que si la IA devuelve un ID que ya es UUID, lo está modificando)
-            if temp_id in temp_id_to_new_uuid_map:
-                # Modificar nodo existente
-                node_db = db.query(GraphNode).filter(GraphNode.id == temp_id).first()
-                if node_db:
-                    node_db.label = node_data.get("label", node_db.label)
-                    node_db.description = node_data.get("description", node_db.description)
-                    node_db.node_type = node_data.get("type", node_db.node_type)
-                    node_db.color = node_data.get("color", node_db.color)
-            else:
-                # Crear nodo nuevo
-                new_node = GraphNode(
-                    id=str(uuid.uuid4()), # Nuevo UUID
-                    label=node_data.get("label"),
-                    description=node_data.get("description"),
-                    node_type=node_data.get("type"),
-                    color=node_data.get("color"),
-                    comments=node_data.get("comments", []),
-                    owner_id=request.user_id, # Asignar propietario
-                    graph_id=graph_id
-                )
-                db.add(new_node)
-                temp_id_to_new_uuid_map[temp_id] = new_node.id # Mapear temp_id a nuevo UUID
-
-        # Bucle 2: Crear Ejes (después de que todos los nodos estén en la sesión)
-        # Primero, borramos los ejes viejos si es un refine/add (lógica simple)
-        if request.previous_graph:
-            db.query(GraphEdge).filter(GraphEdge.graph_id == graph_id).delete()
-
-        new_edges_from_json = parsed_json.get("edges", [])
-        for edge_data in new_edges_from_json:
-            source_temp_id = edge_data.get("from")
-            target_temp_id = edge_data.get("to")
-
-            # Encontrar los UUIDs reales usando el mapa
-            source_real_id = temp_id_to_new_uuid_map.get(source_temp_id)
-            target_real_id = temp_id_to_new_uuid_map.get(target_temp_id)
-
-            if source_real_id and target_real_id:
-                new_edge = GraphEdge(
-                    id=str(uuid.uuid4()),
-                    label=edge_data.get("label"),
-                    graph_id=graph_id,
-                    source_node_id=source_real_id,
-                    target_node_id=target_real_id
-                )
-                db.add(new_edge)
-            else:
-                print(f"Advertencia: No se pudo crear eje, ID de nodo no encontrado: {source_temp_id} -> {target_temp_id}")
-
-        db.commit() # Guardar todos los cambios
-
-        # 3. Devolver el grafo completo y actualizado
-        final_graph_json = assemble_graph_json(graph_id, db)
-        await broadcast_update(graph_id, final_graph_json)
-        
-        return {"graph_id": graph_id, "graph": final_graph_json}
+        return graph_response(entry, graph_id=graph_id, revision=revision, edge_changes={
+            "added": len(edge_diff["added"]), "removed": len(edge_diff["removed"]), "unchanged": edge_diff["unchanged"],
+        }, prompt_tokens=prompt_tokens)
     
+    except LLMBusyError as e:
+        db.rollback()
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         db.rollback()
         print(f"Error en generate_graph: {e}")
@@ -426,58 +918,68 @@ async def generate_graph(request: GraphRequest, db: Session = Depends(get_db)):
 # --- 5. ENDPOINT /delete_node ACTUALIZADO 
 @app.post("/delete_node")
 async def delete_node(request: DeleteNodeRequest, db: Session = Depends(get_db)):
-    
-    # 1. Encontrar el nodo en la DB
-    node_to_delete = db.query(GraphNode).filter(
-        GraphNode.id == request.node_id,
-        GraphNode.graph_id == request.graph_id
-    ).first()
-
-    if not node_to_delete:
-        raise HTTPException(status_code=404, detail="Nodo no encontrado")
-
-    # 2. Lógica de restricción (¡directo en la consulta!)
-    if node_to_delete.owner_id != request.user_id:
-        raise HTTPException(
-            status_code=403, 
-            detail="Acción denegada: No puedes eliminar un nodo que no te pertenece."
-        )
-    
-    # 3. Eliminar el nodo. La DB (con 'ON DELETE CASCADE') se encarga de los ejes.
-    try:
-        db.delete(node_to_delete)
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error de base de datos al eliminar: {e}")
+    def write():
+        # 1. Encontrar el nodo en la DB
+        node_to_delete = db.query(GraphNode).filter(
+            GraphNode.id == request.node_id,
+            GraphNode.graph_id == request.graph_id
+        ).first()
+
+        if not node_to_delete:
+            raise HTTPException(status_code=404, detail="Nodo no encontrado")
+
+        # 2. Lógica de restricción (¡directo en la consulta!)
+        if node_to_delete.owner_id != request.user_id:
+            raise HTTPException(
+                status_code=403, 
+                detail="Acción denegada: No puedes eliminar un nodo que no te pertenece."
+            )
+        
+        # 3. Eliminar el nodo. La DB (con 'ON DELETE CASCADE') se encarga de los ejes.
+        try:
+            removed_edges = db.query(GraphEdge).filter(or_(GraphEdge.source_node_id == request.node_id,
+                                                           GraphEdge.target_node_id == request.node_id)).count()
+            db.delete(node_to_delete)
+            revision = bump_revision(db, request.graph_id, nodes=-1, edges=-removed_edges)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Error de base de datos al eliminar: {e}")
+        return revision
+
+    # Las consultas van a un hilo; en el bucle de eventos solo queda la difusión
+    revision = await asyncio.to_thread(write)
 
-    # 4. Notificar a todos los clientes
-    final_graph_json = assemble_graph_json(request.graph_id, db)
-    await broadcast_update(request.graph_id, final_graph_json)
+    # 4. Notificar a todos los clientes (los ejes del nodo se borran en cliente)
+    await publish_patches(request.graph_id, revision, [{"op": "node_removed", "id": request.node_id}])
 
-    return {"graph": final_graph_json}
+    return graph_response(await asyncio.to_thread(load_graph, request.graph_id, db), revision=revision)
 
 
 # --- 5.b ENDPOINT /delete_graph (nuevo) ---
 @app.post("/delete_graph")
 async def delete_graph(request: DeleteGraphRequest, db: Session = Depends(get_db)):
-    # Buscar el grafo
-    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
-    if not graph:
-        raise HTTPException(status_code=404, detail="Grafo no encontrado")
+    def write():
+        # Buscar el grafo
+        graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
+        if not graph:
+            raise HTTPException(status_code=404, detail="Grafo no encontrado")
 
-    """
-    # Permisos: solo el propietario puede borrar el grafo
-    if graph.user_id != request.user_id:
-        raise HTTPException(status_code=403, detail="Acción denegada: No puedes eliminar un grafo que no te pertenece.")
-    """
-    
-    try:
-        db.delete(graph)
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error de base de datos al eliminar grafo: {e}")
+        """
+        # Permisos: solo el propietario puede borrar el grafo
+        if graph.user_id != request.user_id:
+            raise HTTPException(status_code=403, detail="Acción denegada: No puedes eliminar un grafo que no te pertenece.")
+        """
+        
+        try:
+            db.delete(graph)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Error de base de datos al eliminar grafo: {e}")
+
+    # El borrado (con la cascada de nodos, ejes y versiones) va a un hilo
+    await asyncio.to_thread(write)
 
     # Notificar a clientes conectados (enviar grafo vacío) y cerrar conexiones WebSocket
     try:
@@ -485,58 +987,93 @@ async def delete_graph(request: DeleteGraphRequest, db: Session = Depends(get_db
     except Exception:
         pass
 
-    # Cerrar y limpiar colaboraciones si existen
-    conns = collaborations.get(request.graph_id, [])
-    for ws in list(conns):
-        try:
-            await ws.close(code=1000, reason="Graph deleted")
-        except Exception:
-            pass
-    if request.graph_id in collaborations:
-        collaborations.pop(request.graph_id, None)
+    # Cerrar y limpiar colaboraciones si existen (en todos los procesos)
+    await broadcast_message(request.graph_id, {"type": "graph_deleted", "graph_id": request.graph_id})
 
     return {"success": True}
 
 
 @app.post("/update_graph_title")
 async def update_graph_title(request: UpdateGraphTitleRequest, db: Session = Depends(get_db)):
-    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
-    if not graph:
-        raise HTTPException(status_code=404, detail="Grafo no encontrado")
+    def write():
+        graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
+        if not graph:
+            raise HTTPException(status_code=404, detail="Grafo no encontrado")
 
-    # (Opcional) podríamos chequear permisos aquí: graph.user_id == request.user_id
-    graph.title = request.title
-    try:
-        db.commit()
-        db.refresh(graph)
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Error actualizando título: {e}")
+        # (Opcional) podríamos chequear permisos aquí: graph.user_id == request.user_id
+        graph.title = request.title
+        try:
+            revision = bump_revision(db, request.graph_id)
+            db.commit()
+            db.refresh(graph)
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Error actualizando título: {e}")
+        return revision, graph.id, graph.title
+
+    revision, graph_id, title = await asyncio.to_thread(write)
 
     # Notificar a clientes conectados del cambio (si aplica)
     try:
-        final_graph_json = assemble_graph_json(request.graph_id, db)
-        await broadcast_update(request.graph_id, final_graph_json)
+        await publish_patches(request.graph_id, revision, [{"op": "title_changed", "title": title}])
     except Exception:
         pass
 
-    return {"success": True, "id": graph.id, "title": graph.title}
+    return {"success": True, "id": graph_id, "title": title}
 
 
 # --- 6. ENDPOINTS /expand_node y /refine_graph ACTUALIZADOS ---
 
-async def get_previous_graph_json(graph_id: str, db: Session) -> Optional[Dict]:
-    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).first()
-    if not graph:
-        return None
-    return assemble_graph_json(graph_id, db)
+# Contexto de /expand_node y /contextual_help (ver graph_context.py)
+CONTEXT_HOPS = int(os.environ.get("CONTEXT_HOPS", "2"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SEEDS = int(os.environ.get("CONTEXT_SEEDS", "3"))  # Semillas por relevancia si el texto no nombra ningún nodo
+
+# Índices BM25 por grafo y revisión (ver relevance.py); misma LRU que la analítica
+relevance_cache = AnalyticsCache(max_graphs=int(os.environ.get("RELEVANCE_CACHE_GRAPHS", "64")))
+
+def node_index(graph_id: Optional[str], entry_graph: Dict, revision: int = 0) -> NodeIndex:
+    """Índice del grafo guardado (en caché) o de un grafo enviado por el cliente."""
+    if graph_id is None:
+        return NodeIndex(revision, entry_graph)
+    return relevance_cache.get(graph_id, revision, lambda: NodeIndex(revision, entry_graph))
+
+def context_seeds(graph: Dict, node_id: Optional[str], text: str, index: Optional[NodeIndex] = None) -> List[str]:
+    """Nodo pedido explícitamente; si no, los nodos que menciona el texto o, en
+    su defecto, los más relevantes para él."""
+    if node_id:
+        return [node_id]
+    seeds = find_nodes(graph, text)
+    if not seeds and index is not None:
+        seeds = [node_id for node_id, _ in index.rank(text, limit=CONTEXT_SEEDS)]
+    return seeds
+
+def relevance_scores(index: NodeIndex, text: str) -> Optional[Dict[str, float]]:
+    """Puntuación BM25 de cada nodo para `text` (None si nada coincide: se usa el grado)."""
+    return dict(index.rank(text)) or None
 
 @app.post("/expand_node")
 async def expand_node(request: GraphRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == request.user_id).first()
-    if not user: raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    
-    request.previous_graph = await get_previous_graph_json(request.graph_id, db)
+    def read():
+        user = db.query(User).filter(User.id == request.user_id).first()
+        if not user: raise HTTPException(status_code=404, detail="Usuario no encontrado")
+        return load_graph(request.graph_id, db) if request.graph_id else None
+
+    entry = await asyncio.to_thread(read)
+    full_graph = entry.graph if entry else None
+    scope = None
+    if full_graph and full_graph.get("nodes"):
+        # Solo el vecindario del nodo (y lo más relevante del resto) dentro del
+        # presupuesto, con las mismas semillas que /contextual_help: si el texto
+        # no nombra ningún nodo, los más relevantes según BM25. Nunca el grafo entero.
+        label = request.message[len("Expandir:"):] if request.message.startswith("Expandir:") else request.message
+        index = node_index(request.graph_id, full_graph, entry.revision)
+        seeds = context_seeds(full_graph, request.node_id, label, index)
+        request.previous_graph = select_context(full_graph, seeds, hops=CONTEXT_HOPS, token_budget=CONTEXT_TOKEN_BUDGET,
+                                                scores=relevance_scores(index, f"{label} {request.context or ''}"))
+        scope = {node["id"] for node in request.previous_graph["nodes"]}
+    else:
+        request.previous_graph = full_graph
     
     context_instruction = ""
     if request.context:
@@ -547,19 +1084,56 @@ async def expand_node(request: GraphRequest, db: Session = Depends(get_db)):
     else:
         request.message = f"{request.message}{context_instruction}"
     
-    return await generate_graph(request, db)
+    return await run_graph_generation(request, db, scope=scope)
+
+QUIZ_CONTEXT_TOKENS = int(os.environ.get("QUIZ_CONTEXT_TOKENS", "1500"))
+QUIZ_DESCRIPTION_CHARS = 200
+QUIZ_SIZE = 10
+
+def quiz_concepts(graph_id: str, entry: CachedGraph, topic: Optional[str] = None) -> List[str]:
+    """"Etiqueta: descripción" de los nodos para el quiz, dentro de QUIZ_CONTEXT_TOKENS."""
+    index = node_index(graph_id, entry.graph, entry.revision)
+    nodes = {n["id"]: n for n in entry.graph.get("nodes", [])}
+    ranked = [node_id for node_id, _ in index.rank(topic)] if topic else []
+
+    def order():
+        # Primero lo relevante para el tema; el presupuesto que sobre, para cubrir el resto
+        yield from ranked
+        chosen = set(ranked)
+        yield from (node_id for node_id in index.coverage() if node_id not in chosen)
+
+    lines, used = [], 0
+    for node_id in order():
+        node = nodes[node_id]
+        description = (node.get("description") or "")[:QUIZ_DESCRIPTION_CHARS]
+        cost = node_tokens({"label": node.get("label"), "description": description})
+        if used + cost > QUIZ_CONTEXT_TOKENS:
+            break
+        lines.append(f"{node.get('label')}: {description}" if description else f"{node.get('label')}")
+        used += cost
+    return lines
+
+async def generate_quiz_questions(graph_id: str, topic: Optional[str] = None, use_cache: bool = False):
+    """Una tanda de preguntas del LLM: (revisión del grafo, nº de nodos, preguntas sin validar)."""
+    def read():
+        db = ReadSessionLocal()
+        try:
+            return load_graph(graph_id, db)
+        finally:
+            db.close()
 
-@app.post("/generate_quiz")
-async def generate_quiz(request: QuizRequest, db: Session = Depends(get_db)):
-    graph_json = assemble_graph_json(request.graph_id, db)
-    if not graph_json or not graph_json["nodes"]:
-        raise HTTPException(status_code=400, detail="El grafo está vacío, no se puede generar un quiz.")
+    entry = await asyncio.to_thread(read)
+    if not entry or not entry.graph["nodes"]:
+        raise ValueError("El grafo está vacío, no se puede generar un quiz.")
 
-    # Prompt para generar preguntas
-    nodes_text = ", ".join([n["label"] for n in graph_json["nodes"][:20]]) # Usamos los primeros 20 nodos
+    # Prompt para generar preguntas: los conceptos más relevantes para el tema
+    # (o los que mejor cubren el grafo) que caben en el presupuesto
+    nodes_text = "\n".join(f"- {line}" for line in quiz_concepts(graph_id, entry, topic))
     prompt = f"""
-    Basado en estos conceptos: {nodes_text}.
-    Genera 10 preguntas de opción múltiple para evaluar el conocimiento del estudiante.
+    Basado en estos conceptos:
+{nodes_text}
+
+    Genera {QUIZ_SIZE} preguntas de opción múltiple para evaluar el conocimiento del estudiante.
     
     Responde ÚNICAMENTE con un JSON válido con este formato exacto:
     {{
@@ -577,31 +1151,64 @@ async def generate_quiz(request: QuizRequest, db: Session = Depends(get_db)):
     messages = [{"role": "system", "content": "Eres un profesor experto creando evaluaciones."},
                 {"role": "user", "content": prompt}]
 
+    content = await llm.complete(
+        "openai/gpt-oss-120b", # O llama-3.1-70b-versatile
+        messages,
+        temperature=0.5,
+        response_format={"type": "json_object"}, # Forzar JSON si el modelo lo soporta, sino usar regex
+        use_cache=use_cache, validate=looks_like_json,
+    )
+    # Intento de parseo robusto
     try:
-        completion = client.chat.completions.create(
-            model="openai/gpt-oss-120b", # O llama-3.1-70b-versatile
-            messages=messages,
-            temperature=0.5,
-            response_format={"type": "json_object"} # Forzar JSON si el modelo lo soporta, sino usar regex
-        )
-        content = completion.choices[0].message.content
-        # Intento de parseo robusto
-        try:
-            quiz_data = json.loads(content)
-        except:
-            # Fallback regex si el modelo habla texto antes del json
-            json_match = re.search(r'\{[\s\S]*\}', content)
-            if json_match:
-                quiz_data = json.loads(json_match.group(0))
-            else:
-                raise ValueError("No se pudo parsear JSON del quiz")
-                
-        return quiz_data
+        quiz_data = json.loads(content)
+    except:
+        # Fallback regex si el modelo habla texto antes del json
+        json_match = re.search(r'\{[\s\S]*\}', content)
+        if json_match:
+            quiz_data = json.loads(json_match.group(0))
+        else:
+            raise ValueError("No se pudo parsear JSON del quiz")
+    return entry.revision, len(entry.graph["nodes"]), quiz_data.get("questions") or []
+
+# Reservas de preguntas pregeneradas por grafo (ver quiz_pool.py). Las tandas
+# no usan la caché del LLM: el mismo prompt devolvería las mismas preguntas.
+quiz_pools = QuizPoolManager(
+    generate_quiz_questions,
+    quiz_size=QUIZ_SIZE,
+    target=int(os.environ.get("QUIZ_POOL_TARGET", "40")),
+    low_water=int(os.environ.get("QUIZ_POOL_LOW_WATER", "20")),
+    max_serves=int(os.environ.get("QUIZ_POOL_MAX_SERVES", "20")),
+    invalidate_ratio=float(os.environ.get("QUIZ_POOL_INVALIDATE_RATIO", "0.2")),
+    refresh_delay=float(os.environ.get("QUIZ_POOL_REFRESH_DELAY", "5")),
+    max_pools=int(os.environ.get("QUIZ_POOL_MAX", "256")),
+)
+
+@app.post("/generate_quiz")
+async def generate_quiz(request: QuizRequest, db: Session = Depends(get_read_db)):
+    entry = await asyncio.to_thread(load_graph, request.graph_id, db)
+    if not entry or not entry.graph["nodes"]:
+        raise HTTPException(status_code=400, detail="El grafo está vacío, no se puede generar un quiz.")
+
+    try:
+        # Muestra al azar de la reserva; bypass_cache pide un quiz recién generado
+        if request.bypass_cache:
+            return await quiz_pools.fresh(request.graph_id, request.topic)
+        return await quiz_pools.quiz(request.graph_id, request.topic)
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generando quiz: {str(e)}")
 
+@app.get("/quiz_pool_stats")
+async def quiz_pool_stats(graph_id: Optional[str] = None):
+    return quiz_pools.stats(graph_id)
+
+@app.on_event("shutdown")
+async def stop_quiz_pools():
+    quiz_pools.shutdown()
+
 @app.post("/update_user_stats")
-async def update_user_stats(stats: UserStatsUpdate, db: Session = Depends(get_db)):
+def update_user_stats(stats: UserStatsUpdate, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == stats.user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
@@ -623,7 +1230,7 @@ async def update_user_stats(stats: UserStatsUpdate, db: Session = Depends(get_db
 
 
 @app.get("/get_user_profile/{user_id}")
-async def get_user_profile(user_id: str, db: Session = Depends(get_db)):
+def get_user_profile(user_id: str, db: Session = Depends(get_read_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user: return {}
     return {
@@ -641,68 +1248,118 @@ async def get_user_profile(user_id: str, db: Session = Depends(get_db)):
 
 @app.post("/refine_graph")
 async def refine_graph(request: FeedbackRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == request.user_id).first()
-    if not user: raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    def read():
+        user = db.query(User).filter(User.id == request.user_id).first()
+        if not user: raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-    # Ensamblar el grafo anterior desde la DB
-    previous_graph_json = await get_previous_graph_json(request.graph_id, db)
-    if not previous_graph_json:
-        raise HTTPException(status_code=404, detail="Grafo no encontrado")
+        # Ensamblar el grafo anterior desde la DB
+        entry = load_graph(request.graph_id, db)
+        if not entry:
+            raise HTTPException(status_code=404, detail="Grafo no encontrado")
+        return entry
 
-    graph_db = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
+    entry = await asyncio.to_thread(read)
 
     # Preparar la solicitud para generate_graph
     graph_request = GraphRequest(
         message=request.feedback,
-        previous_graph=previous_graph_json,
+        previous_graph=entry.graph,
         graph_id=request.graph_id,
         user_id=request.user_id,
-        title=graph_db.title
+        title=entry.title
     )
     
     return await generate_graph(graph_request, db)
 
 # --- 7. ENDPOINTS RESTANTES ACTUALIZADOS ---
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def encode_history_cursor(title_key: str, graph_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([title_key, graph_id]).encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    try:
+        title_key, graph_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(title_key), str(graph_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de historial inválido")
+
 @app.get("/graph_history/{user_id}")
-async def graph_history(user_id: str, db: Session = Depends(get_db)):
-    # Lógica global (como pediste antes)
+def graph_history(user_id: str, limit: int = HISTORY_PAGE_SIZE, cursor: Optional[str] = None,
+                  owner: Optional[str] = None, title_prefix: Optional[str] = None,
+                  updated_since: Optional[datetime.datetime] = None, db: Session = Depends(get_read_db)):
+    """Historial global paginado por título (cursor opaco en `next_cursor`).
+
+    Filtros opcionales: propietario, prefijo del título (distingue mayúsculas)
+    y fecha mínima de última modificación.
+    """
     print(f"Usuario {user_id} solicitando historial de grafos (modo global).")
-    todos_los_grafos = db.query(KnowledgeGraph).order_by(KnowledgeGraph.title).all()
-    graphs_list = [{"id": g.id, "title": g.title} for g in todos_los_grafos]
-    return {"graphs": graphs_list}
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = db.query(KnowledgeGraph.id, KnowledgeGraph.title, KnowledgeGraph.user_id, KnowledgeGraph.revision,
+                     KnowledgeGraph.node_count, KnowledgeGraph.edge_count, KnowledgeGraph.updated_at,
+                     GRAPH_TITLE_KEY.label("title_key"))
+    if owner:
+        query = query.filter(KnowledgeGraph.user_id == owner)
+    if title_prefix:
+        # Rango en vez de LIKE para que use el índice de la clave de orden
+        query = query.filter(GRAPH_TITLE_KEY >= title_prefix, GRAPH_TITLE_KEY < title_prefix + "\U0010ffff")
+    if updated_since:
+        if updated_since.tzinfo:
+            updated_since = updated_since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        query = query.filter(KnowledgeGraph.updated_at >= updated_since)
+    if cursor:
+        title_key, graph_id = decode_history_cursor(cursor)
+        # La cota sobre la clave sola es la que SQLite usa como rango del índice;
+        # con solo la comparación de tuplas recorre el índice desde el principio
+        query = query.filter(GRAPH_TITLE_KEY >= title_key,
+                             tuple_(GRAPH_TITLE_KEY, KnowledgeGraph.id) > tuple_(title_key, graph_id))
+    rows = query.order_by(GRAPH_TITLE_KEY, KnowledgeGraph.id).limit(limit + 1).all()
+
+    page = rows[:limit]
+    next_cursor = encode_history_cursor(page[-1].title_key, page[-1].id) if len(rows) > limit else None
+    graphs_list = [{
+        "id": g.id, "title": g.title, "user_id": g.user_id, "revision": g.revision,
+        "node_count": g.node_count, "edge_count": g.edge_count,
+        "updated_at": g.updated_at.isoformat() if g.updated_at else None,
+    } for g in page]
+    return {"graphs": graphs_list, "next_cursor": next_cursor}
 
 @app.post("/add_comment")
 async def add_comment(request: CommentRequest, db: Session = Depends(get_db)):
-    # Ahora esto es mucho más eficiente
-    node = db.query(GraphNode).filter(
-        GraphNode.id == request.node_id,
-        GraphNode.graph_id == request.graph_id
-    ).first()
-    
-    if not node:
-        raise HTTPException(status_code=404, detail="Nodo no encontrado")
-
-    # Modificar el campo JSON
-    if not node.comments:
-        node.comments = []
-    
-    node.comments.append({
+    comment = {
         "user_id": request.user_id,
         "text": request.text,
         "timestamp": str(uuid.uuid4())
-    })
-    
-    db.commit()
-    db.refresh(node)
+    }
 
-    # Notificar a todos
-    final_graph_json = assemble_graph_json(request.graph_id, db)
-    await broadcast_update(request.graph_id, final_graph_json)
-    
-    return {"graph": final_graph_json}
+    def write():
+        # Ahora esto es mucho más eficiente
+        node = db.query(GraphNode).filter(
+            GraphNode.id == request.node_id,
+            GraphNode.graph_id == request.graph_id
+        ).first()
+        
+        if not node:
+            raise HTTPException(status_code=404, detail="Nodo no encontrado")
+
+        # Modificar el campo JSON: asignar una lista nueva para que SQLAlchemy
+        # detecte el cambio (un append en sitio no se guarda)
+        node.comments = [*(node.comments or []), comment]
+        
+        revision = bump_revision(db, request.graph_id)
+        db.commit()
+        return revision
+
+    revision = await asyncio.to_thread(write)
 
-# WebSocket y broadcast (sin cambios)
+    # Notificar a todos (solo el comentario nuevo)
+    await publish_patches(request.graph_id, revision, [{"op": "comment_appended", "node_id": request.node_id, "comment": comment}])
+
+    return graph_response(await asyncio.to_thread(load_graph, request.graph_id, db), revision=revision)
+
+# WebSocket de colaboración y difusión (ver collab.py)
 @app.websocket("/ws/{graph_id}")
 async def websocket_endpoint(websocket: WebSocket, graph_id: str):
     await websocket.accept()
@@ -713,8 +1370,8 @@ async def websocket_endpoint(websocket: WebSocket, graph_id: str):
         await websocket.close(code=1008, reason="Graph not found")
         return
 
-    collaborations[graph_id].append(websocket)
-    print(f"WebSocket connected for graph {graph_id}. Conns: {len(collaborations[graph_id])}")
+    connection = collaborations.connect(graph_id, websocket)
+    print(f"WebSocket connected for graph {graph_id}. Conns: {collaborations.count(graph_id)}")
     try:
         while True:
             # Lógica de recepción (si decides implementar edición en vivo por WS)
@@ -723,67 +1380,248 @@ async def websocket_endpoint(websocket: WebSocket, graph_id: str):
             # Por ahora, este WS es principalmente para 'broadcast_update'
             
     except WebSocketDisconnect:
-        collaborations[graph_id].remove(websocket)
-        print(f"WebSocket disconnected for graph {graph_id}. Remaining: {len(collaborations[graph_id])}")
-
-async def broadcast_update(graph_id: str, graph_data: Dict, exclude_sender: Optional[WebSocket] = None):
-    active_connections = collaborations.get(graph_id, [])
-    print(f"Broadcasting update for graph {graph_id} to {len(active_connections)} client(s).")
-    message = json.dumps({"type": "update", "graph": graph_data})
-    for connection in active_connections:
-        if connection != exclude_sender:
-            try: await connection.send_text(message)
-            except Exception as e: print(f"Error sending broadcast: {e}")
+        pass
+    finally:
+        await collaborations.disconnect(connection)
+        print(f"WebSocket disconnected for graph {graph_id}. Remaining: {collaborations.count(graph_id)}")
+
+async def broadcast_update(graph_id: str, graph_data: Dict):
+    print(f"Broadcasting update for graph {graph_id} to {collaborations.count(graph_id)} local client(s).")
+    await broadcast_message(graph_id, {"type": "update", "graph": graph_data})
+
+async def broadcast_message(graph_id: str, payload: Dict):
+    """Publica un mensaje (update, patch...) en el bus; cada proceso lo entrega
+    a sus colaboradores sin esperar a ningún cliente."""
+    await collab_bus.publish(graph_id, payload)
+
+async def deliver_collab_event(graph_id: str, payload: Dict, local: bool):
+    """Entrega un evento del bus (propio o de otro proceso) a los WebSockets locales."""
+    if payload.get("type") == "patch":
+        # Todos los procesos guardan los parches para poder resincronizar clientes
+        # y descartan su copia en caché del grafo anterior a esta revisión
+        patch_log.append(graph_id, payload["revision"], payload["patches"])
+        graph_cache.invalidate(graph_id, payload["revision"])
+        analytics_cache.apply_patches(graph_id, payload["revision"], payload["patches"], payload.get("base_revision"))
+        relevance_cache.apply_patches(graph_id, payload["revision"], payload["patches"], payload.get("base_revision"))
+        # Solo el proceso que hizo el cambio pregenera preguntas (una llamada al LLM, no una por worker)
+        quiz_pools.note_patches(graph_id, payload["revision"], payload["patches"], warm=local)
+    if payload.get("type") == "graph_deleted":
+        await collaborations.close_graph(graph_id, code=1000, reason="Graph deleted")
+        patch_log.forget(graph_id)
+        graph_cache.invalidate(graph_id)
+        analytics_cache.forget(graph_id)
+        relevance_cache.forget(graph_id)
+        quiz_pools.forget(graph_id)
+        return
+    collaborations.publish(graph_id, payload)
+
+@app.on_event("startup")
+async def start_collab_bus():
+    await collab_bus.start(deliver_collab_event)
+
+@app.on_event("shutdown")
+async def stop_collab_bus():
+    await collab_bus.stop()
+
+@app.get("/graph_cache_stats")
+async def graph_cache_stats():
+    return graph_cache.stats()
+
+@app.get("/collab_stats")
+async def collab_stats(graph_id: Optional[str] = None):
+    """Métricas por grafo: conexiones, profundidad de colas y latencia de envío."""
+    return {"graphs": collaborations.stats(graph_id)}
+
+# --- Revisiones y parches de colaboración (ver graph_patches.py) ---
+PATCH_LOG_SIZE = int(os.environ.get("PATCH_LOG_SIZE", "200"))
+PATCH_LOG_GRAPHS = int(os.environ.get("PATCH_LOG_GRAPHS", "1024"))
+patch_log = PatchLog(max_revisions=PATCH_LOG_SIZE, max_graphs=PATCH_LOG_GRAPHS)
+
+def bump_revision(db: Session, graph_id: str, nodes: int = 0, edges: int = 0, recount: bool = False) -> int:
+    """Incrementa la revisión del grafo dentro de la transacción actual.
+
+    `nodes`/`edges` son las variaciones de tamaño de esta escritura: así los
+    contadores del historial se mantienen sin recontar filas. Con `recount`,
+    los contadores se recalculan con COUNT(*) en la misma transacción (para
+    escrituras en bloque que no llevan la cuenta de sus filas).
+    """
+    if recount:
+        counts = {
+            KnowledgeGraph.node_count: select(func.count()).select_from(GraphNode)
+                                       .where(GraphNode.graph_id == graph_id).scalar_subquery(),
+            KnowledgeGraph.edge_count: select(func.count()).select_from(GraphEdge)
+                                       .where(GraphEdge.graph_id == graph_id).scalar_subquery(),
+        }
+    else:
+        counts = {KnowledgeGraph.node_count: KnowledgeGraph.node_count + nodes,
+                  KnowledgeGraph.edge_count: KnowledgeGraph.edge_count + edges}
+    db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).update({
+        KnowledgeGraph.revision: KnowledgeGraph.revision + 1,
+        **counts,
+        KnowledgeGraph.updated_at: datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    return current_revision(db, graph_id)
+
+def lock_graph(db: Session, graph_id: str):
+    """Abre la transacción de escritura del grafo con un UPDATE que no cambia nada.
+
+    SQLite toma ahí el bloqueo de escritura y PostgreSQL el de la fila, así que
+    lo que se lea después (el estado previo de un diff) no cambia hasta el commit.
+    """
+    db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).update(
+        {KnowledgeGraph.revision: KnowledgeGraph.revision}, synchronize_session=False)
+
+def current_revision(db: Session, graph_id: str) -> int:
+    return db.query(KnowledgeGraph.revision).filter(KnowledgeGraph.id == graph_id).scalar() or 0
+
+async def publish_patches(graph_id: str, revision: int, patches: List[Dict]):
+    """Registra los parches de una revisión y los difunde a los colaboradores."""
+    if not patches:
+        return
+    print(f"Broadcasting revision {revision} for graph {graph_id} ({len(patches)} patch(es)).")
+    await broadcast_message(graph_id, {"type": "patch", "graph_id": graph_id, "revision": revision, "patches": patches})
+
+@app.get("/graph_changes/{graph_id}")
+def graph_changes(graph_id: str, since: int = 0, db: Session = Depends(get_read_db)):
+    """Resincronización: parches desde la revisión `since`, o instantánea completa
+    si el cliente se ha quedado demasiado atrás."""
+    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).first()
+    if not graph:
+        raise HTTPException(status_code=404, detail="Grafo no encontrado")
+    changes = patch_log.since(graph_id, since, graph.revision)
+    if changes is None:
+        return {"revision": graph.revision, "snapshot": load_graph(graph_id, db).graph}
+    return {"revision": graph.revision, "changes": changes}
 
 # Endpoints de /analyze_graph, /contextual_help, /export_graph, /get_preferences, /update_preferences 
 
 @app.post("/export_graph")
-async def export_graph(request: ExportRequest, db: Session = Depends(get_db)):
-    graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == request.graph_id).first()
-    if not graph: raise HTTPException(status_code=404, detail="Grafo no encontrado")
+def export_graph(request: ExportRequest, db: Session = Depends(get_read_db)):
+    entry = load_graph(request.graph_id, db)
+    if not entry: raise HTTPException(status_code=404, detail="Grafo no encontrado")
     if request.format == 'json':
-        return assemble_graph_json(request.graph_id, db)
+        return Response(content=entry.body, media_type="application/json")
     else: 
         raise HTTPException(status_code=400, detail="Formato no soportado (solo json)")
 
+analytics_cache = AnalyticsCache(max_graphs=int(os.environ.get("ANALYTICS_CACHE_GRAPHS", "64")))
+# "auto": matrices dispersas (si NumPy/SciPy están instalados) desde ANALYTICS_SPARSE_MIN_NODES nodos
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "auto")
+ANALYTICS_SPARSE_MIN_NODES = int(os.environ.get("ANALYTICS_SPARSE_MIN_NODES", "5000"))
+if ANALYTICS_BACKEND == "sparse" and not SPARSE_AVAILABLE:
+    raise RuntimeError("ANALYTICS_BACKEND=sparse requiere NumPy y SciPy (pip install -r requirements.txt)")
+
+def build_analytics(graph_id: str, node_count: int, db: Session):
+    """Analítica de un grafo con el backend que toque según su tamaño.
+
+    Solo lee IDs (y etiquetas) de graph_nodes/graph_edges: no ensambla el grafo
+    con descripciones y comentarios como load_graph. La revisión se relee en la
+    misma instantánea que las filas, así que puede ser más nueva que la pedida.
+    """
+    use_sparse = SPARSE_AVAILABLE and (
+        ANALYTICS_BACKEND == "sparse"
+        or (ANALYTICS_BACKEND == "auto" and node_count >= ANALYTICS_SPARSE_MIN_NODES)
+    )
+    if use_sparse:
+        analytics = load_sparse_analytics(db, graph_id)
+        if analytics is not None:
+            return analytics
+    with read_snapshot(db):
+        revision = current_revision(db, graph_id)
+        nodes = [{"id": node_id, "label": label} for node_id, label in
+                 db.query(GraphNode.id, GraphNode.label).filter(GraphNode.graph_id == graph_id)]
+        edges = [{"from": source, "to": target} for source, target in
+                 db.query(GraphEdge.source_node_id, GraphEdge.target_node_id).filter(GraphEdge.graph_id == graph_id)]
+    return GraphAnalytics(revision, {"nodes": nodes, "edges": edges})
+
+def node_labels(graph_id: str, revision: int, db: Session) -> Dict[str, str]:
+    """ID -> etiqueta: del grafo en caché si está en esa revisión; si no, solo esas dos columnas."""
+    entry = graph_cache.get(graph_id)
+    if entry is not None and entry.revision == revision:
+        rows = ((node["id"], node.get("label")) for node in entry.graph.get("nodes", []))
+    else:
+        rows = db.query(GraphNode.id, GraphNode.label).filter(GraphNode.graph_id == graph_id)
+    return {node_id: label if label is not None else "Sin etiqueta" for node_id, label in rows}
+
+class AnalyzeRequest(BaseModel):
+    graph_id: str
+    format: Optional[str] = None
+    metrics: Optional[List[str]] = None # Por defecto: grados, PageRank y componentes
+    # Camino de aprendizaje más corto hasta `target` (desde `source` o desde una raíz)
+    target: Optional[str] = None
+    source: Optional[str] = None
+
 @app.post("/analyze_graph")
-async def analyze_graph(request: ExportRequest, db: Session = Depends(get_db)):
-    graph_json = assemble_graph_json(request.graph_id, db)
-    if not graph_json or "nodes" not in graph_json or "edges" not in graph_json:
-         raise HTTPException(status_code=400, detail="El contenido del grafo es inválido o está vacío.")
-    
-    G = nx.DiGraph(); node_map = {}
+def analyze_graph(request: AnalyzeRequest, db: Session = Depends(get_read_db)):
+    graph = db.query(KnowledgeGraph.revision, KnowledgeGraph.node_count).filter(KnowledgeGraph.id == request.graph_id).first()
+    if not graph:
+        raise HTTPException(status_code=404, detail="Grafo no encontrado")
+    metrics = request.metrics or list(DEFAULT_METRICS)
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Métricas desconocidas: {', '.join(unknown)}. Disponibles: {', '.join(METRICS)}")
+
     try:
-        for node in graph_json.get("nodes", []):
-            node_id = node.get("id");
-            if node_id: G.add_node(node_id, label=node.get("label", "Sin etiqueta")); node_map[node_id] = node.get("label", "Sin etiqueta")
-        for edge in graph_json.get("edges", []):
-            source_id = edge.get("from"); target_id = edge.get("to")
-            if source_id in G.nodes and target_id in G.nodes: G.add_edge(source_id, target_id, label=edge.get("label", ""))
-        
-        in_degree_centrality = nx.in_degree_centrality(G); out_degree_centrality = nx.out_degree_centrality(G)
-        label_in_centrality = {node_map.get(node_id, node_id): value for node_id, value in in_degree_centrality.items()}
-        label_out_centrality = {node_map.get(node_id, node_id): value for node_id, value in out_degree_centrality.items()}
-        return {"analytics": {"in_degree_centrality": label_in_centrality, "out_degree_centrality": label_out_centrality}}
+        analytics = analytics_cache.get(request.graph_id, graph.revision,
+                                        lambda: build_analytics(request.graph_id, graph.node_count, db))
+        result = {name: analytics.metric(name) for name in metrics}
+        if request.target:
+            result["learning_path"] = analytics.learning_path(request.target, request.source)
+        # Resultados por ID de nodo; las etiquetas van aparte (puede haber repetidas)
+        return {"revision": analytics.revision, "analytics": result,
+                "labels": node_labels(request.graph_id, analytics.revision, db)}
     except Exception as e: raise HTTPException(status_code=500, detail=f"Error durante el análisis: {str(e)}")
 
+@app.get("/analytics_stats")
+async def analytics_stats():
+    return analytics_cache.stats()
+
 @app.post("/contextual_help")
-async def contextual_help(request: GraphRequest, db: Session = Depends(get_db)):
-    previous_graph_json = None
-    if request.graph_id:
-        previous_graph_json = await get_previous_graph_json(request.graph_id, db)
-        
-    help_prompt = f"Proporciona sugerencias contextuales o tutorial breve en español para: {request.message}\nConsiderando este grafo (si existe): {json.dumps(previous_graph_json)}"
+async def contextual_help(request: GraphRequest, db: Session = Depends(get_read_db)):
+    graph_context = None
+    entry = await asyncio.to_thread(load_graph, request.graph_id, db) if request.graph_id else None
+    full_graph = entry.graph if entry else request.previous_graph
+    if full_graph and full_graph.get("nodes"):
+        index = node_index(request.graph_id if entry else None, full_graph, entry.revision if entry else 0)
+        seeds = context_seeds(full_graph, request.node_id, request.message, index)
+        subgraph = select_context(full_graph, seeds, hops=CONTEXT_HOPS, token_budget=CONTEXT_TOKEN_BUDGET,
+                                  scores=relevance_scores(index, request.message))
+        graph_context = PromptGraph(subgraph).text
+
+    help_prompt = f"Proporciona sugerencias contextuales o tutorial breve en español para: {request.message}\nConsiderando este grafo (si existe): {graph_context}"
     messages = [{"role": "system", "content": "Eres un asistente útil para grafos de conocimiento. Responde brevemente en español."},
                 {"role": "user", "content": help_prompt}]
     try:
-        completion = client.chat.completions.create(model="openai/gpt-oss-20b", messages=messages, temperature=0.7, max_tokens=4503)
-        return {"help": completion.choices[0].message.content}
+        content = await llm.complete("openai/gpt-oss-20b", messages, temperature=0.7, max_tokens=4503,
+                                     use_cache=not request.bypass_cache, validate=bool)
+        return {"help": content}
+    except LLMBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error obteniendo ayuda: {str(e)}")
 
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+@app.get("/search")
+def search(q: str, graph_id: Optional[str] = None, limit: int = SEARCH_PAGE_SIZE, offset: int = 0,
+           db: Session = Depends(get_read_db)):
+    """Busca en etiquetas, descripciones y comentarios de los nodos (sin distinguir acentos).
+
+    Resultados por relevancia; `next_offset` es None en la última página.
+    """
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+    results = search_nodes(db, q, graph_id=graph_id, limit=limit + 1, offset=offset)
+    return {"results": results[:limit], "next_offset": offset + limit if len(results) > limit else None}
+
+@app.get("/llm_stats")
+def llm_stats():
+    """Concurrencia por modelo y contadores de aciertos/fallos de la caché del LLM."""
+    return llm.stats()
+
 @app.post("/update_preferences")
-async def update_preferences(request: PreferenceRequest, db: Session = Depends(get_db)):
+def update_preferences(request: PreferenceRequest, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == request.user_id).first()
     if not user: raise HTTPException(status_code=404, detail="Usuario no encontrado...")
     pref = db.query(Preference).filter(Preference.user_id == request.user_id).first()
@@ -792,7 +1630,7 @@ async def update_preferences(request: PreferenceRequest, db: Session = Depends(g
     db.commit(); db.refresh(pref); return {"preferences": pref.content}
 
 @app.get("/get_preferences/{user_id}")
-async def get_preferences(user_id: str, db: Session = Depends(get_db)):
+def get_preferences(user_id: str, db: Session = Depends(get_read_db)):
     pref = db.query(Preference).filter(Preference.user_id == user_id).first()
     if not pref: return {"preferences": {}}
     return {"preferences": pref.content}
@@ -803,91 +1641,178 @@ if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
-
-
-
-
-class GraphVersion(Base):
-    __tablename__ = "graph_versions"
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    graph_id = Column(String, ForeignKey("knowledge_graphs.id", ondelete="CASCADE"), nullable=False)
-    content = Column(SQLJSON, nullable=False) # Guardamos el JSON completo {nodes, edges}
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    
-    graph = relationship("KnowledgeGraph", back_populates="versions")
-
-#
-KnowledgeGraph.versions = relationship("GraphVersion", back_populates="graph", cascade="all, delete-orphan", order_by="GraphVersion.created_at")
-
-# Crear la tabla nueva si no existe
-Base.metadata.create_all(bind=engine)
-
-# --- FUNCIÓN AUXILIAR PARA GUARDAR VERSIÓN ---
-def save_graph_snapshot(db: Session, graph_id: str):
-    """Guarda el estado actual del grafo como una nueva versión."""
-    graph_json = assemble_graph_json(graph_id, db)
-    new_version = GraphVersion(graph_id=graph_id, content=graph_json)
+# --- FUNCIONES AUXILIARES DEL HISTORIAL DE VERSIONES ---
+def version_content(db: Session, version: GraphVersion) -> Dict:
+    """Grafo completo de una versión: su keyframe más los deltas hasta ella."""
+    if version.kind is None:
+        return version.content or {"nodes": [], "edges": []} # Versión antigua sin migrar
+    keyframe_seq = db.query(func.max(GraphVersion.seq)).filter(
+        GraphVersion.graph_id == version.graph_id, GraphVersion.kind == "keyframe", GraphVersion.seq <= version.seq
+    ).scalar()
+    chain = db.query(GraphVersion.kind, GraphVersion.payload).filter(
+        GraphVersion.graph_id == version.graph_id, GraphVersion.seq >= (keyframe_seq or 0), GraphVersion.seq <= version.seq
+    ).order_by(GraphVersion.seq).all()
+    return reconstruct(chain)
+
+def save_graph_snapshot(db: Session, graph_id: str, graph_json: Optional[Dict] = None, author_id: Optional[str] = None):
+    """Añade el estado actual del grafo como nueva versión (keyframe o delta). No hace commit."""
+    # Con el bloqueo del grafo, dos guardados a la vez no leen la misma última
+    # versión ni chocan con el índice único (graph_id, seq)
+    lock_graph(db, graph_id)
+    if graph_json is None:
+        graph_json = assemble_graph_json(graph_id, db)
+    last = db.query(GraphVersion).filter(GraphVersion.graph_id == graph_id).order_by(GraphVersion.seq.desc()).first()
+    seq = last.seq + 1 if last else 0
+    kind, payload = encode_version(version_content(db, last) if last else None, graph_json, seq)
+    new_version = GraphVersion(
+        graph_id=graph_id, seq=seq, kind=kind, payload=payload, byte_size=len(payload),
+        node_count=len(graph_json.get("nodes", [])), edge_count=len(graph_json.get("edges", [])),
+        author_id=author_id,
+        content=SQLJSON.NULL, # JSON 'null': en DBs antiguas la columna es NOT NULL
+    )
     db.add(new_version)
+
+# Compactación: se conservan las VERSION_RETENTION versiones más recientes de
+# cada grafo y la cadena se vuelve a codificar (keyframes a intervalos regulares).
+VERSION_RETENTION = int(os.environ.get("VERSION_RETENTION", "100"))
+VERSION_COMPACT_INTERVAL = float(os.environ.get("VERSION_COMPACT_INTERVAL", "0"))  # segundos; 0 = desactivado
+
+def compact_graph_versions(db: Session, graph_id: str, keep: int = VERSION_RETENTION) -> Dict:
+    lock_graph(db, graph_id)  # Sin versiones nuevas mientras se renumera la cadena
+    versions = db.query(GraphVersion).filter(GraphVersion.graph_id == graph_id).order_by(GraphVersion.seq, GraphVersion.created_at).all()
+    before = sum(v.byte_size for v in versions)
+    # Reconstruir toda la cadena en una pasada
+    graphs, current = [], {"nodes": [], "edges": []}
+    for v in versions:
+        if v.kind is None:
+            current = v.content or {"nodes": [], "edges": []}
+        elif v.kind == "keyframe":
+            current = decode_payload(v.payload)
+        else:
+            current = apply_delta(current, decode_payload(v.payload))
+        graphs.append(current)
+    split = max(0, len(versions) - keep) if keep > 0 else 0
+    pruned, kept = versions[:split], versions[split:]
+    for v in pruned:
+        db.delete(v)
+    db.flush()
+    # seq provisional negativo para no chocar con el índice único al renumerar
+    for i, v in enumerate(kept):
+        v.seq = -(i + 1)
+    db.flush()
+    for seq, (v, (kind, payload)) in enumerate(zip(kept, reencode(graphs[split:]))):
+        v.seq, v.kind, v.payload, v.byte_size, v.content = seq, kind, payload, len(payload), SQLJSON.NULL
     db.commit()
+    return {"graph_id": graph_id, "pruned": len(pruned), "kept": len(kept),
+            "bytes_before": before, "bytes_after": sum(v.byte_size for v in kept)}
+
+async def compact_versions_periodically():
+    while True:
+        await asyncio.sleep(VERSION_COMPACT_INTERVAL)
+        def run():
+            db = SessionLocal()
+            try:
+                graph_ids = [gid for (gid,) in db.query(GraphVersion.graph_id).group_by(GraphVersion.graph_id)
+                             .having(func.count(GraphVersion.id) > VERSION_RETENTION)]
+                for gid in graph_ids:
+                    print(f"Compactando versiones: {compact_graph_versions(db, gid)}")
+            finally:
+                db.close()
+        try:
+            await asyncio.to_thread(run)
+        except Exception as e:
+            print(f"Error compactando versiones: {e}")
+
+@app.on_event("startup")
+async def start_version_compaction():
+    if VERSION_COMPACT_INTERVAL > 0:
+        asyncio.create_task(compact_versions_periodically())
 
 
 @app.get("/graph_versions/{graph_id}")
-async def get_graph_versions(graph_id: str, db: Session = Depends(get_db)):
-    """Obtiene la lista de versiones (historial) de un grafo."""
-    versions = db.query(GraphVersion).filter(GraphVersion.graph_id == graph_id).order_by(GraphVersion.created_at.asc()).all()
-    return {"versions": [{"id": v.id, "created_at": v.created_at, "node_count": len(v.content.get('nodes', []))} for v in versions]}
+def get_graph_versions(graph_id: str, db: Session = Depends(get_read_db)):
+    """Obtiene la lista de versiones (historial) de un grafo, solo con sus metadatos."""
+    versions = db.query(GraphVersion.id, GraphVersion.created_at, GraphVersion.node_count, GraphVersion.edge_count,
+                        GraphVersion.byte_size, GraphVersion.author_id) \
+                 .filter(GraphVersion.graph_id == graph_id).order_by(GraphVersion.created_at.asc()).all()
+    return {"versions": [{"id": v.id, "created_at": v.created_at, "node_count": v.node_count, "edge_count": v.edge_count,
+                          "byte_size": v.byte_size, "author_id": v.author_id} for v in versions]}
+
+@app.post("/compact_versions/{graph_id}")
+def compact_versions(graph_id: str, keep: int = VERSION_RETENTION, db: Session = Depends(get_db)):
+    """Poda las versiones antiguas del grafo y recodifica su cadena de deltas."""
+    return compact_graph_versions(db, graph_id, keep=max(1, keep))
+
+NODE_COLUMNS = ("label", "description", "node_type", "color", "comments", "owner_id")
+
+def restore_graph_state(db: Session, graph_id: str, content: Dict, default_owner: str):
+    """Deja los nodos y ejes del grafo como en `content` con operaciones en bloque.
+
+    Los nodos se comparan por ID: se borran los que sobran (con sus ejes, por
+    cascada), se insertan los que faltan y se actualizan solo los que cambian.
+    Los ejes se concilian con reconcile_edges. No hace commit.
+    """
+    current = {row.id: {"id": row.id, **{c: getattr(row, c) for c in NODE_COLUMNS}}
+               for row in db.query(GraphNode.id, *(getattr(GraphNode, c) for c in NODE_COLUMNS))
+                             .filter(GraphNode.graph_id == graph_id)}
+    target = {}
+    for n in content.get("nodes", []):
+        target[n["id"]] = {
+            "id": n["id"], # Mantenemos el ID original para consistencia
+            "label": n.get("label"),
+            "description": n.get("description"),
+            "node_type": n.get("type"),
+            "color": n.get("color"),
+            "comments": n.get("comments") or [],
+            # Si owner_id falta (versiones viejas), el dueño es el del grafo
+            "owner_id": n.get("owner_id") or default_owner,
+        }
+
+    removed = [node_id for node_id in current if node_id not in target]
+    for start in range(0, len(removed), 500):  # Límite de parámetros de SQLite
+        db.query(GraphNode).filter(GraphNode.id.in_(removed[start:start + 500])).delete(synchronize_session=False)
+    added = [{**node, "graph_id": graph_id} for node_id, node in target.items() if node_id not in current]
+    if added:
+        db.execute(insert(GraphNode), added)
+    changed = [node for node_id, node in target.items()
+               if node_id in current and {**current[node_id], "comments": current[node_id]["comments"] or []} != node]
+    if changed:
+        db.execute(update(GraphNode), changed)
+
+    edges = [{"from": e["from"], "to": e["to"], "label": e.get("label")}
+             for e in content.get("edges", []) if e.get("from") in target and e.get("to") in target]
+    return reconcile_edges(db, graph_id, edges)
 
 @app.post("/restore_version/{version_id}")
-async def restore_version(version_id: str, db: Session = Depends(get_db)):
-    """Restaura el grafo a una versión específica."""
-    version = db.query(GraphVersion).filter(GraphVersion.id == version_id).first()
-    if not version:
-        raise HTTPException(status_code=404, detail="Versión no encontrada")
-    
-    graph_id = version.graph_id
-    content = version.content
-    
-    # 1. Borrar estado actual (nodos y ejes)
-    db.query(GraphEdge).filter(GraphEdge.graph_id == graph_id).delete()
-    db.query(GraphNode).filter(GraphNode.graph_id == graph_id).delete()
-    
-    # 2. Reconstruir nodos desde el JSON histórico
-    id_map = {} # Mapeo de IDs viejos a nuevos (o mantener los mismos si son UUID válidos)
-    
-    for n in content.get("nodes", []):
-        new_node = GraphNode(
-            id=n["id"], # Mantenemos el ID original para consistencia
-            label=n["label"],
-            description=n.get("description"),
-            node_type=n.get("type"),
-            color=n.get("color"),
-            comments=n.get("comments", []),
-            graph_id=graph_id,
-            owner_id=n.get("owner_id") # Asumiendo que el dueño es el mismo
-        )
-        # Si owner_id falta (versiones viejas), buscar owner del grafo
-        if not new_node.owner_id:
-             graph = db.query(KnowledgeGraph).filter(KnowledgeGraph.id == graph_id).first()
-             new_node.owner_id = graph.user_id
-             
-        db.add(new_node)
-    
-    # 3. Reconstruir ejes
-    for e in content.get("edges", []):
-        new_edge = GraphEdge(
-            id=str(uuid.uuid4()),
-            label=e.get("label"),
-            graph_id=graph_id,
-            source_node_id=e["from"],
-            target_node_id=e["to"]
-        )
-        db.add(new_edge)
+async def restore_version(version_id: str, user_id: Optional[str] = None, db: Session = Depends(get_db)):
+    """Restaura el grafo a una versión específica (`user_id`: quién restaura, para el historial)."""
+    def write():
+        version = db.query(GraphVersion).filter(GraphVersion.id == version_id).first()
+        if not version:
+            raise HTTPException(status_code=404, detail="Versión no encontrada")
         
-    db.commit()
-    
-    # 4. Guardar ESTA restauración como una NUEVA versión al final de la pila (estilo navegador)
-    save_graph_snapshot(db, graph_id)
-    
-    final_graph = assemble_graph_json(graph_id, db)
-    await broadcast_update(graph_id, final_graph)
-    return {"graph": final_graph}
\ No newline at end of file
+        graph_id = version.graph_id
+        content = version_content(db, version)
+        lock_graph(db, graph_id)
+        previous_state = assemble_graph_json(graph_id, db)
+        
+        # 1. Llevar nodos y ejes al estado de la versión escribiendo solo las diferencias
+        try:
+            restore_graph_state(db, graph_id, content, default_owner=version.graph.user_id)
+            db.flush()
+            final_graph = assemble_graph_json(graph_id, db)
+            patches = diff_graphs(previous_state, final_graph)
+            revision = bump_revision(db, graph_id, recount=True) if patches else current_revision(db, graph_id)
+            # 2. Guardar ESTA restauración como una NUEVA versión al final de la pila (estilo navegador)
+            save_graph_snapshot(db, graph_id, graph_json=final_graph, author_id=user_id)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Error restaurando versión: {e}")
+        return graph_id, patches, CachedGraph(revision, final_graph, version.graph.title)
+
+    # La restauración en bloque va a un hilo; en el bucle de eventos solo queda la difusión
+    graph_id, patches, entry = await asyncio.to_thread(write)
+    await publish_patches(graph_id, entry.revision, patches)
+    entry = graph_cache.put(graph_id, entry)
+    return graph_response(entry, revision=entry.revision)
\ No newline at end of file
@@ -0,0 +1,75 @@
+# bench_analytics.py
+# Compara la analítica con networkx (graph_analytics.GraphAnalytics) con la de
+# matrices dispersas (graph_sparse.SparseGraphAnalytics) en grafos crecientes.
+#
+#   python bench_analytics.py [tamaños...]     (por defecto: 1000 10000 50000)
+#
+# Mide construir el grafo desde las filas de graph_edges y calcular grados,
+# PageRank, componentes e intermediación (muestreada por encima de 500 nodos),
+# y comprueba que ambos caminos dan los mismos resultados.
+import random
+import sys
+import time
+import uuid
+
+from graph_analytics import GraphAnalytics
+from graph_sparse import SPARSE_AVAILABLE, SparseGraphAnalytics
+
+METRICS = ("in_degree_centrality", "out_degree_centrality", "pagerank", "components", "betweenness_centrality")
+
+
+def make_rows(size: int, seed: int = 7):
+    """Mapa de curso sintético: un árbol de prerrequisitos más algunos enlaces cruzados."""
+    rng = random.Random(seed)
+    node_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(size)]
+    edges = [(node_ids[rng.randrange(i)], node_ids[i]) for i in range(1, size)]
+    edges += [(rng.choice(node_ids), rng.choice(node_ids)) for _ in range(size // 2)]
+    return node_ids, edges
+
+
+def build_networkx(node_ids, edges):
+    graph = {"nodes": [{"id": node_id, "label": node_id} for node_id in node_ids],
+             "edges": [{"from": s, "to": t} for s, t in edges]}
+    return GraphAnalytics(0, graph)
+
+
+def build_sparse(node_ids, edges):
+    return SparseGraphAnalytics(0, node_ids, edges)
+
+
+def same(a, b, tol: float = 1e-6) -> bool:
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k], tol) for k in a)
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(a - b) <= tol
+    return a == b
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def run(size: int):
+    node_ids, edges = make_rows(size)
+    row = [f"{size:>6} nodos"]
+    results = {}
+    for name, build in (("networkx", build_networkx), ("disperso", build_sparse)):
+        build_time, analytics = timed(lambda: build(node_ids, edges))
+        metric_time, values = timed(lambda: {m: analytics.metric(m) for m in METRICS})
+        results[name] = (build_time + metric_time, values)
+        row.append(f"{name}: construir {build_time:7.3f}s métricas {metric_time:7.3f}s")
+    (slow, expected), (fast, got) = results["networkx"], results["disperso"]
+    for metric in METRICS:
+        assert same(expected[metric], got[metric]), f"{metric} difiere con {size} nodos"
+    row.append(f"x{slow / fast:5.1f}")
+    print(" | ".join(row))
+
+
+if __name__ == "__main__":
+    if not SPARSE_AVAILABLE:
+        sys.exit("El backend disperso necesita NumPy y SciPy (pip install numpy scipy).")
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    for size in sizes:
+        run(size)
@@ -0,0 +1,190 @@
+# collab.py
+# Difusión concurrente a los colaboradores de un grafo, con contrapresión.
+#
+# Antes, broadcast esperaba `send_text` de cada WebSocket en serie: un cliente
+# atascado retrasaba a todos y mantenía abierta la petición HTTP. Ahora cada
+# conexión tiene su propia cola acotada, vaciada por su propia tarea, y
+# publicar solo encola (no espera a ningún cliente).
+#
+# Si la cola de un cliente lento se llena se aplica una política:
+#   - "coalesce": los parches pendientes se fusionan en un único mensaje que
+#     cubre varias revisiones (y de los "update" completos solo queda el último).
+#     Si el mensaje fusionado crece demasiado, se pasa a "resync".
+#   - "resync": se descarta la cola y se envía {"type": "resync"} para que el
+#     cliente pida lo que le falta a /graph_changes.
+# Un envío que tarda más de `send_timeout` expulsa al cliente (cierre 1013).
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+
+class ClientConnection:
+    """Un WebSocket suscrito a un grafo, con su cola de salida y su tarea de envío."""
+
+    def __init__(self, hub: "CollaborationHub", graph_id: str, websocket: WebSocket):
+        self.hub = hub
+        self.graph_id = graph_id
+        self.websocket = websocket
+        self.queue: Deque[Tuple[Dict, str]] = deque()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()   # Cola vacía y sin envío en curso
+        self.idle.set()
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+
+    def enqueue(self, payload: Dict, message: str):
+        if self.closed:
+            return
+        if len(self.queue) >= self.hub.queue_size:
+            self.hub.metrics[self.graph_id]["overflows"] += 1
+            if self.hub.slow_policy == "coalesce" and self._coalesce(payload):
+                self.idle.clear()
+                self.ready.set()
+                return
+            self.queue.clear()
+            self.hub.metrics[self.graph_id]["resyncs"] += 1
+            payload = {"type": "resync", "graph_id": self.graph_id}
+            message = json.dumps(payload)
+        self.queue.append((payload, message))
+        self.idle.clear()
+        self.ready.set()
+
+    def _coalesce(self, payload: Dict) -> bool:
+        """Fusiona la cola + el mensaje nuevo. Devuelve False si no es posible."""
+        pending = [p for p, _ in self.queue] + [payload]
+        snapshots = [p for p in pending if p.get("type") == "update"]
+        patches = [p for p in pending if p.get("type") == "patch"]
+        if len(snapshots) + len(patches) != len(pending):
+            return False
+        merged: List[Tuple[Dict, str]] = []
+        if snapshots:
+            merged.append((snapshots[-1], json.dumps(snapshots[-1])))
+        if patches:
+            revisions = [p["revision"] for p in patches]
+            first = patches[0].get("base_revision", revisions[0])
+            if revisions != sorted(revisions):
+                return False
+            all_patches = [patch for p in patches for patch in p["patches"]]
+            if len(all_patches) > self.hub.max_coalesced_patches:
+                return False
+            combined = {"type": "patch", "graph_id": self.graph_id, "base_revision": first,
+                        "revision": revisions[-1], "patches": all_patches}
+            merged.append((combined, json.dumps(combined)))
+        self.queue.clear()
+        self.queue.extend(merged)
+        self.hub.metrics[self.graph_id]["coalesced"] += 1
+        return True
+
+    async def run(self):
+        metrics = self.hub.metrics[self.graph_id]
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and not self.closed:
+                    _, message = self.queue.popleft()
+                    start = time.perf_counter()
+                    try:
+                        await asyncio.wait_for(self.websocket.send_text(message), timeout=self.hub.send_timeout)
+                    except asyncio.TimeoutError:
+                        metrics["evictions"] += 1
+                        print(f"Expulsando cliente lento del grafo {self.graph_id}")
+                        await self.hub.disconnect(self, code=1013, reason="Slow consumer")
+                        return
+                    except Exception as e:
+                        print(f"Error sending broadcast: {e}")
+                        await self.hub.disconnect(self)
+                        return
+                    elapsed = time.perf_counter() - start
+                    metrics["sent"] += 1
+                    metrics["send_time_total"] += elapsed
+                    metrics["send_time_max"] = max(metrics["send_time_max"], elapsed)
+                self.idle.set()
+        except asyncio.CancelledError:
+            pass
+
+
+def _new_metrics() -> Dict:
+    return {"sent": 0, "send_time_total": 0.0, "send_time_max": 0.0,
+            "overflows": 0, "coalesced": 0, "resyncs": 0, "evictions": 0}
+
+
+class CollaborationHub:
+    """Conexiones por grafo y difusión no bloqueante de mensajes."""
+
+    def __init__(self, queue_size: int = 64, slow_policy: str = "coalesce",
+                 send_timeout: float = 5.0, max_coalesced_patches: int = 500):
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.send_timeout = send_timeout
+        self.max_coalesced_patches = max_coalesced_patches
+        self.connections: Dict[str, List[ClientConnection]] = defaultdict(list)
+        self.metrics: Dict[str, Dict] = defaultdict(_new_metrics)
+
+    def connect(self, graph_id: str, websocket: WebSocket) -> ClientConnection:
+        connection = ClientConnection(self, graph_id, websocket)
+        connection.task = asyncio.create_task(connection.run())
+        self.connections[graph_id].append(connection)
+        return connection
+
+    async def disconnect(self, connection: ClientConnection, code: Optional[int] = None, reason: str = ""):
+        if connection.closed:
+            return
+        connection.closed = True
+        connection.ready.set()
+        conns = self.connections.get(connection.graph_id, [])
+        if connection in conns:
+            conns.remove(connection)
+        if not conns:
+            self.connections.pop(connection.graph_id, None)
+        if code is not None:
+            try:
+                await connection.websocket.close(code=code, reason=reason)
+            except Exception:
+                pass
+        if connection.task and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    def count(self, graph_id: str) -> int:
+        return len(self.connections.get(graph_id, []))
+
+    def publish(self, graph_id: str, payload: Dict, exclude: Optional[WebSocket] = None):
+        """Encola el mensaje (serializado una sola vez) para cada colaborador."""
+        conns = self.connections.get(graph_id)
+        if not conns:
+            return
+        message = json.dumps(payload)
+        for connection in list(conns):
+            if connection.websocket is not exclude:
+                connection.enqueue(payload, message)
+
+    async def close_graph(self, graph_id: str, code: int = 1000, reason: str = ""):
+        """Cierra todas las conexiones del grafo tras enviar lo que tengan pendiente."""
+        for connection in list(self.connections.get(graph_id, [])):
+            try:
+                await asyncio.wait_for(connection.idle.wait(), timeout=self.send_timeout)
+            except asyncio.TimeoutError:
+                pass
+            await self.disconnect(connection, code=code, reason=reason)
+        self.metrics.pop(graph_id, None)
+
+    def stats(self, graph_id: Optional[str] = None) -> Dict:
+        graph_ids = [graph_id] if graph_id else sorted(set(self.connections) | set(self.metrics))
+        result = {}
+        for gid in graph_ids:
+            conns = self.connections.get(gid, [])
+            metrics = self.metrics.get(gid) or _new_metrics()
+            depths = [len(c.queue) for c in conns]
+            result[gid] = {
+                "connections": len(conns),
+                "queue_depth_total": sum(depths),
+                "queue_depth_max": max(depths, default=0),
+                "send_latency_avg": metrics["send_time_total"] / metrics["sent"] if metrics["sent"] else 0.0,
+                "send_latency_max": metrics["send_time_max"],
+                **{k: metrics[k] for k in ("sent", "overflows", "coalesced", "resyncs", "evictions")},
+            }
+        return result
@@ -0,0 +1,260 @@
+# graph_analytics.py
+# Analítica por grafo, en memoria y por revisión.
+#
+# Antes /analyze_graph reconstruía un networkx.DiGraph en cada llamada y
+# devolvía el grado de entrada/salida indexado por etiqueta (dos nodos con la
+# misma etiqueta se pisaban). Aquí cada grafo analizado conserva su DiGraph:
+#   - los parches de colaboración lo actualizan incrementalmente (si llegan
+#     en orden; con un hueco se descarta y se reconstruye al pedirlo);
+#   - cada métrica se calcula al pedirla y se memoriza hasta la siguiente
+#     revisión;
+#   - todos los resultados van indexados por ID de nodo.
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import networkx as nx
+
+# Por encima de este número de nodos la intermediación se aproxima con muestreo
+BETWEENNESS_EXACT_LIMIT = 500
+BETWEENNESS_SAMPLES = 200
+
+METRICS = ("in_degree_centrality", "out_degree_centrality", "pagerank", "betweenness_centrality",
+           "components", "communities")
+DEFAULT_METRICS = ("in_degree_centrality", "out_degree_centrality", "pagerank", "components")
+
+
+def pagerank(G: nx.DiGraph, alpha: float = 0.85, tol: float = 1.0e-6, max_iter: int = 100) -> Dict[str, float]:
+    """PageRank por iteración de potencias (nx.pagerank necesita SciPy)."""
+    n = G.number_of_nodes()
+    if n == 0:
+        return {}
+    rank = dict.fromkeys(G, 1.0 / n)
+    out_degree = dict(G.out_degree())
+    dangling = [node for node, degree in out_degree.items() if degree == 0]
+    for _ in range(max_iter):
+        previous = rank
+        dangling_sum = alpha * sum(previous[node] for node in dangling) / n
+        rank = dict.fromkeys(G, (1.0 - alpha) / n + dangling_sum)
+        for node in G:
+            if out_degree[node]:
+                share = alpha * previous[node] / out_degree[node]
+                for target in G.successors(node):
+                    rank[target] += share
+        if sum(abs(rank[node] - previous[node]) for node in G) < n * tol:
+            break
+    return rank
+
+
+class GraphAnalytics:
+    """DiGraph de un grafo en una revisión, con las métricas ya calculadas."""
+
+    incremental = True
+
+    def __init__(self, revision: int, graph: Dict):
+        self.revision = revision
+        self.lock = threading.Lock()
+        self.G = nx.DiGraph()
+        # Multiplicidad de cada (origen, destino): el DiGraph guarda una sola arista
+        self.edge_counts: Dict[Tuple[str, str], int] = {}
+        self.memo: Dict = {}
+        # Cálculos en curso sobre self.G (_replay modifica una copia mientras haya alguno)
+        self._computing = 0
+        # Parches recibidos por apply y aún no aplicados a self.G; self.revision
+        # ya es la del último
+        self._pending: List[List[Dict]] = []
+        self._pending_lock = threading.Lock()
+        for node in graph.get("nodes", []):
+            self.G.add_node(node["id"], label=node.get("label"))
+        for edge in graph.get("edges", []):
+            self._add_edge(edge)
+
+    def _add_edge(self, edge: Dict, G: Optional[nx.DiGraph] = None):
+        G = self.G if G is None else G
+        source, target = edge.get("from"), edge.get("to")
+        if source in G and target in G:
+            key = (source, target)
+            self.edge_counts[key] = self.edge_counts.get(key, 0) + 1
+            G.add_edge(source, target)
+
+    def _remove_edge(self, edge: Dict, G: Optional[nx.DiGraph] = None):
+        G = self.G if G is None else G
+        key = (edge.get("from"), edge.get("to"))
+        count = self.edge_counts.get(key, 0)
+        if count > 1:
+            self.edge_counts[key] = count - 1
+        elif count == 1:
+            del self.edge_counts[key]
+            G.remove_edge(*key)
+
+    def apply(self, revision: int, patches: List[Dict]):
+        """Anota los parches de colaboración que llevan a `revision`.
+
+        Se llama desde el bucle de eventos y no toca el DiGraph: solo encola los
+        parches bajo un lock propio, que nunca se retiene mientras se copia el
+        grafo. El siguiente cálculo (en un hilo) los aplica en _snapshot.
+        """
+        with self._pending_lock:
+            self._pending.append(patches)
+            self.revision = revision
+
+    def _replay(self, batches: List[List[Dict]]):
+        """Aplica parches encolados. Con cálculos en curso sobre self.G, sobre una copia."""
+        G = self.G.copy() if self._computing else self.G
+        for patches in batches:
+            for patch in patches:
+                op = patch.get("op")
+                if op in ("node_added", "node_updated"):
+                    node = patch["node"]
+                    G.add_node(node["id"], label=node.get("label"))
+                elif op == "node_removed":
+                    node_id = patch["id"]
+                    if node_id in G:
+                        for key in [k for k in self.edge_counts if node_id in k]:
+                            del self.edge_counts[key]
+                        G.remove_node(node_id)
+                elif op == "edge_added":
+                    self._add_edge(patch["edge"], G)
+                elif op == "edge_removed":
+                    self._remove_edge(patch["edge"], G)
+        self.G = G
+        self.memo.clear()
+
+    def _snapshot(self, key):
+        """(resultado memorizado o None, DiGraph y revisión sobre los que calcular)."""
+        with self.lock:
+            with self._pending_lock:
+                batches, self._pending = self._pending, []
+                revision = self.revision
+            if batches:
+                self._replay(batches)
+            if key in self.memo:
+                return True, self.memo[key], None, None
+            self._computing += 1
+            return False, None, self.G, revision
+
+    def _store(self, key, revision: int, value):
+        with self.lock:
+            self._computing -= 1
+            # Si entretanto llegó otra revisión, el resultado ya no vale para la memoria
+            if revision == self.revision:
+                self.memo[key] = value
+
+    def metric(self, name: str):
+        found, value, G, revision = self._snapshot(name)
+        if found:
+            return value
+        try:
+            value = self._compute(name, G)
+        except BaseException:
+            with self.lock:
+                self._computing -= 1
+            raise
+        self._store(name, revision, value)
+        return value
+
+    def _compute(self, name: str, G: nx.DiGraph):
+        if name == "in_degree_centrality":
+            return nx.in_degree_centrality(G) if len(G) > 1 else dict.fromkeys(G, 0.0)
+        if name == "out_degree_centrality":
+            return nx.out_degree_centrality(G) if len(G) > 1 else dict.fromkeys(G, 0.0)
+        if name == "pagerank":
+            return pagerank(G)
+        if name == "betweenness_centrality":
+            if len(G) > BETWEENNESS_EXACT_LIMIT:
+                # Aproximación por muestreo de fuentes (semilla fija: resultados estables)
+                return nx.betweenness_centrality(G, k=BETWEENNESS_SAMPLES, seed=42, normalized=True)
+            return nx.betweenness_centrality(G, normalized=True)
+        if name == "components":
+            components = sorted((sorted(c) for c in nx.weakly_connected_components(G)), key=len, reverse=True)
+            return {"count": len(components), "components": components}
+        if name == "communities":
+            if len(G) == 0:
+                return []
+            communities = nx.community.louvain_communities(G.to_undirected(), seed=42)
+            return sorted((sorted(c) for c in communities), key=len, reverse=True)
+        raise ValueError(f"Métrica desconocida: {name}")
+
+    def learning_path(self, target: str, source: Optional[str] = None) -> Optional[List[str]]:
+        """Camino más corto hasta `target`: desde `source` o desde el nodo raíz
+        (sin aristas de entrada) más cercano. None si no hay camino."""
+        key = ("learning_path", source, target)
+        found, path, G, revision = self._snapshot(key)
+        if found:
+            return path
+        try:
+            path = None
+            if target in G:
+                if source is not None:
+                    if source in G and nx.has_path(G, source, target):
+                        path = nx.shortest_path(G, source, target)
+                else:
+                    # BFS hacia atrás desde el objetivo hasta la primera raíz
+                    lengths = nx.single_source_shortest_path(G.reverse(copy=False), target)
+                    roots = [(len(p), n) for n, p in lengths.items() if G.in_degree(n) == 0]
+                    if roots:
+                        _, root = min(roots)
+                        path = list(reversed(lengths[root]))
+                    else:
+                        path = [target]
+        except BaseException:
+            with self.lock:
+                self._computing -= 1
+            raise
+        self._store(key, revision, path)
+        return path
+
+
+class AnalyticsCache:
+    """LRU por grafo de estructuras derivadas de una revisión: GraphAnalytics,
+    graph_sparse.SparseGraphAnalytics o relevance.NodeIndex."""
+
+    def __init__(self, max_graphs: int = 64):
+        self.max_graphs = max_graphs
+        self._entries: "OrderedDict[str, GraphAnalytics]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.incremental_updates = 0
+
+    def get(self, graph_id: str, revision: int, build: Callable[[], "GraphAnalytics"]) -> "GraphAnalytics":
+        """Analítica de la revisión `revision`; `build()` la construye si hay que reconstruirla."""
+        with self._lock:
+            entry = self._entries.get(graph_id)
+            if entry is not None and entry.revision == revision:
+                self._entries.move_to_end(graph_id)
+                return entry
+        entry = build()
+        with self._lock:
+            self.builds += 1
+            current = self._entries.get(graph_id)
+            if current is None or current.revision <= entry.revision:
+                self._entries[graph_id] = entry
+                self._entries.move_to_end(graph_id)
+                while len(self._entries) > self.max_graphs:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def apply_patches(self, graph_id: str, revision: int, patches: List[Dict], base_revision: Optional[int] = None):
+        """Actualiza el grafo en caché si el parche sigue a su revisión; si no, lo descarta.
+
+        Un mensaje fusionado (ver collab.py) cubre base_revision..revision: sigue
+        a la entrada si esta está en base_revision - 1.
+        """
+        with self._lock:
+            entry = self._entries.get(graph_id)
+            if entry is None:
+                return
+            follows = entry.revision == (base_revision if base_revision is not None else revision) - 1
+            if not follows or not entry.incremental:
+                if entry.revision < revision:
+                    del self._entries[graph_id]
+                return
+            self.incremental_updates += 1
+        entry.apply(revision, patches)
+
+    def forget(self, graph_id: str):
+        with self._lock:
+            self._entries.pop(graph_id, None)
+
+    def stats(self) -> Dict:
+        return {"graphs": len(self._entries), "builds": self.builds, "incremental_updates": self.incremental_updates}
@@ -0,0 +1,97 @@
+# graph_cache.py
+# Caché por grafo del JSON ensamblado y de su serialización.
+#
+# assemble_graph_json recorre graph_nodes y graph_edges en cada lectura y luego
+# el resultado se vuelve a serializar. Aquí se guarda, por grafo, la estructura
+# y sus bytes JSON junto con la revisión a la que corresponden. Las escrituras
+# suben la revisión y la entrada se invalida al difundirse el cambio, así que
+# leer un grafo que no ha cambiado no toca la DB ni vuelve a serializar.
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class CachedGraph:
+    """Grafo ensamblado (no modificar) y su JSON ya serializado."""
+
+    __slots__ = ("revision", "graph", "body", "title")
+
+    def __init__(self, revision: int, graph: Dict, title: Optional[str] = None):
+        self.revision = revision
+        self.graph = graph
+        self.title = title
+        self.body = json.dumps(graph, ensure_ascii=False).encode("utf-8")
+
+
+class GraphCache:
+    """LRU acotado por número de grafos y por bytes serializados."""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, max_floors: int = 4096):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_floors = max_floors
+        self._entries: "OrderedDict[str, CachedGraph]" = OrderedDict()
+        self._bytes = 0
+        # Revisión mínima aceptable por grafo (la última invalidación vista), para
+        # no guardar una lectura que empezó antes de una escritura ya difundida.
+        # LRU propio: una lectura en curso dura segundos, así que basta recordar
+        # las últimas `max_floors` invalidaciones y no todos los grafos tocados.
+        self._floor: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, graph_id: str) -> Optional[CachedGraph]:
+        with self._lock:
+            entry = self._entries.get(graph_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(graph_id)
+            self.hits += 1
+            return entry
+
+    def put(self, graph_id: str, entry: CachedGraph) -> CachedGraph:
+        with self._lock:
+            if entry.revision < self._floor.get(graph_id, 0):
+                return entry
+            current = self._entries.get(graph_id)
+            # Nunca reemplazar una revisión más nueva por una más vieja.
+            if current is not None and current.revision > entry.revision:
+                return current
+            if current is not None:
+                self._bytes -= len(current.body)
+            self._entries[graph_id] = entry
+            self._entries.move_to_end(graph_id)
+            self._bytes += len(entry.body)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+            return entry
+
+    def invalidate(self, graph_id: str, revision: Optional[int] = None):
+        """Descarta la entrada si es anterior a `revision` (o siempre, sin revisión)."""
+        with self._lock:
+            if revision is not None:
+                self._floor[graph_id] = max(self._floor.get(graph_id, 0), revision)
+                self._floor.move_to_end(graph_id)
+                while len(self._floor) > self.max_floors:
+                    self._floor.popitem(last=False)
+            else:
+                self._floor.pop(graph_id, None)
+            entry = self._entries.get(graph_id)
+            if entry is not None and (revision is None or entry.revision < revision):
+                del self._entries[graph_id]
+                self._bytes -= len(entry.body)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "floors": len(self._floor),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,94 @@
+# graph_context.py
+# Selección del subgrafo que se envía al LLM como contexto.
+#
+# /expand_node y /contextual_help enviaban el grafo entero aunque la pregunta
+# fuera sobre un nodo. select_context toma el vecindario a `hops` saltos de
+# los nodos semilla (ordenado por distancia y, a igual distancia, por
+# puntuación) y, con el presupuesto de tokens que sobre, los nodos mejor
+# puntuados del resto del grafo. La puntuación por defecto es el grado; quien
+# llama puede pasar otra (p. ej. relevancia respecto a la pregunta).
+#
+# El subgrafo devuelto trae solo los ejes entre nodos seleccionados: al
+# guardar la respuesta, los ejes se concilian únicamente dentro de ese ámbito
+# y el resto del grafo no se toca (ver reconcile_edges en app.py).
+import json
+import unicodedata
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set
+
+from prompt_graph import estimate_tokens
+
+
+def node_tokens(node: Dict) -> int:
+    """Tokens aproximados de un nodo en el prompt compacto (ver prompt_graph.py)."""
+    compact = {"id": "n000", "label": node.get("label"), "type": node.get("type"), "description": node.get("description")}
+    return estimate_tokens(json.dumps(compact, ensure_ascii=False, separators=(",", ":")))
+
+
+def edge_tokens(edge: Dict) -> int:
+    return estimate_tokens(json.dumps({"from": "n000", "to": "n000", "label": edge.get("label")},
+                                      ensure_ascii=False, separators=(",", ":")))
+
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin acentos, para comparar etiquetas con el texto del usuario."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def find_nodes(graph: Dict, text: str, min_length: int = 3) -> List[str]:
+    """Nodos mencionados en `text`: la etiqueta exacta si existe; si no, las etiquetas contenidas."""
+    folded = _fold(text)
+    exact = [n["id"] for n in graph.get("nodes", []) if _fold(n.get("label")) == folded]
+    if exact:
+        return exact
+    return [n["id"] for n in graph.get("nodes", [])
+            if len(_fold(n.get("label"))) >= min_length and _fold(n.get("label")) in folded]
+
+
+def select_context(graph: Dict, seeds: Iterable[str], hops: int = 2, token_budget: int = 3000,
+                   scores: Optional[Dict[str, float]] = None) -> Dict:
+    """Subgrafo {nodes, edges} para el prompt, dentro de `token_budget` (las semillas van siempre)."""
+    nodes = {n["id"]: n for n in graph.get("nodes", [])}
+    incident: Dict[str, List[Dict]] = defaultdict(list)
+    neighbours: Dict[str, Set[str]] = defaultdict(set)
+    for edge in graph.get("edges", []):
+        source, target = edge.get("from"), edge.get("to")
+        if source in nodes and target in nodes:
+            incident[source].append(edge)
+            incident[target].append(edge)
+            neighbours[source].add(target)
+            neighbours[target].add(source)
+    if scores is None:
+        scores = {node_id: len(incident[node_id]) for node_id in nodes}
+
+    # BFS sin dirección desde todas las semillas a la vez
+    seeds = [s for s in dict.fromkeys(seeds) if s in nodes]
+    distance = {s: 0 for s in seeds}
+    queue = deque(seeds)
+    while queue:
+        current = queue.popleft()
+        if distance[current] >= hops:
+            continue
+        for neighbour in neighbours[current]:
+            if neighbour not in distance:
+                distance[neighbour] = distance[current] + 1
+                queue.append(neighbour)
+
+    nearby = sorted(distance, key=lambda n: (distance[n], -scores.get(n, 0), n))
+    rest = sorted((n for n in nodes if n not in distance), key=lambda n: (-scores.get(n, 0), n))
+    selected: Set[str] = set()
+    used = 0
+    for node_id in nearby + rest:
+        cost = node_tokens(nodes[node_id]) + sum(
+            edge_tokens(e) for e in incident[node_id]
+            if (e["to"] if e["from"] == node_id else e["from"]) in selected
+        )
+        if used + cost > token_budget and distance.get(node_id) != 0:
+            continue
+        selected.add(node_id)
+        used += cost
+    return {
+        "nodes": [node for node_id, node in nodes.items() if node_id in selected],
+        "edges": [e for e in graph.get("edges", []) if e.get("from") in selected and e.get("to") in selected],
+    }
@@ -0,0 +1,102 @@
+# graph_mapreduce.py
+# Extracción map-reduce para documentos largos.
+#
+# Un PDF completo enviado como un solo mensaje choca con el límite de contexto
+# y produce una única completion enorme y lenta. En su lugar:
+#   - map: el texto se divide en fragmentos solapados y se extrae un subgrafo
+#     por fragmento (las llamadas al LLM las hace app.py, en paralelo acotado).
+#   - reduce: los subgrafos se fusionan de forma determinista por etiqueta
+#     normalizada, deduplicando nodos y reasignando los ejes.
+# El resultado tiene el mismo formato {"nodes", "edges"} con IDs temporales,
+# así que se guarda con la misma lógica de mapeo temp_id -> UUID.
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def split_text(text: str, chunk_size: int = 8000, overlap: int = 800) -> List[str]:
+    """Divide el texto en fragmentos de ~chunk_size caracteres con solapamiento.
+
+    Los cortes se hacen preferentemente en un salto de párrafo o fin de frase
+    para no partir conceptos por la mitad.
+    """
+    text = text.strip()
+    if len(text) <= chunk_size:
+        return [text] if text else []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            window = text[start + chunk_size // 2:end]
+            cut = max(window.rfind("\n\n"), window.rfind(". "), window.rfind("\n"))
+            if cut != -1:
+                end = start + chunk_size // 2 + cut + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if c]
+
+
+def normalize_label(label: str) -> str:
+    """Minúsculas, sin tildes ni signos de puntuación y con espacios colapsados."""
+    label = unicodedata.normalize("NFKD", label or "")
+    label = "".join(ch for ch in label if not unicodedata.combining(ch)).lower()
+    label = re.sub(r"[^\w\s]", " ", label)
+    return re.sub(r"\s+", " ", label).strip()
+
+
+def label_text(value: Any) -> Optional[str]:
+    """Etiqueta como texto: el LLM a veces devuelve números; otros tipos no valen."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+def merge_subgraphs(subgraphs: List[Dict]) -> Dict:
+    """Fusiona subgrafos (en orden de fragmento) en un único grafo.
+
+    Nodos con la misma etiqueta normalizada se unen en uno solo: se conserva
+    el primero que aparece y se le asigna la descripción más larga. Los ejes
+    se reasignan al nodo fusionado y se eliminan duplicados y bucles.
+    """
+    merged_nodes: Dict[str, Dict] = {}   # etiqueta normalizada -> nodo
+    merged_edges: List[Dict] = []
+    seen_edges = set()
+
+    for subgraph in subgraphs:
+        local_ids: Dict[str, str] = {}   # ID temporal del fragmento -> ID fusionado
+        for node in subgraph.get("nodes", []):
+            label = label_text(node.get("label")) if isinstance(node, dict) else None
+            key = normalize_label(label) if label is not None else ""
+            if not key:
+                continue
+            existing = merged_nodes.get(key)
+            if existing is None:
+                existing = dict(node, label=label)
+                existing["id"] = f"n{len(merged_nodes) + 1}"
+                existing["comments"] = []
+                merged_nodes[key] = existing
+            elif isinstance(node.get("description"), str) and \
+                    len(node["description"]) > len(label_text(existing.get("description")) or ""):
+                existing["description"] = node["description"]
+            local_ids[node.get("id")] = existing["id"]
+
+        for edge in subgraph.get("edges", []):
+            if not isinstance(edge, dict):
+                continue
+            source = local_ids.get(edge.get("from"))
+            target = local_ids.get(edge.get("to"))
+            if not source or not target or source == target:
+                continue
+            label = label_text(edge.get("label"))
+            signature: Tuple[str, str, str] = (source, target, normalize_label(label or ""))
+            if signature in seen_edges:
+                continue
+            seen_edges.add(signature)
+            merged_edges.append({"from": source, "to": target, "label": label})
+
+    return {"nodes": list(merged_nodes.values()), "edges": merged_edges}
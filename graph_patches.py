@@ -0,0 +1,116 @@
+# graph_patches.py
+# Parches compactos para la colaboración en tiempo real.
+#
+# Cada grafo lleva un número de revisión que crece con cada escritura. En vez
+# de reenviar el documento {nodes, edges} completo a cada cliente, se difunde
+# la lista de cambios de esa revisión:
+#   {"op": "node_added",       "node": {...}}
+#   {"op": "node_updated",     "node": {...}}
+#   {"op": "node_removed",     "id": "..."}            (implica borrar sus ejes)
+#   {"op": "edge_added",       "edge": {"id", "from", "to", "label"}}
+#   {"op": "edge_removed",     "edge": {"id", "from", "to", "label"}}
+#   {"op": "comment_appended", "node_id": "...", "comment": {...}}
+#   {"op": "title_changed",    "title": "..."}
+# Puede haber varios ejes con el mismo (from, to, label): los clientes los
+# distinguen por "id". Los grafos guardados antes de que los ejes llevaran ID
+# se comparan por (from, to, label), como un multiconjunto.
+# Un cliente que se queda atrás pide los parches desde su revisión; si ya no
+# están en el registro, recibe una instantánea completa.
+import threading
+from collections import OrderedDict, defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+def edge_signature(edge: Dict) -> Tuple:
+    return (edge.get("from"), edge.get("to"), edge.get("label"))
+
+
+def edge_key(edge: Dict) -> Tuple:
+    """Identidad de un eje al comparar grafos: su ID, o su firma si no lo tiene."""
+    return ("id", edge["id"]) if edge.get("id") else edge_signature(edge)
+
+
+def diff_graphs(old: Dict, new: Dict) -> List[Dict]:
+    """Calcula los parches que transforman el grafo `old` en `new`."""
+    patches: List[Dict] = []
+    old_nodes = {n["id"]: n for n in old.get("nodes", [])}
+    new_nodes = {n["id"]: n for n in new.get("nodes", [])}
+
+    for node_id in old_nodes.keys() - new_nodes.keys():
+        patches.append({"op": "node_removed", "id": node_id})
+    for node_id, node in new_nodes.items():
+        before = old_nodes.get(node_id)
+        if before is None:
+            patches.append({"op": "node_added", "node": node})
+        elif before != node:
+            old_comments = before.get("comments") or []
+            new_comments = node.get("comments") or []
+            only_comments = {k: v for k, v in before.items() if k != "comments"} == \
+                            {k: v for k, v in node.items() if k != "comments"}
+            if only_comments and new_comments[:len(old_comments)] == old_comments:
+                for comment in new_comments[len(old_comments):]:
+                    patches.append({"op": "comment_appended", "node_id": node_id, "comment": comment})
+            else:
+                patches.append({"op": "node_updated", "node": node})
+
+    # Ejes por identidad (ver edge_key); sin ID, multiconjunto por firma
+    old_edges: Dict[Tuple, List[Dict]] = defaultdict(list)
+    for edge in old.get("edges", []):
+        old_edges[edge_key(edge)].append(edge)
+    for edge in new.get("edges", []):
+        matches = old_edges.get(edge_key(edge))
+        if matches:
+            matches.pop()
+        else:
+            patches.append({"op": "edge_added", "edge": edge})
+    removed_nodes = old_nodes.keys() - new_nodes.keys()
+    for edges in old_edges.values():
+        for edge in edges:
+            # Los ejes de un nodo borrado ya los elimina "node_removed".
+            if edge.get("from") in removed_nodes or edge.get("to") in removed_nodes:
+                continue
+            patches.append({"op": "edge_removed", "edge": edge})
+    return patches
+
+
+class PatchLog:
+    """Registro acotado en memoria de los parches recientes de cada grafo.
+
+    Guarda hasta `max_revisions` revisiones por grafo y como mucho `max_graphs`
+    grafos (LRU). Un grafo descartado no cubre ninguna revisión, así que quien
+    lo pida recibe la instantánea completa.
+    """
+
+    def __init__(self, max_revisions: int = 200, max_graphs: int = 1024):
+        self.max_revisions = max_revisions
+        self.max_graphs = max_graphs
+        self._log: "OrderedDict[str, Deque[Tuple[int, List[Dict]]]]" = OrderedDict()
+        # Se escribe desde el bucle de eventos y se lee desde el pool de hilos
+        self._lock = threading.Lock()
+
+    def append(self, graph_id: str, revision: int, patches: List[Dict]):
+        with self._lock:
+            log = self._log.get(graph_id)
+            if log is None:
+                log = self._log[graph_id] = deque(maxlen=self.max_revisions)
+            self._log.move_to_end(graph_id)
+            log.append((revision, patches))
+            while len(self._log) > self.max_graphs:
+                self._log.popitem(last=False)
+
+    def since(self, graph_id: str, revision: int, current: int) -> Optional[List[Dict]]:
+        """Cambios posteriores a `revision`, o None si el registro no los cubre."""
+        if revision >= current:
+            return []
+        with self._lock:
+            if graph_id in self._log:
+                self._log.move_to_end(graph_id)
+            entries = [(r, p) for r, p in self._log.get(graph_id, ()) if r > revision]
+        # Deben estar todas las revisiones revision+1..current, sin huecos.
+        if [r for r, _ in entries] != list(range(revision + 1, current + 1)):
+            return None
+        return [{"revision": r, "patches": p} for r, p in entries]
+
+    def forget(self, graph_id: str):
+        with self._lock:
+            self._log.pop(graph_id, None)
@@ -0,0 +1,224 @@
+# graph_sparse.py
+# Analítica con matrices dispersas (CSR) para grafos grandes.
+#
+# Con mapas de curso de decenas de miles de conceptos, construir un
+# networkx.DiGraph nodo a nodo cuesta más (en tiempo y memoria) que las propias
+# métricas. SparseGraphAnalytics lee solo los IDs de graph_nodes y los pares
+# (origen, destino) de graph_edges, arma una matriz de adyacencia CSR y calcula
+# las métricas con álgebra dispersa vectorizada. Expone la misma interfaz que
+# graph_analytics.GraphAnalytics (metric, learning_path) y devuelve los mismos
+# resultados, indexados por ID de nodo.
+#
+# NumPy y SciPy están en requirements.txt, pero la importación sigue siendo
+# opcional: sin ellos SPARSE_AVAILABLE es False, "auto" usa siempre networkx y
+# ANALYTICS_BACKEND=sparse falla al arrancar.
+#
+#   python bench_analytics.py [tamaños...]   compara ambos caminos
+import random
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+try:
+    import numpy as np
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    SPARSE_AVAILABLE = True
+except ImportError:  # pragma: no cover - dependencia opcional
+    np = sparse = csgraph = None
+    SPARSE_AVAILABLE = False
+
+from graph_analytics import BETWEENNESS_EXACT_LIMIT, BETWEENNESS_SAMPLES
+from storage import read_snapshot
+
+# Fuentes procesadas a la vez en la intermediación (columnas de las matrices densas)
+BETWEENNESS_BATCH = 64
+
+
+class SparseGraphAnalytics:
+    """Matriz de adyacencia CSR de un grafo en una revisión, con las métricas ya calculadas."""
+
+    # Los parches no se aplican sobre la CSR: la caché descarta la entrada y se reconstruye
+    incremental = False
+
+    def __init__(self, revision: int, node_ids: Sequence[str], edges: Sequence[Tuple[str, str]]):
+        self.revision = revision
+        self.lock = threading.Lock()
+        self.memo: Dict = {}
+        self.node_ids: List[str] = list(node_ids)
+        self.index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        n = len(self.node_ids)
+        pairs = [(self.index[s], self.index[t]) for s, t in edges if s in self.index and t in self.index]
+        rows = np.fromiter((s for s, _ in pairs), dtype=np.int32, count=len(pairs))
+        cols = np.fromiter((t for _, t in pairs), dtype=np.int32, count=len(pairs))
+        # Los ejes repetidos cuentan una vez, como en el DiGraph
+        A = sparse.csr_matrix((np.ones(len(pairs), dtype=np.float64), (rows, cols)), shape=(n, n))
+        A.sum_duplicates()
+        A.data[:] = 1.0
+        self.A = A
+        self.AT = A.T.tocsr()
+        self.out_degree = np.diff(A.indptr)
+        self.in_degree = np.diff(self.AT.indptr)
+
+    def _by_id(self, values) -> Dict[str, float]:
+        return dict(zip(self.node_ids, values.tolist()))
+
+    def metric(self, name: str):
+        with self.lock:
+            if name in self.memo:
+                return self.memo[name]
+        # La matriz no cambia tras construirse: se calcula fuera del cerrojo (otras
+        # métricas no esperan) y, si dos peticiones coinciden, se queda la primera.
+        value = self._compute(name)
+        with self.lock:
+            return self.memo.setdefault(name, value)
+
+    def _compute(self, name: str):
+        n = len(self.node_ids)
+        if name in ("in_degree_centrality", "out_degree_centrality"):
+            degree = self.in_degree if name == "in_degree_centrality" else self.out_degree
+            return self._by_id(degree / (n - 1) if n > 1 else np.zeros(n))
+        if name == "pagerank":
+            return self._by_id(self.pagerank())
+        if name == "betweenness_centrality":
+            return self._by_id(self.betweenness())
+        if name == "components":
+            count, labels = csgraph.connected_components(self.A, directed=True, connection="weak")
+            groups: Dict[int, List[str]] = {}
+            for node_id, label in zip(self.node_ids, labels.tolist()):
+                groups.setdefault(label, []).append(node_id)
+            components = sorted((sorted(c) for c in groups.values()), key=len, reverse=True)
+            return {"count": count, "components": components}
+        if name == "communities":
+            # Louvain no tiene versión dispersa: se delega en networkx con los ejes en bloque
+            import networkx as nx
+            if n == 0:
+                return []
+            G = nx.Graph()
+            G.add_nodes_from(self.node_ids)
+            coo = self.A.tocoo()
+            G.add_edges_from(zip((self.node_ids[i] for i in coo.row.tolist()),
+                                 (self.node_ids[j] for j in coo.col.tolist())))
+            communities = nx.community.louvain_communities(G, seed=42)
+            return sorted((sorted(c) for c in communities), key=len, reverse=True)
+        raise ValueError(f"Métrica desconocida: {name}")
+
+    def pagerank(self, alpha: float = 0.85, tol: float = 1.0e-6, max_iter: int = 100):
+        """PageRank por iteración de potencias: un producto matriz-vector por paso."""
+        n = len(self.node_ids)
+        if n == 0:
+            return np.zeros(0)
+        inv_out = np.divide(1.0, self.out_degree, out=np.zeros(n), where=self.out_degree > 0)
+        dangling = self.out_degree == 0
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iter):
+            previous = rank
+            rank = alpha * (self.AT @ (previous * inv_out))
+            rank += (1.0 - alpha) / n + alpha * previous[dangling].sum() / n
+            if np.abs(rank - previous).sum() < n * tol:
+                break
+        return rank
+
+    def betweenness(self):
+        """Intermediación normalizada (Brandes) con BFS por niveles sobre varias fuentes a la vez.
+
+        Por encima de BETWEENNESS_EXACT_LIMIT nodos se muestrean BETWEENNESS_SAMPLES
+        fuentes con la misma semilla que networkx, así que se eligen las mismas.
+        """
+        n = len(self.node_ids)
+        if n > BETWEENNESS_EXACT_LIMIT:
+            sources = [self.index[s] for s in random.Random(42).sample(self.node_ids, BETWEENNESS_SAMPLES)]
+            k: Optional[int] = BETWEENNESS_SAMPLES
+        else:
+            sources, k = list(range(n)), None
+        total = np.zeros(n)
+        for start in range(0, len(sources), BETWEENNESS_BATCH):
+            batch = np.array(sources[start:start + BETWEENNESS_BATCH])
+            cols = np.arange(len(batch))
+            # Avance: número de caminos mínimos (sigma) por nivel; se guardan las
+            # posiciones (nodo, fuente) alcanzadas en cada nivel para el retroceso
+            sigma = np.zeros((n, len(batch)))
+            sigma[batch, cols] = 1.0
+            levels = [(batch, cols)]
+            frontier = sigma.copy()
+            while True:
+                reached = self.AT @ frontier
+                new = np.nonzero((reached > 0) & (sigma == 0))
+                if len(new[0]) == 0:
+                    break
+                sigma[new] = reached[new]
+                frontier = np.zeros_like(sigma)
+                frontier[new] = reached[new]
+                levels.append(new)
+            # Retroceso: dependencia acumulada de cada nodo, del nivel más lejano al primero
+            delta = np.zeros_like(sigma)
+            weight = np.zeros_like(sigma)
+            for d in range(len(levels) - 1, 0, -1):
+                at_next, at_level = levels[d], levels[d - 1]
+                weight[at_next] = (1.0 + delta[at_next]) / sigma[at_next]
+                delta[at_level] += sigma[at_level] * (self.A @ weight)[at_level]
+                weight[at_next] = 0.0
+            delta[batch, cols] = 0.0
+            total += delta.sum(axis=1)
+        if n > 2:
+            total *= 1.0 / ((n - 1) * (n - 2)) * (n / k if k else 1.0)
+        return total
+
+    def learning_path(self, target: str, source: Optional[str] = None) -> Optional[List[str]]:
+        """Camino más corto hasta `target`: desde `source` o desde el nodo raíz
+        (sin aristas de entrada) más cercano. None si no hay camino."""
+        key = ("learning_path", source, target)
+        with self.lock:
+            if key in self.memo:
+                return self.memo[key]
+        path = None
+        if target in self.index:
+            t = self.index[target]
+            if source is not None:
+                if source in self.index:
+                    path = self._bfs_path(self.A, self.index[source], t)
+                    path = path[::-1] if path else None
+            else:
+                # BFS hacia atrás desde el objetivo; la primera raíz por distancia (y por ID)
+                order, predecessors = csgraph.breadth_first_order(self.AT, t, directed=True)
+                distance = np.zeros(len(self.node_ids), dtype=np.int32)
+                for v in order[1:].tolist():
+                    distance[v] = distance[predecessors[v]] + 1
+                roots = [(int(distance[v]), self.node_ids[v]) for v in order.tolist() if self.in_degree[v] == 0]
+                if roots:
+                    _, root = min(roots)
+                    path = self._walk(predecessors, self.index[root])
+                else:
+                    path = [target]
+        with self.lock:
+            return self.memo.setdefault(key, path)
+
+    def _bfs_path(self, M, start: int, end: int) -> Optional[List[str]]:
+        """Camino de `end` hacia `start` en el BFS de M (None si no se alcanza)."""
+        order, predecessors = csgraph.breadth_first_order(M, start, directed=True)
+        if end != start and predecessors[end] < 0:
+            return None
+        return self._walk(predecessors, end)
+
+    def _walk(self, predecessors, node: int) -> List[str]:
+        path = [self.node_ids[node]]
+        while predecessors[node] >= 0:
+            node = predecessors[node]
+            path.append(self.node_ids[node])
+        return path
+
+
+def load_sparse_analytics(db: Session, graph_id: str) -> Optional[SparseGraphAnalytics]:
+    """Construye la analítica dispersa leyendo solo IDs, en una misma transacción."""
+    # Revisión y filas de la misma instantánea: si no, una escritura entre medias
+    # dejaría filas de R+1 etiquetadas como R
+    with read_snapshot(db):
+        revision = db.execute(text("SELECT revision FROM knowledge_graphs WHERE id = :g"), {"g": graph_id}).scalar()
+        if revision is None:
+            return None
+        node_ids = db.execute(text("SELECT id FROM graph_nodes WHERE graph_id = :g"), {"g": graph_id}).scalars().all()
+        edges = db.execute(text("SELECT source_node_id, target_node_id FROM graph_edges WHERE graph_id = :g"),
+                           {"g": graph_id}).all()
+    return SparseGraphAnalytics(revision, node_ids, edges)
@@ -0,0 +1,89 @@
+# graph_stream.py
+# Parser JSON incremental para la respuesta del LLM en modo streaming.
+#
+# El LLM responde {"nodes": [...], "edges": [...]}. En lugar de esperar a la
+# completion entera, se recorren los tokens a medida que llegan y se emite
+# cada objeto de "nodes" o "edges" en cuanto su llave de cierre aparece.
+import json
+from typing import Dict, List, Optional, Tuple
+
+# Claves de primer nivel cuyos elementos se emiten, y el tipo de evento.
+STREAM_KEYS = {"nodes": "node", "edges": "edge"}
+
+
+class GraphStreamParser:
+    """Recibe fragmentos de texto con `feed()` y devuelve ("node"|"edge", dict)."""
+
+    def __init__(self):
+        self.buffer: List[str] = []   # Texto completo recibido (para el fallback final)
+        self.depth = 0                # Profundidad de llaves/corchetes
+        self.started = False          # Ya vimos la llave inicial del objeto raíz
+        self.in_string = False
+        self.escape = False
+        self.string_chars: List[str] = []
+        self.last_key: Optional[str] = None   # Última cadena vista en el nivel 1
+        self.array_kind: Optional[str] = None # "node"/"edge" si estamos dentro de ese array
+        self.item_chars: Optional[List[str]] = None  # Objeto en construcción
+        self.emitted = 0
+
+    def feed(self, chunk: str) -> List[Tuple[str, Dict]]:
+        self.buffer.append(chunk)
+        events = []
+        for ch in chunk:
+            event = self._consume(ch)
+            if event:
+                events.append(event)
+        return events
+
+    @property
+    def text(self) -> str:
+        return "".join(self.buffer)
+
+    def _consume(self, ch: str) -> Optional[Tuple[str, Dict]]:
+        if not self.started:
+            # Ignorar texto previo (p. ej. "```json") hasta el objeto raíz.
+            if ch == "{":
+                self.started = True
+                self.depth = 1
+            return None
+
+        if self.item_chars is not None:
+            self.item_chars.append(ch)
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+                if self.depth == 1:
+                    self.last_key = "".join(self.string_chars)
+            elif self.depth == 1:
+                self.string_chars.append(ch)
+            return None
+
+        if ch == '"':
+            self.in_string = True
+            self.string_chars = []
+        elif ch in "{[":
+            self.depth += 1
+            if ch == "[" and self.depth == 2:
+                self.array_kind = STREAM_KEYS.get(self.last_key)
+            elif ch == "{" and self.depth == 3 and self.array_kind:
+                self.item_chars = ["{"]
+        elif ch in "}]":
+            self.depth -= 1
+            if ch == "}" and self.depth == 2 and self.item_chars is not None:
+                raw = "".join(self.item_chars)
+                self.item_chars = None
+                try:
+                    item = json.loads(raw)
+                except ValueError:
+                    return None
+                if isinstance(item, dict):
+                    self.emitted += 1
+                    return self.array_kind, item
+            elif ch == "]" and self.depth == 1:
+                self.array_kind = None
+        return None
@@ -0,0 +1,93 @@
+# graph_versions.py
+# Almacenamiento compacto del historial de versiones de un grafo.
+#
+# Antes cada versión guardaba el JSON {nodes, edges} completo. Ahora las
+# versiones de un grafo forman una cadena ordenada por `seq`:
+#   - "keyframe": el grafo completo;
+#   - "delta": solo los cambios respecto a la versión anterior.
+# Cada KEYFRAME_INTERVAL versiones se guarda un keyframe, así que reconstruir
+# cualquier versión cuesta como mucho un keyframe + (KEYFRAME_INTERVAL - 1)
+# deltas. Las cargas útiles se guardan como JSON comprimido con zlib.
+import json
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from graph_patches import edge_key
+
+KEYFRAME_INTERVAL = 20
+
+
+def encode_payload(data: Dict) -> bytes:
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def decode_payload(payload: bytes) -> Dict:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def graph_delta(old: Dict, new: Dict) -> Dict:
+    """Cambios que llevan de `old` a `new` (los ejes se comparan como multiconjunto)."""
+    old_nodes = {n["id"]: n for n in old.get("nodes", [])}
+    new_nodes = {n["id"]: n for n in new.get("nodes", [])}
+    delta: Dict = {
+        "nodes_removed": [node_id for node_id in old_nodes if node_id not in new_nodes],
+        "nodes_upserted": [node for node_id, node in new_nodes.items() if old_nodes.get(node_id) != node],
+        "edges_removed": [],
+        "edges_added": [],
+    }
+    remaining: Dict[Tuple, List[Dict]] = defaultdict(list)
+    for edge in old.get("edges", []):
+        remaining[edge_key(edge)].append(edge)
+    for edge in new.get("edges", []):
+        matches = remaining.get(edge_key(edge))
+        if matches:
+            matches.pop()
+        else:
+            delta["edges_added"].append(edge)
+    for edges in remaining.values():
+        delta["edges_removed"].extend(edges)
+    return delta
+
+
+def apply_delta(graph: Dict, delta: Dict) -> Dict:
+    """Aplica un delta de graph_delta y devuelve un grafo nuevo."""
+    removed = set(delta.get("nodes_removed", []))
+    nodes = {n["id"]: n for n in graph.get("nodes", []) if n["id"] not in removed}
+    for node in delta.get("nodes_upserted", []):
+        nodes[node["id"]] = node
+    edges = list(graph.get("edges", []))
+    for edge in delta.get("edges_removed", []):
+        key = edge_key(edge)
+        for i, current in enumerate(edges):
+            if edge_key(current) == key:
+                del edges[i]
+                break
+    edges.extend(delta.get("edges_added", []))
+    return {"nodes": list(nodes.values()), "edges": edges}
+
+
+def encode_version(previous: Optional[Dict], graph: Dict, seq: int) -> Tuple[str, bytes]:
+    """(kind, payload) de la versión número `seq` dado el grafo de la versión anterior."""
+    if previous is None or seq % KEYFRAME_INTERVAL == 0:
+        return "keyframe", encode_payload(graph)
+    return "delta", encode_payload(graph_delta(previous, graph))
+
+
+def reconstruct(chain: Iterable[Tuple[str, bytes]]) -> Dict:
+    """Grafo de la última versión de `chain` (de un keyframe en adelante, en orden)."""
+    graph: Dict = {"nodes": [], "edges": []}
+    for kind, payload in chain:
+        data = decode_payload(payload)
+        graph = data if kind == "keyframe" else apply_delta(graph, data)
+    return graph
+
+
+def reencode(graphs: List[Dict]) -> List[Tuple[str, bytes]]:
+    """Codifica de nuevo una secuencia de grafos completos como cadena keyframe + deltas."""
+    encoded = []
+    previous = None
+    for seq, graph in enumerate(graphs):
+        encoded.append(encode_version(previous, graph, seq))
+        previous = graph
+    return encoded
@@ -0,0 +1,322 @@
+# ingest.py
+# Cola de trabajos en segundo plano para extraer el texto de los archivos subidos.
+#
+# /upload hacía PyPDF2, Tesseract o el reconocimiento de voz dentro de la
+# petición: una imagen escaneada o una grabación larga bloqueaban un hilo
+# durante mucho tiempo y las subidas en paralelo se encolaban sin control.
+# Ahora /upload guarda el archivo en disco, crea un trabajo y responde con su
+# ID al momento. La extracción corre en un pool de procesos con concurrencia
+# acotada; el cliente sigue el estado y el progreso por sondeo
+# (/upload_jobs/{id}) o por WebSocket, y puede cancelar. Los trabajos
+# terminados se olvidan pasado `ttl` segundos.
+#
+# Los PDF se procesan por lotes de páginas repartidos entre los procesos del
+# pool (cada proceso abre el archivo con mmap y solo lee sus páginas). El
+# texto se acumula en orden de página a medida que llegan los lotes y se puede
+# leer en streaming (/upload_jobs/{id}/text) antes de que termine el documento.
+# Como mucho hay `2 * workers` lotes en vuelo, así que la memoria no depende
+# del número de páginas más allá del propio texto extraído.
+#
+# Con una ExtractedTextCache (text_cache.py), un archivo ya procesado con el
+# mismo extractor se responde al subirlo, sin pasar por el pool.
+import asyncio
+import hashlib
+import mmap
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import PyPDF2
+import pytesseract
+import speech_recognition as sr
+from PIL import Image
+
+from text_cache import ExtractedTextCache, extraction_key
+
+# Extensión -> tipo de extractor
+FILE_KINDS = {
+    ".pdf": "pdf",
+    ".txt": "text",
+    ".wav": "audio", ".mp3": "audio",
+    ".png": "image", ".jpg": "image", ".jpeg": "image",
+}
+
+# Idiomas de Tesseract y del reconocimiento de voz
+OCR_LANG = "spa"
+SPEECH_LANG = "es-ES"
+
+# Extractor y configuración por tipo (forma parte de la clave de caché)
+EXTRACTORS = {
+    "pdf": f"pypdf2-{PyPDF2.__version__}",
+    "text": "utf-8",
+    "audio": f"google-speech:{SPEECH_LANG}",
+    "image": f"tesseract:{OCR_LANG}",
+}
+
+# Estados de un trabajo; los tres últimos son finales
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class IngestBusyError(Exception):
+    """Hay demasiados trabajos pendientes."""
+
+
+def file_kind(filename: str) -> Optional[str]:
+    return FILE_KINDS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def pdf_page_count(path: str) -> int:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return len(PyPDF2.PdfReader(data).pages)
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Texto de las páginas [start, stop) de un PDF (se ejecuta en un proceso del pool)."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pages = PyPDF2.PdfReader(data).pages
+        return [(pages[i].extract_text() or "") + "\n" for i in range(start, stop)]
+
+
+def extract_text(kind: str, path: str) -> str:
+    """Extrae el texto de un archivo que no es PDF (se ejecuta en un proceso del pool)."""
+    if kind == "text":
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    if kind == "audio":
+        recognizer = sr.Recognizer()
+        with sr.AudioFile(path) as source:
+            audio = recognizer.record(source)
+        return recognizer.recognize_google(audio, language=SPEECH_LANG)
+    if kind == "image":
+        with Image.open(path) as image:
+            return pytesseract.image_to_string(image, lang=OCR_LANG)
+    raise ValueError(f"Tipo de archivo no soportado: {kind}")
+
+
+class IngestJob:
+    __slots__ = ("id", "filename", "kind", "path", "cache_key", "cached", "status", "progress", "stage",
+                 "chunks", "error", "created_at", "finished_at", "task", "watchers")
+
+    def __init__(self, filename: str, kind: str, path: str, cache_key: Optional[str] = None):
+        self.id = str(uuid.uuid4())
+        self.filename = filename
+        self.kind = kind
+        self.path = path
+        self.cache_key = cache_key
+        self.cached = False
+        self.status = QUEUED
+        self.progress = 0.0
+        self.stage = "en cola"
+        # Texto extraído en orden (una entrada por página en los PDF)
+        self.chunks: List[str] = []
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.watchers: List[asyncio.Queue] = []
+
+    def snapshot(self) -> Dict:
+        """Estado del trabajo con la forma de la antigua respuesta de /upload."""
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "stage": self.stage,
+            "cached": self.cached,
+            "extracted_text": "".join(self.chunks) if self.status == DONE else None,
+            "notification": self.error,
+        }
+
+
+class IngestQueue:
+    """Trabajos de extracción en curso y recientes, ejecutados en un pool de procesos."""
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, ttl: float = 600.0,
+                 spool_dir: Optional[str] = None, pdf_pages_per_task: int = 8,
+                 cache: Optional[ExtractedTextCache] = None):
+        self.workers = workers
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.cache = cache
+        self.jobs: Dict[str, IngestJob] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # "spawn": un fork del servidor (multihilo) heredaría locks tomados por
+            # otros hilos y las conexiones abiertas de SQLAlchemy y SQLite
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def pending(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status in (QUEUED, RUNNING))
+
+    async def submit(self, filename: str, fileobj: BinaryIO) -> IngestJob:
+        """Guarda el archivo en disco y encola su extracción. ValueError si el tipo no se soporta."""
+        self.sweep()
+        kind = file_kind(filename)
+        if kind is None:
+            raise ValueError("Tipo de archivo no soportado")
+        if self.pending() >= self.max_pending:
+            raise IngestBusyError("Demasiados archivos en proceso; inténtalo en unos segundos")
+        path, digest = await asyncio.to_thread(self._spool, fileobj, os.path.splitext(filename)[1].lower())
+        job = IngestJob(filename, kind, path, extraction_key(digest, EXTRACTORS[kind]))
+        self.jobs[job.id] = job
+        if self.cache is not None:
+            text = await asyncio.to_thread(self.cache.get, job.cache_key)
+            if text is not None:
+                job.cached = True
+                job.chunks.append(text)
+                self._finish(job, DONE)
+                await asyncio.to_thread(self._discard_file, path)
+                return job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def _spool(self, fileobj: BinaryIO, suffix: str) -> Tuple[str, str]:
+        """Vuelca el archivo a disco calculando su SHA-256 en la misma pasada."""
+        digest = hashlib.sha256()
+        fd, path = tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=self.spool_dir)
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                block = fileobj.read(1024 * 1024)
+                if not block:
+                    break
+                digest.update(block)
+                out.write(block)
+        return path, digest.hexdigest()
+
+    async def _run(self, job: IngestJob):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        try:
+            async with self._slots:
+                if job.status != QUEUED:
+                    return
+                self._update(job, status=RUNNING, progress=0.1, stage="extrayendo texto")
+                try:
+                    if job.kind == "pdf":
+                        await self._extract_pdf(job)
+                    else:
+                        text = await asyncio.get_running_loop().run_in_executor(
+                            self._pool(), extract_text, job.kind, job.path)
+                        job.chunks.append(text)
+                except Exception as e:
+                    if job.status == RUNNING:
+                        self.failed += 1
+                        self._finish(job, FAILED, error=f"Error procesando archivo: {str(e)}")
+                    return
+                # Un trabajo cancelado mientras corría termina igual, pero su resultado se descarta
+                if job.status == RUNNING:
+                    self.completed += 1
+                    self._finish(job, DONE)
+                    if self.cache is not None:
+                        await asyncio.to_thread(self.cache.put, job.cache_key, "".join(job.chunks),
+                                                EXTRACTORS[job.kind])
+        except asyncio.CancelledError:
+            pass  # Cancelado mientras esperaba turno
+        finally:
+            await asyncio.to_thread(self._discard_file, job.path)
+
+    async def _extract_pdf(self, job: IngestJob):
+        """Reparte las páginas en lotes entre el pool y las añade en orden."""
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        total = await loop.run_in_executor(pool, pdf_page_count, job.path)
+        step = self.pdf_pages_per_task
+        batches = [(start, min(start + step, total)) for start in range(0, total, step)]
+        window = 2 * self.workers
+        in_flight: Dict[int, asyncio.Future] = {}
+        submitted = 0
+        try:
+            for index, (_, stop) in enumerate(batches):
+                while submitted < len(batches) and len(in_flight) < window:
+                    in_flight[submitted] = loop.run_in_executor(pool, extract_pdf_pages, job.path, *batches[submitted])
+                    submitted += 1
+                pages = await in_flight.pop(index)
+                if job.status != RUNNING:
+                    return  # Cancelado: no se encargan más lotes
+                job.chunks.extend(pages)
+                self._update(job, progress=0.1 + 0.9 * stop / total, stage=f"página {stop} de {total}")
+        finally:
+            for future in in_flight.values():
+                future.cancel()
+
+    @staticmethod
+    def _discard_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _update(self, job: IngestJob, **fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+        snapshot = job.snapshot()
+        for queue in job.watchers:
+            queue.put_nowait(snapshot)
+
+    def _finish(self, job: IngestJob, status: str, error: Optional[str] = None):
+        job.finished_at = time.time()
+        stage = {DONE: "terminado", FAILED: "error", CANCELLED: "cancelado"}[status]
+        self._update(job, status=status, progress=1.0 if status == DONE else job.progress,
+                     stage=stage, error=error)
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        self.sweep()
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[IngestJob]:
+        """Cancela un trabajo pendiente; los terminados no cambian."""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        was_queued = job.status == QUEUED
+        self.cancelled += 1
+        self._finish(job, CANCELLED, error="Procesamiento cancelado")
+        if was_queued:
+            # Sin empezar: se libera ya su archivo y su turno
+            self._discard_file(job.path)
+            if job.task is not None:
+                job.task.cancel()
+        return job
+
+    def watch(self, job: IngestJob) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        job.watchers.append(queue)
+        return queue
+
+    def unwatch(self, job: IngestJob, queue: asyncio.Queue):
+        if queue in job.watchers:
+            job.watchers.remove(queue)
+
+    def sweep(self):
+        """Olvida los trabajos terminados hace más de `ttl` segundos."""
+        limit = time.time() - self.ttl
+        for job_id in [j.id for j in self.jobs.values() if j.finished_at is not None and j.finished_at < limit]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict:
+        by_status: Dict[str, int] = {}
+        for job in self.jobs.values():
+            by_status[job.status] = by_status.get(job.status, 0) + 1
+        return {"workers": self.workers, "jobs": by_status, "completed": self.completed,
+                "failed": self.failed, "cancelled": self.cancelled,
+                "cache": self.cache.stats() if self.cache is not None else None}
@@ -0,0 +1,249 @@
+# llm.py
+# Capa asíncrona para las llamadas al LLM.
+#
+# Los endpoints de app.py son `async def`; si llaman al cliente síncrono de
+# Groq bloquean el event loop de uvicorn durante toda la completion y congelan
+# los WebSockets y el resto de peticiones. Aquí se centralizan las llamadas:
+#   - Un backend pluggable (Groq asíncrono o un stub local para pruebas).
+#   - Un límite de concurrencia por modelo con una cola acotada de espera.
+#   - Una caché opcional de respuestas (ver llm_cache.py).
+import asyncio
+import json
+import os
+import random
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from llm_cache import LLMCache, cache_key
+
+
+class LLMBusyError(Exception):
+    """La cola de espera del modelo está llena; el cliente debe reintentar."""
+
+
+class LLMBackend:
+    """Interfaz mínima que debe implementar un backend de LLM."""
+
+    async def complete(self, model: str, messages: List[Dict], **params) -> str:
+        raise NotImplementedError
+
+    async def stream(self, model: str, messages: List[Dict], **params) -> AsyncIterator[str]:
+        # Por defecto, un único fragmento con la respuesta completa.
+        yield await self.complete(model, messages, **params)
+
+
+class GroqBackend(LLMBackend):
+    """Backend real: usa el cliente asíncrono del SDK de Groq."""
+
+    def __init__(self, api_key: str):
+        from groq import AsyncGroq
+        self.client = AsyncGroq(api_key=api_key)
+
+    async def complete(self, model: str, messages: List[Dict], **params) -> str:
+        completion = await self.client.chat.completions.create(model=model, messages=messages, **params)
+        return completion.choices[0].message.content
+
+    async def stream(self, model: str, messages: List[Dict], **params) -> AsyncIterator[str]:
+        chunks = await self.client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class StubBackend(LLMBackend):
+    """Backend local sin red. Responde con JSON plausible tras una latencia simulada.
+
+    Sirve para medir el throughput del servidor sin gastar cuota de Groq.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+
+    async def complete(self, model: str, messages: List[Dict], **params) -> str:
+        self.calls += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.respond(model, messages)
+
+    async def stream(self, model: str, messages: List[Dict], **params) -> AsyncIterator[str]:
+        # Reparte la latencia entre fragmentos de ~16 caracteres, como un stream real.
+        self.calls += 1
+        text = self.respond(model, messages)
+        pieces = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+        for piece in pieces:
+            if self.latency > 0:
+                await asyncio.sleep(self.latency / len(pieces))
+            yield piece
+
+    def respond(self, model: str, messages: List[Dict]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        system = messages[0]["content"] if messages else ""
+        if '"questions"' in prompt:
+            questions = [
+                {"id": i, "question": f"¿Pregunta {i}?", "options": ["A", "B", "C", "D"], "correctAnswer": "A"}
+                for i in range(1, 11)
+            ]
+            return json.dumps({"questions": questions})
+        if '"nodes"' in system:
+            topic = prompt.strip().splitlines()[-1][:60] or "Tema"
+            nodes = [
+                {"id": "concepto_1", "label": topic, "type": "concepto_principal",
+                 "description": f"Concepto principal generado por el stub para {topic}.", "color": "#FFB347", "comments": []},
+                {"id": "concepto_2", "label": f"Detalle de {topic}", "type": "detalle",
+                 "description": "Detalle secundario generado por el backend stub local.", "color": "#B39EB5", "comments": []},
+            ]
+            edges = [{"from": "concepto_1", "to": "concepto_2", "label": "incluye"}]
+            return json.dumps({"nodes": nodes, "edges": edges}, ensure_ascii=False)
+        return "Respuesta de ayuda generada por el backend stub."
+
+
+class LLMClient:
+    """Punto único de acceso al LLM con concurrencia limitada por modelo.
+
+    Cada modelo tiene un semáforo con `limit` llamadas simultáneas; las que
+    exceden el límite esperan en cola. Si ya hay `max_queue` esperando, se
+    lanza `LLMBusyError` en lugar de acumular peticiones sin límite.
+    Con `cache`, las respuestas idénticas se sirven sin llamar al backend.
+    """
+
+    def __init__(self, backend: LLMBackend, default_limit: int = 4,
+                 model_limits: Optional[Dict[str, int]] = None, max_queue: int = 32,
+                 cache: Optional[LLMCache] = None):
+        self.backend = backend
+        self.cache = cache
+        self.default_limit = default_limit
+        self.model_limits = model_limits or {}
+        self.max_queue = max_queue
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._waiting: Dict[str, int] = {}
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.model_limits.get(model, self.default_limit))
+            self._waiting[model] = 0
+        return self._semaphores[model]
+
+    async def complete(self, model: str, messages: List[Dict], use_cache: bool = True,
+                       validate: Optional[Callable[[str], bool]] = None, **params) -> str:
+        """Devuelve el texto de la completion.
+
+        `use_cache=False` evita leer la caché (la respuesta nueva sí se guarda).
+        `validate` decide si una respuesta es apta para guardarse en caché.
+        """
+        key = None
+        if self.cache is not None:
+            key = cache_key(model, messages, params.get("temperature"))
+            if use_cache:
+                cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    return cached
+        content = await self._call(model, messages, **params)
+        if key is not None and (validate is None or validate(content)):
+            await asyncio.to_thread(self.cache.put, key, content, model)
+        return content
+
+    async def stream(self, model: str, messages: List[Dict], use_cache: bool = True,
+                     validate: Optional[Callable[[str], bool]] = None, **params) -> AsyncIterator[str]:
+        """Como `complete`, pero entrega la respuesta en fragmentos a medida que llegan.
+
+        Un acierto de caché se entrega como un único fragmento.
+        """
+        key = None
+        if self.cache is not None:
+            key = cache_key(model, messages, params.get("temperature"))
+            if use_cache:
+                cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    yield cached
+                    return
+        parts = []
+        await self._acquire(model)
+        try:
+            async for piece in self.backend.stream(model, messages, **params):
+                parts.append(piece)
+                yield piece
+        finally:
+            self._semaphores[model].release()
+        content = "".join(parts)
+        if key is not None and (validate is None or validate(content)):
+            await asyncio.to_thread(self.cache.put, key, content, model)
+
+    async def _acquire(self, model: str):
+        semaphore = self._semaphore(model)
+        if semaphore.locked() and self._waiting[model] >= self.max_queue:
+            raise LLMBusyError(f"Demasiadas solicitudes en cola para {model}")
+        self._waiting[model] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[model] -= 1
+
+    async def _call(self, model: str, messages: List[Dict], **params) -> str:
+        await self._acquire(model)
+        try:
+            return await self.backend.complete(model, messages, **params)
+        finally:
+            self._semaphores[model].release()
+
+    def stats(self) -> Dict:
+        return {
+            "models": {
+                model: {
+                    "limit": self.model_limits.get(model, self.default_limit),
+                    "waiting": self._waiting.get(model, 0),
+                }
+                for model in list(self._semaphores)  # Se llama desde el pool de hilos
+            },
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+
+def create_llm_client(api_key: Optional[str]) -> LLMClient:
+    """Construye el cliente según variables de entorno.
+
+    LLM_BACKEND=groq|stub, LLM_STUB_LATENCY (segundos), LLM_MAX_CONCURRENCY,
+    LLM_MODEL_LIMITS (JSON {"modelo": limite}) y LLM_MAX_QUEUE.
+    Caché: LLM_CACHE=0 la desactiva; LLM_CACHE_DB, LLM_CACHE_TTL (segundos),
+    LLM_CACHE_MEMORY_ENTRIES y LLM_CACHE_MAX_ROWS la configuran.
+    """
+    if os.environ.get("LLM_BACKEND", "groq") == "stub":
+        backend: LLMBackend = StubBackend(latency=float(os.environ.get("LLM_STUB_LATENCY", "0.5")))
+    else:
+        backend = GroqBackend(api_key=api_key or "")
+    model_limits = json.loads(os.environ.get("LLM_MODEL_LIMITS", "{}"))
+    cache = None
+    if os.environ.get("LLM_CACHE", "1") != "0":
+        cache = LLMCache(
+            db_path=os.environ.get("LLM_CACHE_DB", "./llm_cache.db"),
+            ttl=float(os.environ.get("LLM_CACHE_TTL", "86400")),
+            memory_entries=int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "256")),
+            max_rows=int(os.environ.get("LLM_CACHE_MAX_ROWS", "5000")),
+        )
+    return LLMClient(
+        backend,
+        default_limit=int(os.environ.get("LLM_MAX_CONCURRENCY", "4")),
+        model_limits={k: int(v) for k, v in model_limits.items()},
+        max_queue=int(os.environ.get("LLM_MAX_QUEUE", "32")),
+        cache=cache,
+    )
+
+
+if __name__ == "__main__":
+    # Medición offline del throughput con el backend stub:
+    #   python llm.py 200 8 0.5   -> 200 llamadas, límite 8, 0.5 s de latencia
+    import sys
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+
+    async def _run():
+        llm = LLMClient(StubBackend(latency=latency), default_limit=limit, max_queue=total)
+        start = time.perf_counter()
+        await asyncio.gather(*(llm.complete("stub", [{"role": "user", "content": "x"}]) for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        print(f"{total} llamadas en {elapsed:.2f}s -> {total / elapsed:.1f} llamadas/s (límite {limit})")
+
+    asyncio.run(_run())
@@ -0,0 +1,120 @@
+# llm_cache.py
+# Caché de respuestas del LLM direccionada por contenido.
+#
+# La clave es un SHA-256 de (modelo, mensajes, temperatura): el mismo tema
+# pedido por varios estudiantes o el mismo texto reintentado tras un timeout
+# se responde sin volver a llamar a Groq. Dos niveles:
+#   1. Memoria: LRU acotado por número de entradas.
+#   2. SQLite: persistente entre reinicios, acotado por filas, con TTL.
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+def cache_key(model: str, messages: List[Dict], temperature: Optional[float]) -> str:
+    payload = json.dumps({"model": model, "messages": messages, "temperature": temperature},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Caché de dos niveles (LRU en memoria + SQLite) con TTL y contadores."""
+
+    def __init__(self, db_path: Optional[str] = "./llm_cache.db", ttl: float = 86400,
+                 memory_entries: int = 256, max_rows: int = 5000):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.max_rows = max_rows
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed ON llm_cache (accessed_at)")
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttl:
+                    self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._conn.commit()
+                    self._remember(key, row[1], row[0])
+                    self.hits["disk"] += 1
+                    return row[0]
+                if row:
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str, model: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, accessed_at)"
+                    " VALUES (?, ?, ?, ?, ?)", (key, model, response, now, now)
+                )
+                self._prune(now)
+                self._conn.commit()
+
+    def _remember(self, key: str, created_at: float, response: str):
+        self._memory[key] = (created_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _prune(self, now: float):
+        # Expirados por TTL y, si sobra, los menos usados recientemente.
+        self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            " SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_rows,)
+        )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM llm_cache")
+                self._conn.commit()
+
+    def stats(self) -> Dict:
+        total_hits = self.hits["memory"] + self.hits["disk"]
+        lookups = total_hits + self.misses
+        disk_rows = 0
+        if self._conn is not None:
+            with self._lock:
+                disk_rows = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {
+            "hits_memory": self.hits["memory"],
+            "hits_disk": self.hits["disk"],
+            "misses": self.misses,
+            "hit_rate": total_hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": disk_rows,
+        }
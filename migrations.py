@@ -0,0 +1,299 @@
+# migrations.py
+# Migraciones versionadas e idempotentes del esquema relacional.
+#
+# create_all solo crea tablas que no existen: no añade columnas ni índices a
+# una DB ya creada. Cada cambio de esquema es aquí una migración numerada que
+# se aplica una vez y queda anotada en `schema_migrations`. Cada migración
+# corre en una transacción que toma antes el bloqueo de escritura (BEGIN
+# IMMEDIATE en SQLite, LOCK TABLE en PostgreSQL) y vuelve a mirar si ya está
+# anotada, así que dos workers que arrancan a la vez se turnan en lugar de
+# lanzar el mismo ALTER TABLE.
+#
+# Una migración aplicada no debe cambiar nunca: cada una lleva su propio SQL y
+# su lógica congelados aquí, sin importar código de la aplicación que pueda
+# evolucionar después.
+#
+#   python migrations.py [DATABASE_URL]   aplica las migraciones y comprueba
+#                                        que las consultas calientes usan índices
+import datetime
+import json
+import sys
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import Index, MetaData, func, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+# (versión, descripción, función(conn, metadata))
+Migration = Tuple[int, str, Callable[[Connection, MetaData], None]]
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    def register(fn: Callable[[Connection, MetaData], None]):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def add_column(conn: Connection, table: str, column: str, ddl: str):
+    if column not in [c["name"] for c in inspect(conn).get_columns(table)]:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def index_exists(conn: Connection, table: str, name: str) -> bool:
+    if conn.dialect.name == "sqlite":
+        # El inspector de SQLite omite los índices sobre expresiones
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                            {"name": name}).first() is not None
+    return name in [i["name"] for i in inspect(conn).get_indexes(table)]
+
+
+def add_index(conn: Connection, metadata: MetaData, name: str, table: str, *columns, unique: bool = False):
+    """Crea el índice si no existe. `columns`: nombres de columna o expresiones."""
+    if not index_exists(conn, table, name):
+        t = metadata.tables[table]
+        Index(name, *(t.c[c] if isinstance(c, str) else c for c in columns), unique=unique).create(conn)
+
+
+# --- Migraciones (añadir siempre al final, con el siguiente número) ---
+
+@migration(1, "knowledge_graphs.revision")
+def _graph_revision(conn: Connection, metadata: MetaData):
+    add_column(conn, "knowledge_graphs", "revision", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(2, "índices de graph_nodes, graph_edges y graph_versions")
+def _graph_indexes(conn: Connection, metadata: MetaData):
+    add_index(conn, metadata, "ix_graph_nodes_graph_id", "graph_nodes", "graph_id")
+    add_index(conn, metadata, "ix_graph_edges_graph_id", "graph_edges", "graph_id")
+    add_index(conn, metadata, "ix_graph_edges_source_node_id", "graph_edges", "source_node_id")
+    add_index(conn, metadata, "ix_graph_edges_target_node_id", "graph_edges", "target_node_id")
+    add_index(conn, metadata, "ix_graph_versions_graph_id_created_at", "graph_versions", "graph_id", "created_at")
+
+
+@migration(3, "contadores e índices del historial de grafos")
+def _graph_history(conn: Connection, metadata: MetaData):
+    add_column(conn, "knowledge_graphs", "node_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "knowledge_graphs", "edge_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "knowledge_graphs", "updated_at", "TIMESTAMP")
+    # Relleno único; a partir de aquí los mantiene bump_revision
+    conn.execute(text(
+        "UPDATE knowledge_graphs SET"
+        " node_count = (SELECT COUNT(*) FROM graph_nodes WHERE graph_nodes.graph_id = knowledge_graphs.id),"
+        " edge_count = (SELECT COUNT(*) FROM graph_edges WHERE graph_edges.graph_id = knowledge_graphs.id),"
+        " updated_at = COALESCE(updated_at, (SELECT MAX(created_at) FROM graph_versions"
+        "                                    WHERE graph_versions.graph_id = knowledge_graphs.id), CURRENT_TIMESTAMP)"
+    ))
+    t = metadata.tables["knowledge_graphs"]
+    title_key = func.coalesce(t.c.title, "")
+    add_index(conn, metadata, "ix_knowledge_graphs_title_key", "knowledge_graphs", title_key, "id")
+    add_index(conn, metadata, "ix_knowledge_graphs_user_title_key", "knowledge_graphs", "user_id", title_key, "id")
+
+
+# SQL de la migración 4 tal como se aplicó
+_FTS_COMMENTS_V4 = ("(SELECT group_concat(json_extract(value, '$.text'), ' ') FROM json_each("
+                    "CASE WHEN json_valid({row}.comments) THEN {row}.comments ELSE '[]' END))")
+_FTS_INSERT_V4 = ("INSERT INTO graph_nodes_fts (rowid, label, description, comments, graph_id) "
+                  "VALUES (new.rowid, new.label, new.description, " + _FTS_COMMENTS_V4.format(row="new") + ", new.graph_id);")
+_FTS_DDL_V4 = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS graph_nodes_fts USING fts5("
+    " label, description, comments, graph_id UNINDEXED,"
+    " tokenize = 'unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS graph_nodes_fts_insert AFTER INSERT ON graph_nodes BEGIN "
+    + _FTS_INSERT_V4 + " END",
+    "CREATE TRIGGER IF NOT EXISTS graph_nodes_fts_update AFTER UPDATE OF label, description, comments ON graph_nodes BEGIN "
+    "DELETE FROM graph_nodes_fts WHERE rowid = old.rowid; " + _FTS_INSERT_V4 + " END",
+    "CREATE TRIGGER IF NOT EXISTS graph_nodes_fts_delete AFTER DELETE ON graph_nodes BEGIN "
+    "DELETE FROM graph_nodes_fts WHERE rowid = old.rowid; END",
+]
+
+
+@migration(4, "índice de texto completo de los nodos (FTS5)")
+def _search_index(conn: Connection, metadata: MetaData):
+    if conn.dialect.name != "sqlite":
+        return  # Sin FTS5: search.py recurre a LIKE
+    for statement in _FTS_DDL_V4:
+        conn.execute(text(statement))
+    conn.execute(text("DELETE FROM graph_nodes_fts"))
+    conn.execute(text(
+        "INSERT INTO graph_nodes_fts (rowid, label, description, comments, graph_id) "
+        "SELECT n.rowid, n.label, n.description, " + _FTS_COMMENTS_V4.format(row="n") + ", n.graph_id "
+        "FROM graph_nodes AS n"
+    ))
+
+
+def _encode_versions_v5(graphs: List[Dict]) -> List[Tuple[str, bytes]]:
+    """Cadena keyframe + deltas en el formato de la migración 5: un keyframe
+    cada 20 versiones, JSON compacto con zlib y los ejes (que aún no tenían ID)
+    comparados como multiconjunto de (from, to, label)."""
+    def payload(data: Dict) -> bytes:
+        return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+    def signature(edge: Dict) -> Tuple:
+        return (edge.get("from"), edge.get("to"), edge.get("label"))
+
+    encoded = []
+    previous: Optional[Dict] = None
+    for seq, graph in enumerate(graphs):
+        if previous is None or seq % 20 == 0:
+            encoded.append(("keyframe", payload(graph)))
+        else:
+            old_nodes = {n["id"]: n for n in previous.get("nodes", [])}
+            new_nodes = {n["id"]: n for n in graph.get("nodes", [])}
+            remaining: Dict[Tuple, int] = {}
+            for edge in previous.get("edges", []):
+                remaining[signature(edge)] = remaining.get(signature(edge), 0) + 1
+            added = []
+            for edge in graph.get("edges", []):
+                if remaining.get(signature(edge)):
+                    remaining[signature(edge)] -= 1
+                else:
+                    added.append(edge)
+            encoded.append(("delta", payload({
+                "nodes_removed": [node_id for node_id in old_nodes if node_id not in new_nodes],
+                "nodes_upserted": [node for node_id, node in new_nodes.items() if old_nodes.get(node_id) != node],
+                "edges_removed": [{"from": source, "to": target, "label": label}
+                                  for (source, target, label), count in remaining.items() for _ in range(count)],
+                "edges_added": added,
+            })))
+        previous = graph
+    return encoded
+
+
+@migration(5, "historial de versiones como keyframes + deltas comprimidos")
+def _compact_versions(conn: Connection, metadata: MetaData):
+    add_column(conn, "graph_versions", "seq", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "graph_versions", "kind", "VARCHAR")
+    add_column(conn, "graph_versions", "payload", "BLOB" if conn.dialect.name == "sqlite" else "BYTEA")
+    add_column(conn, "graph_versions", "node_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "graph_versions", "edge_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "graph_versions", "byte_size", "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, "graph_versions", "author_id", "VARCHAR")
+    # Recodificar las instantáneas completas existentes, grafo a grafo
+    rows = conn.execute(text(
+        "SELECT id, graph_id, content FROM graph_versions WHERE kind IS NULL ORDER BY graph_id, created_at, id"
+    )).all()
+    by_graph: Dict[str, List] = {}
+    for row in rows:
+        by_graph.setdefault(row.graph_id, []).append(row)
+    for graph_rows in by_graph.values():
+        graphs = [json.loads(r.content) if isinstance(r.content, str) else (r.content or {}) for r in graph_rows]
+        graphs = [g if g else {"nodes": [], "edges": []} for g in graphs]
+        for seq, (row, graph, (kind, payload)) in enumerate(zip(graph_rows, graphs, _encode_versions_v5(graphs))):
+            conn.execute(text(
+                "UPDATE graph_versions SET seq = :seq, kind = :kind, payload = :payload, byte_size = :size,"
+                " node_count = :nodes, edge_count = :edges, content = 'null' WHERE id = :id"
+            ), {"seq": seq, "kind": kind, "payload": payload, "size": len(payload), "id": row.id,
+                "nodes": len(graph.get("nodes", [])), "edges": len(graph.get("edges", []))})
+    add_index(conn, metadata, "ix_graph_versions_graph_id_seq", "graph_versions", "graph_id", "seq", unique=True)
+
+
+def lock_schema(conn: Connection, table: Optional[str] = None):
+    """Toma el bloqueo de escritura al empezar la transacción: otro proceso que
+    migre a la vez espera aquí (hasta busy_timeout en SQLite)."""
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql" and table:
+        conn.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+
+
+def is_applied(conn: Connection, version: int) -> bool:
+    return conn.execute(text("SELECT 1 FROM schema_migrations WHERE version = :v"), {"v": version}).first() is not None
+
+
+def run_migrations(engine: Engine, metadata: MetaData) -> List[int]:
+    """Crea las tablas que falten y aplica las migraciones pendientes. Devuelve las aplicadas."""
+    with engine.begin() as conn:
+        lock_schema(conn)
+        metadata.create_all(bind=conn)
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY, description VARCHAR NOT NULL, applied_at VARCHAR NOT NULL)"
+        ))
+        done = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    applied = []
+    for version, description, fn in sorted(MIGRATIONS):
+        if version in done:
+            continue
+        try:
+            with engine.begin() as conn:
+                lock_schema(conn, "schema_migrations")
+                if is_applied(conn, version):
+                    continue  # Otro proceso la aplicó mientras esperábamos el bloqueo
+                fn(conn, metadata)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                    {"v": version, "d": description, "t": datetime.datetime.utcnow().isoformat()},
+                )
+        except (IntegrityError, OperationalError):
+            # Motores sin bloqueo de esquema (p. ej. MySQL, donde el DDL hace
+            # commit implícito): si otro proceso la dejó anotada, no es un error
+            with engine.connect() as conn:
+                if not is_applied(conn, version):
+                    raise
+            continue
+        print(f"Migración {version} aplicada: {description}")
+        applied.append(version)
+    return applied
+
+
+# Consultas calientes y el índice que debe usar cada una (solo SQLite)
+HOT_QUERIES = [
+    ("nodos de un grafo", "SELECT * FROM graph_nodes WHERE graph_id = 'x'", "ix_graph_nodes_graph_id"),
+    ("ejes de un grafo", "SELECT * FROM graph_edges WHERE graph_id = 'x'", "ix_graph_edges_graph_id"),
+    ("cascada por origen", "DELETE FROM graph_edges WHERE source_node_id = 'x'", "ix_graph_edges_source_node_id"),
+    ("cascada por destino", "DELETE FROM graph_edges WHERE target_node_id = 'x'", "ix_graph_edges_target_node_id"),
+    ("versiones de un grafo",
+     "SELECT id, created_at FROM graph_versions WHERE graph_id = 'x' ORDER BY created_at",
+     "ix_graph_versions_graph_id_created_at"),
+    ("página del historial",
+     "SELECT id FROM knowledge_graphs WHERE coalesce(title, '') >= 'x' AND (coalesce(title, ''), id) > ('x', 'y')"
+     " ORDER BY coalesce(title, ''), id LIMIT 51",
+     "ix_knowledge_graphs_title_key"),
+    ("historial de un propietario",
+     "SELECT id FROM knowledge_graphs WHERE user_id = 'u' AND coalesce(title, '') >= 'x' AND (coalesce(title, ''), id) > ('x', 'y')"
+     " ORDER BY coalesce(title, ''), id LIMIT 51",
+     "ix_knowledge_graphs_user_title_key"),
+]
+
+
+def query_plan(conn: Connection, sql: str) -> str:
+    return " | ".join(row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+
+
+def plan_problem(plan: str, index: str) -> bool:
+    """La consulta no usa `index`, recorre una tabla o índice entero (SCAN) u ordena aparte."""
+    return index not in plan or "SCAN" in plan or "TEMP B-TREE" in plan
+
+
+def check_query_plans(engine: Engine) -> List[str]:
+    """Devuelve los problemas encontrados (lista vacía si todo usa su índice)."""
+    problems = []
+    with engine.connect() as conn:
+        for name, sql, index in HOT_QUERIES:
+            plan = query_plan(conn, sql)
+            if plan_problem(plan, index):
+                problems.append(f"{name}: {plan}")
+    return problems
+
+
+if __name__ == "__main__":
+    import os
+
+    # app.py migra al importarse: la URL pedida tiene que estar puesta antes
+    if len(sys.argv) > 1:
+        os.environ["DATABASE_URL"] = sys.argv[1]
+    import app  # Registra los modelos en app.Base y migra app.engine
+
+    engine = app.engine
+    run_migrations(engine, app.Base.metadata)
+    if engine.dialect.name == "sqlite":
+        problems = check_query_plans(engine)
+        for problem in problems:
+            print(f"SIN ÍNDICE -> {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"{len(HOT_QUERIES)} consultas calientes usan su índice.")
@@ -0,0 +1,94 @@
+# prompt_graph.py
+# Serialización compacta de un grafo para el contexto del LLM.
+#
+# Antes el grafo anterior se pegaba en el prompt con json.dumps: UUIDs de 36
+# caracteres (en nodos y ejes), colores, propietarios, comentarios completos y
+# los acentos escapados como á. Aquí cada nodo se envía con un alias
+# corto (n1, n2...) y solo con lo que la IA necesita (etiqueta, tipo y
+# descripción, opcionalmente recortada); los ejes con alias y etiqueta. La
+# respuesta se traduce de vuelta a UUIDs antes de guardarla, sin pérdidas: los
+# campos omitidos se conservan (persist_llm_graph mantiene lo que la IA no
+# devuelve) y una descripción recortada que vuelve igual no se guarda.
+import json
+from typing import Dict, List, Optional
+
+ALIAS_PREFIX = "n"
+
+# Indicación para la IA sobre los alias del grafo anterior
+ALIAS_INSTRUCTIONS = (
+    "Los nodos existentes usan IDs cortos (n1, n2...): repite el mismo ID para modificar un nodo "
+    "existente o relacionarlo, y usa IDs nuevos con otra forma para los nodos nuevos."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokens aproximados (unos 4 caracteres por token; no hay tokenizador del modelo)."""
+    return (len(text) + 3) // 4
+
+
+class PromptGraph:
+    """Grafo con alias cortos en lugar de UUIDs, listo para el prompt, y su traducción inversa."""
+
+    def __init__(self, graph: Dict, description_chars: int = 0):
+        self.to_id: Dict[str, str] = {}
+        self.to_alias: Dict[str, str] = {}
+        # Alias -> descripción recortada que se envió
+        self.truncated: Dict[str, str] = {}
+        nodes: List[Dict] = []
+        for node in graph.get("nodes", []):
+            if node.get("id") in self.to_alias:
+                continue
+            alias = f"{ALIAS_PREFIX}{len(nodes) + 1}"
+            self.to_id[alias] = node["id"]
+            self.to_alias[node["id"]] = alias
+            compact = {"id": alias, "label": node.get("label")}
+            if node.get("type"):
+                compact["type"] = node["type"]
+            description = node.get("description") or ""
+            if description_chars and len(description) > description_chars:
+                description = description[:description_chars].rstrip() + "…"
+                self.truncated[alias] = description
+            if description:
+                compact["description"] = description
+            nodes.append(compact)
+        edges = [
+            {"from": self.to_alias[edge["from"]], "to": self.to_alias[edge["to"]], "label": edge.get("label")}
+            for edge in graph.get("edges", [])
+            if edge.get("from") in self.to_alias and edge.get("to") in self.to_alias
+        ]
+        self.text = json.dumps({"nodes": nodes, "edges": edges}, ensure_ascii=False, separators=(",", ":"))
+        self.original_text = json.dumps(graph)
+
+    def node(self, node: Dict) -> Dict:
+        """Nodo de la respuesta con su UUID real (los IDs nuevos no se tocan)."""
+        alias = node.get("id")
+        if alias not in self.to_id:
+            return node
+        node = dict(node, id=self.to_id[alias])
+        if alias in self.truncated and node.get("description") == self.truncated[alias]:
+            del node["description"]  # La IA devolvió el recorte: se conserva la descripción guardada
+        return node
+
+    def edge(self, edge: Dict) -> Dict:
+        return dict(edge, **{end: self.to_id.get(edge.get(end), edge.get(end)) for end in ("from", "to")})
+
+    def decode(self, parsed_json: Dict) -> Dict:
+        return {
+            **parsed_json,
+            "nodes": [self.node(n) for n in parsed_json.get("nodes", [])],
+            "edges": [self.edge(e) for e in parsed_json.get("edges", [])],
+        }
+
+    def report(self) -> Dict:
+        """Tokens aproximados del grafo en el prompt, compacto frente a json.dumps."""
+        compact, original = estimate_tokens(self.text), estimate_tokens(self.original_text)
+        return {"graph_tokens": compact, "graph_tokens_uncompressed": original,
+                "graph_savings": round(1 - compact / original, 3) if original else 0.0}
+
+
+def token_report(messages: List[Dict], prompt_graph: Optional[PromptGraph] = None) -> Dict:
+    """Informe de tokens (aproximados) de una petición al LLM."""
+    report = {"prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages)}
+    if prompt_graph is not None:
+        report.update(prompt_graph.report())
+    return report
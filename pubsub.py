@@ -0,0 +1,131 @@
+# pubsub.py
+# Bus de eventos de actualización de grafos entre procesos.
+#
+# Cada proceso de uvicorn (o cada pod) tiene sus propios WebSockets. Para que
+# un cambio hecho en un worker llegue a los clientes conectados a otro, los
+# eventos se publican en un bus y cada proceso los entrega a su hub local.
+#   - LocalPubSub: un solo proceso; entrega directa.
+#   - SQLitePubSub: varios procesos en la misma máquina; los eventos se
+#     escriben en una tabla SQLite compartida y cada proceso la sondea.
+# Otro broker (Redis, NATS...) solo necesita implementar publish/start/stop.
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# deliver(graph_id, payload, local): `local` indica si el evento nació en este proceso.
+Deliver = Callable[[str, Dict, bool], Awaitable[None]]
+
+
+class PubSub:
+    """Interfaz del bus: `start` registra la función de entrega."""
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def publish(self, graph_id: str, payload: Dict):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class LocalPubSub(PubSub):
+    """Un único proceso: el evento se entrega directamente al hub local."""
+
+    async def publish(self, graph_id: str, payload: Dict):
+        if self.deliver:
+            await self.deliver(graph_id, payload, True)
+
+
+class SQLitePubSub(PubSub):
+    """Bus multiproceso sobre una tabla SQLite compartida.
+
+    Los eventos propios se entregan al instante; los de otros procesos, al
+    sondear la tabla cada `poll_interval` segundos. Los eventos más antiguos
+    que `retention` segundos se borran.
+    """
+
+    def __init__(self, db_path: str = "./collab_events.db", poll_interval: float = 0.05, retention: float = 300):
+        super().__init__()
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = str(uuid.uuid4())
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS collab_events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, graph_id TEXT NOT NULL,"
+            " payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._last_id = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        # Solo interesan los eventos posteriores al arranque.
+        self._last_id = await asyncio.to_thread(self._max_id)
+        self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def publish(self, graph_id: str, payload: Dict):
+        await asyncio.to_thread(self._insert, graph_id, json.dumps(payload))
+        if self.deliver:
+            await self.deliver(graph_id, payload, True)
+
+    def _max_id(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM collab_events").fetchone()[0]
+
+    def _insert(self, graph_id: str, message: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO collab_events (origin, graph_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                (self.origin, graph_id, message, time.time()),
+            )
+
+    def _fetch(self) -> List[Tuple[int, str, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, graph_id, payload FROM collab_events WHERE id > ? AND origin != ? ORDER BY id",
+                (self._last_id, self.origin),
+            ).fetchall()
+
+    def _prune(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM collab_events WHERE created_at < ?", (time.time() - self.retention,))
+
+    async def _poll_loop(self):
+        polls = 0
+        while True:
+            try:
+                rows = await asyncio.to_thread(self._fetch)
+                for event_id, graph_id, message in rows:
+                    self._last_id = event_id
+                    await self.deliver(graph_id, json.loads(message), False)
+                polls += 1
+                if polls % 1000 == 0:
+                    await asyncio.to_thread(self._prune)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error leyendo eventos de colaboración: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+
+def create_pubsub(kind: str, db_path: str = "./collab_events.db", poll_interval: float = 0.05) -> PubSub:
+    if kind == "sqlite":
+        return SQLitePubSub(db_path=db_path, poll_interval=poll_interval)
+    return LocalPubSub()
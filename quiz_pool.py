@@ -0,0 +1,289 @@
+# quiz_pool.py
+# Preguntas de quiz pregeneradas por grafo.
+#
+# Cada clic en "Generar quiz" era una llamada de muchos segundos al modelo
+# grande, y una clase entera pulsando a la vez lanzaba decenas de llamadas
+# idénticas. Aquí cada grafo (y tema, si se pide uno) tiene una reserva de
+# preguntas ya validadas, ligada a la revisión del grafo con la que se
+# generaron. Un quiz es una muestra aleatoria de la reserva: se sirve al
+# instante. Cada pregunta se retira tras `max_serves` quizzes; cuando quedan
+# menos de `low_water` se rellena en segundo plano, una tanda (una llamada al
+# LLM) cada vez y nunca dos tandas a la vez para la misma reserva. Si no hay
+# preguntas suficientes, quien pide espera a la tanda en curso en lugar de
+# lanzar otra.
+#
+# Los parches de colaboración (ver deliver_collab_event en app.py) marcan los
+# nodos cambiados desde que se generó la reserva; cuando superan
+# `invalidate_ratio` del grafo, las preguntas se descartan, las tandas que se
+# pidieron antes de ese cambio se ignoran al llegar y la reserva se regenera
+# tras `refresh_delay` segundos (las ediciones llegan en ráfagas). Un grafo
+# recién generado o ampliado estrena así su reserva general sin esperar al
+# primer quiz.
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from relevance import terms
+
+# Tandas seguidas que se pueden descartar por cambios del grafo antes de rendirse
+STALE_RETRIES = 3
+
+# generate(graph_id, topic, use_cache) -> (revisión, nº de nodos, preguntas sin validar)
+QuizGenerator = Callable[[str, Optional[str], bool], Awaitable[Tuple[int, int, List[Dict]]]]
+
+
+def topic_key(topic: Optional[str]) -> str:
+    """Tema normalizado: "Las Células" y "celula" comparten reserva."""
+    return " ".join(sorted(set(terms(topic)))) if topic else ""
+
+
+def _fold(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def validate_question(question: Dict) -> Optional[Dict]:
+    """Pregunta limpia {question, options, correctAnswer} o None si no sirve."""
+    if not isinstance(question, dict):
+        return None
+    text = question.get("question")
+    options = question.get("options")
+    answer = question.get("correctAnswer")
+    if not isinstance(text, str) or not text.strip() or not isinstance(options, list) or not isinstance(answer, str):
+        return None
+    options = list(dict.fromkeys(o.strip() for o in options if isinstance(o, str) and o.strip()))
+    if len(options) < 2:
+        return None
+    # La respuesta debe coincidir con una opción; se tolera distinto uso de mayúsculas/espacios
+    matches = [o for o in options if o == answer.strip()] or \
+              [o for o in options if o.casefold() == answer.strip().casefold()]
+    if len(matches) != 1:
+        return None
+    return {"question": text.strip(), "options": options, "correctAnswer": matches[0]}
+
+
+class QuizPool:
+    """Reserva de preguntas de un grafo (y tema)."""
+
+    __slots__ = ("graph_id", "topic", "revision", "min_revision", "node_count", "questions", "serves",
+                 "seen", "changed", "generated", "invalidations", "created_at")
+
+    def __init__(self, graph_id: str, topic: Optional[str]):
+        self.graph_id = graph_id
+        self.topic = topic
+        self.revision = 0
+        # Las tandas generadas con una revisión anterior a esta se descartan
+        self.min_revision = 0
+        self.node_count = 0
+        self.questions: List[Dict] = []
+        self.serves: List[int] = []
+        self.seen: Set[str] = set()  # Preguntas ya vistas, para no repetirlas entre tandas
+        self.changed: Set[str] = set()  # Nodos cambiados desde la revisión de la reserva
+        self.generated = 0
+        self.invalidations = 0
+        self.created_at = time.time()
+
+    def add(self, revision: int, node_count: int, questions: List[Dict]) -> int:
+        if not self.questions:
+            self.revision, self.node_count = revision, node_count
+            self.changed.clear()
+        added = 0
+        for question in questions:
+            question = validate_question(question)
+            if question is None or _fold(question["question"]) in self.seen:
+                continue
+            self.seen.add(_fold(question["question"]))
+            self.questions.append(question)
+            self.serves.append(0)
+            added += 1
+        self.generated += added
+        return added
+
+    def reset(self, revision: int):
+        self.questions, self.serves = [], []
+        self.seen.clear()
+        self.changed.clear()
+        self.min_revision = revision
+        self.invalidations += 1
+
+
+class QuizPoolManager:
+    """Reservas de preguntas por (grafo, tema), acotadas en número (LRU)."""
+
+    def __init__(self, generate: QuizGenerator, quiz_size: int = 10, target: int = 40, low_water: int = 20,
+                 max_serves: int = 20, invalidate_ratio: float = 0.2, refresh_delay: float = 5.0,
+                 max_pools: int = 256):
+        self.generate = generate
+        self.quiz_size = quiz_size
+        self.target = target
+        self.low_water = low_water
+        self.max_serves = max_serves
+        self.invalidate_ratio = invalidate_ratio
+        self.refresh_delay = refresh_delay
+        self.max_pools = max_pools
+        self._pools: "OrderedDict[Tuple[str, str], QuizPool]" = OrderedDict()
+        self._batches: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._refills: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.served = 0
+        self.instant = 0
+        self.llm_calls = 0
+        self.failures = 0
+
+    def _pool(self, graph_id: str, topic: Optional[str]) -> QuizPool:
+        key = (graph_id, topic_key(topic))
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = QuizPool(graph_id, topic)
+            while len(self._pools) > self.max_pools:
+                old_key, _ = self._pools.popitem(last=False)
+                self._release(old_key)
+        self._pools.move_to_end(key)
+        return pool
+
+    async def quiz(self, graph_id: str, topic: Optional[str] = None) -> Dict:
+        """Quiz de `quiz_size` preguntas al azar de la reserva (espera una tanda si no alcanza)."""
+        pool = self._pool(graph_id, topic)
+        key = (graph_id, topic_key(topic))
+        if len(pool.questions) >= self.quiz_size:
+            self.instant += 1
+        stale = 0
+        while len(pool.questions) < self.quiz_size:
+            before, invalidations = pool.generated, pool.invalidations
+            await self._batch(key, pool)
+            if pool.generated == before and pool.invalidations != invalidations and stale < STALE_RETRIES:
+                stale += 1
+                continue  # La tanda se descartó por un cambio del grafo a mitad: pedir otra
+            if pool.generated == before and not pool.questions:
+                raise ValueError("El modelo no devolvió preguntas válidas")
+            if pool.generated == before:
+                break  # Mejor un quiz algo más corto que esperar otra llamada
+        chosen = random.sample(range(len(pool.questions)), min(self.quiz_size, len(pool.questions)))
+        questions = [dict(pool.questions[i], id=n) for n, i in enumerate(chosen, start=1)]
+        for i in chosen:
+            pool.serves[i] += 1
+        keep = [i for i in range(len(pool.questions)) if pool.serves[i] < self.max_serves]
+        pool.questions = [pool.questions[i] for i in keep]
+        pool.serves = [pool.serves[i] for i in keep]
+        self.served += 1
+        if len(pool.questions) < self.low_water:
+            self.schedule(graph_id, topic)
+        return {"questions": questions, "revision": pool.revision}
+
+    async def fresh(self, graph_id: str, topic: Optional[str] = None) -> Dict:
+        """Quiz recién generado, sin caché (sus preguntas también entran en la reserva)."""
+        pool = self._pool(graph_id, topic)
+        revision, node_count, raw = await self.generate(graph_id, topic, False)
+        self.llm_calls += 1
+        questions = [q for q in map(validate_question, raw) if q is not None]
+        if not questions:
+            raise ValueError("El modelo no devolvió preguntas válidas")
+        if revision >= pool.min_revision:
+            pool.add(revision, node_count, questions)
+        return {"questions": [dict(q, id=n) for n, q in enumerate(questions, start=1)], "revision": revision}
+
+    async def _batch(self, key: Tuple[str, str], pool: QuizPool):
+        """Una tanda de preguntas; si ya hay una en curso para esta reserva, espera a esa."""
+        task = self._batches.get(key)
+        if task is None:
+            task = self._batches[key] = asyncio.create_task(self._generate(key, pool))
+            task.add_done_callback(lambda _: self._batches.pop(key, None) if self._batches.get(key) is task else None)
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise  # Se canceló quien espera, no la tanda
+            raise ValueError("La generación de preguntas se canceló")
+
+    async def _generate(self, key: Tuple[str, str], pool: QuizPool):
+        revision, node_count, questions = await self.generate(pool.graph_id, pool.topic, False)
+        self.llm_calls += 1
+        if revision < pool.min_revision:
+            return  # Generada antes de un cambio grande del grafo
+        pool.add(revision, node_count, questions)
+
+    def schedule(self, graph_id: str, topic: Optional[str] = None, delay: float = 0.0):
+        """Rellena la reserva en segundo plano hasta `target` (no hace nada si ya se está rellenando)."""
+        key = (graph_id, topic_key(topic))
+        if key in self._refills:
+            return
+        task = self._refills[key] = asyncio.create_task(self._refill(key, delay))
+        task.add_done_callback(lambda _: self._refills.pop(key, None) if self._refills.get(key) is task else None)
+
+    async def _refill(self, key: Tuple[str, str], delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        stale = 0
+        try:
+            while key in self._pools and len(self._pools[key].questions) < self.target:
+                pool = self._pools[key]
+                before, invalidations = pool.generated, pool.invalidations
+                await self._batch(key, pool)
+                if pool.generated == before and pool.invalidations != invalidations and stale < STALE_RETRIES:
+                    stale += 1
+                    continue  # Tanda descartada por un cambio del grafo: la reserva está vacía
+                if pool.generated == before:
+                    break  # Sin preguntas nuevas: no insistir hasta el próximo quiz
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            print(f"Advertencia: No se pudo rellenar la reserva de quiz de {key[0]}: {e}")
+
+    def note_patches(self, graph_id: str, revision: int, patches: List[Dict], warm: bool = False):
+        """Registra los nodos cambiados; invalida las reservas del grafo si el cambio es grande.
+
+        Con `warm` (el proceso que hizo el cambio), un grafo sin reserva general
+        la estrena en segundo plano: el primer quiz ya no espera al LLM.
+        """
+        changed = {p["node"]["id"] if "node" in p else p.get("id") for p in patches
+                   if p.get("op") in ("node_added", "node_updated", "node_removed")}
+        changed.discard(None)
+        if not changed:
+            return
+        for key, pool in list(self._pools.items()):
+            if key[0] != graph_id:
+                continue
+            pool.changed |= changed
+            if (pool.questions or key in self._batches) and len(pool.changed) >= self.invalidate_ratio * max(pool.node_count, 1):
+                pool.reset(revision)
+                self.schedule(pool.graph_id, pool.topic, delay=self.refresh_delay)
+        if warm and (graph_id, "") not in self._pools:
+            self._pool(graph_id, None)
+            # Tras refresh_delay: una generación llega en varias revisiones seguidas
+            self.schedule(graph_id, None, delay=self.refresh_delay)
+
+    def _release(self, key: Tuple[str, str]):
+        """Desliga una reserva que sale de la caché: cancela su relleno, pero deja
+        terminar la tanda en curso (puede haber quizzes esperándola)."""
+        task = self._refills.pop(key, None)
+        if task is not None:
+            task.cancel()
+        self._batches.pop(key, None)
+
+    def forget(self, graph_id: str):
+        for key in [k for k in self._pools if k[0] == graph_id]:
+            del self._pools[key]
+            self._release(key)
+
+    def shutdown(self):
+        for tasks in (self._refills, self._batches):
+            for task in tasks.values():
+                task.cancel()
+            tasks.clear()
+
+    def stats(self, graph_id: Optional[str] = None) -> Dict:
+        pools = [
+            {"graph_id": pool.graph_id, "topic": key[1] or None, "revision": pool.revision,
+             "questions": len(pool.questions), "changed_nodes": len(pool.changed), "generated": pool.generated,
+             "invalidations": pool.invalidations, "refilling": key in self._refills or key in self._batches}
+            for key, pool in self._pools.items() if graph_id is None or key[0] == graph_id
+        ]
+        return {
+            "pools": pools,
+            "served": self.served,
+            "instant": self.instant,
+            "instant_rate": self.instant / self.served if self.served else 0.0,
+            "llm_calls": self.llm_calls,
+            "failures": self.failures,
+        }
@@ -0,0 +1,156 @@
+# relevance.py
+# Índice léxico (BM25) por grafo sobre etiquetas y descripciones de los nodos.
+#
+# Sirve para decidir qué nodos van en un prompt con presupuesto de tokens:
+#   - rank(consulta): nodos más relevantes para la pregunta del usuario
+#     (contextual_help, expand_node);
+#   - coverage(): orden que cubre antes los términos más informativos del
+#     grafo, para que un quiz abarque el mapa y no solo los primeros nodos.
+# El índice vive en memoria por revisión (ver AnalyticsCache) y los parches de
+# colaboración lo actualizan nodo a nodo. Los términos se pliegan (minúsculas,
+# sin acentos), se descartan palabras vacías del español y se quita el plural.
+import heapq
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# La etiqueta cuenta como LABEL_WEIGHT apariciones de cada término
+LABEL_WEIGHT = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes como con contra cual cuales cuando de del desde
+donde durante e el ella ellas ellos en entre era eran es esa esas ese eso esos esta estas este esto estos
+fue fueron ha han hasta hay la las le les lo los mas me mi muy no nos o otra otras otro otros para pero
+por que quien se ser si sin sobre su sus tambien te tiene tienen tu un una uno unos unas y ya
+""".split())
+
+
+def terms(text: Optional[str]) -> List[str]:
+    """Términos normalizados de un texto."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    result = []
+    for word in re.findall(r"\w+", folded):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        # Plural simple: "conceptos" -> "concepto", "naciones" -> "nacion"
+        if len(word) > 4 and word.endswith("es"):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        result.append(word)
+    return result
+
+
+class NodeIndex:
+    """Índice invertido de un grafo en una revisión."""
+
+    incremental = True
+
+    def __init__(self, revision: int, graph: Dict):
+        self.revision = revision
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)  # término -> {nodo: frecuencia}
+        self.node_terms: Dict[str, Dict[str, int]] = {}                # nodo -> {término: frecuencia}
+        self.lengths: Dict[str, int] = {}
+        self._total_length = 0
+        self._coverage: Optional[List[str]] = None  # Orden de coverage() en esta revisión
+        for node in graph.get("nodes", []):
+            self._add(node)
+
+    def _add(self, node: Dict):
+        counts = Counter(terms(node.get("description")))
+        for term in terms(node.get("label")):
+            counts[term] += LABEL_WEIGHT
+        node_id = node["id"]
+        for term, count in counts.items():
+            self.postings[term][node_id] = count
+        self.node_terms[node_id] = dict(counts)
+        self.lengths[node_id] = sum(counts.values())
+        self._total_length += self.lengths[node_id]
+
+    def _remove(self, node_id: str):
+        if node_id not in self.lengths:
+            return
+        self._total_length -= self.lengths.pop(node_id)
+        for term in self.node_terms.pop(node_id):
+            del self.postings[term][node_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def apply(self, revision: int, patches: List[Dict]):
+        """Aplica los parches de colaboración que llevan a `revision` (solo cambian los nodos)."""
+        for patch in patches:
+            op = patch.get("op")
+            if op in ("node_added", "node_updated"):
+                self._remove(patch["node"]["id"])
+                self._add(patch["node"])
+            elif op == "node_removed":
+                self._remove(patch["id"])
+        self.revision = revision
+        self._coverage = None
+
+    def idf(self, term: str) -> float:
+        n, df = len(self.lengths), len(self.postings.get(term, ()))
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def rank(self, query: str, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Nodos con algún término de la consulta, de más a menos relevante (BM25)."""
+        if not self.lengths:
+            return []
+        average = self._total_length / len(self.lengths) or 1.0
+        scores: Dict[str, float] = defaultdict(float)
+        for term in set(terms(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = self.idf(term)
+            for node_id, tf in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[node_id] / average)
+                scores[node_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit is not None else ranked
+
+    def coverage(self) -> List[str]:
+        """Nodos en el orden que cubre antes más términos informativos (suma de idf, voraz).
+
+        Se calcula una vez por revisión (apply lo descarta). La ganancia de un
+        nodo solo puede bajar al cubrirse términos, así que basta con recalcular
+        la del primero del montículo: si no ha bajado, es el máximo.
+        """
+        if self._coverage is None:
+            idf = {term: self.idf(term) for term in self.postings}
+            covered: set = set()
+
+            def gain(node_id: str) -> float:
+                return sum(idf[t] for t in self.node_terms[node_id] if t not in covered)
+
+            # Montículo de (-ganancia, nodo); a igual ganancia gana el ID mayor
+            heap = [(-gain(n), _Desc(n)) for n in self.lengths]
+            heapq.heapify(heap)
+            order = []
+            while heap:
+                stale, node = heapq.heappop(heap)
+                fresh = -gain(node.value)
+                if fresh != stale:
+                    heapq.heappush(heap, (fresh, node))
+                    continue
+                order.append(node.value)
+                covered.update(self.node_terms[node.value])
+            self._coverage = order
+        return self._coverage
+
+
+class _Desc:
+    """Envoltorio que invierte el orden de un ID (desempate en el montículo)."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+    def __lt__(self, other: "_Desc") -> bool:
+        return self.value > other.value
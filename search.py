@@ -0,0 +1,84 @@
+# search.py
+# Búsqueda de texto completo sobre los nodos de todos los grafos.
+#
+# En SQLite se usa una tabla FTS5 (`graph_nodes_fts`) con etiqueta,
+# descripción y texto de los comentarios de cada nodo. El tokenizador
+# unicode61 con remove_diacritics pliega mayúsculas y acentos ("Leguía" =
+# "leguia"); cada término se busca además como prefijo, lo que cubre plurales
+# y flexiones simples del español (FTS5 no trae un lematizador para español).
+#
+# La tabla y los triggers los crea la migración 4 (migrations.py). El índice
+# se mantiene con esos triggers sobre graph_nodes, así que cualquier
+# camino de escritura (ORM, inserciones en bloque, borrados en cascada) lo
+# actualiza en la misma transacción. Las filas FTS usan el rowid del nodo:
+# tras un VACUUM hay que llamar a rebuild_search_index.
+#
+# Con otras bases de datos se recurre a una búsqueda LIKE sin ranking.
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+# Texto de los comentarios de un nodo (columna JSON con [{"text": ...}, ...])
+_COMMENTS_TEXT = (
+    "(SELECT group_concat(json_extract(value, '$.text'), ' ') FROM json_each("
+    "CASE WHEN json_valid({row}.comments) THEN {row}.comments ELSE '[]' END))"
+)
+
+# Peso de cada columna en bm25 (la etiqueta pesa más que la descripción)
+BM25_WEIGHTS = (10.0, 3.0, 1.0)
+
+
+def rebuild_search_index(conn: Connection):
+    conn.execute(text("DELETE FROM graph_nodes_fts"))
+    conn.execute(text(
+        "INSERT INTO graph_nodes_fts (rowid, label, description, comments, graph_id) "
+        "SELECT n.rowid, n.label, n.description, " + _COMMENTS_TEXT.format(row="n") + ", n.graph_id "
+        "FROM graph_nodes AS n"
+    ))
+
+
+def match_query(query: str) -> Optional[str]:
+    """Convierte el texto del usuario en una consulta FTS5 segura (términos AND, por prefijo)."""
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_nodes(db: Session, query: str, graph_id: Optional[str] = None,
+                 limit: int = 20, offset: int = 0) -> List[Dict]:
+    """Nodos que contienen todos los términos, ordenados por relevancia."""
+    match = match_query(query)
+    if match is None:
+        return []
+    params = {"match": match, "graph_id": graph_id, "limit": limit, "offset": offset}
+    if db.get_bind().dialect.name == "sqlite":
+        rows = db.execute(text(
+            "SELECT n.id AS node_id, n.graph_id, g.title AS graph_title, n.label,"
+            " snippet(graph_nodes_fts, -1, '[', ']', '…', 12) AS snippet,"
+            f" bm25(graph_nodes_fts, {', '.join(map(str, BM25_WEIGHTS))}) AS score"
+            " FROM graph_nodes_fts"
+            " JOIN graph_nodes AS n ON n.rowid = graph_nodes_fts.rowid"
+            " JOIN knowledge_graphs AS g ON g.id = n.graph_id"
+            " WHERE graph_nodes_fts MATCH :match"
+            " AND (:graph_id IS NULL OR graph_nodes_fts.graph_id = :graph_id)"
+            " ORDER BY score LIMIT :limit OFFSET :offset"
+        ), params).mappings().all()
+        # bm25 es "menor = mejor"; se devuelve positivo para el cliente
+        return [{**row, "score": -row["score"]} for row in rows]
+
+    # Otras bases de datos: coincidencia simple sin ranking ni plegado de acentos
+    like = {f"t{i}": f"%{term}%" for i, term in enumerate(re.findall(r"\w+", query))}
+    conditions = " AND ".join(
+        f"(lower(n.label) LIKE lower(:{key}) OR lower(n.description) LIKE lower(:{key}))" for key in like
+    )
+    rows = db.execute(text(
+        "SELECT n.id AS node_id, n.graph_id, g.title AS graph_title, n.label, n.description AS snippet, 0 AS score"
+        " FROM graph_nodes AS n JOIN knowledge_graphs AS g ON g.id = n.graph_id"
+        f" WHERE {conditions} AND (:graph_id IS NULL OR n.graph_id = :graph_id)"
+        " ORDER BY g.title, n.label LIMIT :limit OFFSET :offset"
+    ), {**params, **like}).mappings().all()
+    return [dict(row) for row in rows]
@@ -7,6 +7,7 @@ import { NodeDetailModal } from './NodeDetailModal';
 import { SettingsModal } from './SettingsModal';
 import { QuizModal } from './QuizModal';
 import { useGraphTour } from '../lib/useGraphTour';
+import { applyPatches } from '../lib/graphPatches';
 import {
   Plus, FileText, Sparkles, FocusIcon, RefreshCw, Loader2, Upload,
   Trash2, HelpCircle, BarChart2, Save, LogOut, Settings,
@@ -34,6 +35,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
   // --- ESTADOS ---
   const [user_id, setUserId] = useState<string | null>(() => sessionStorage.getItem('knowledge_graph_user_id'));
   const [graphs, setGraphs] = useState<GraphSummary[]>([]);
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
   const [selectedGraph, setSelectedGraph] = useState<GraphSummary | null>(null);
   const [graphData, setGraphData] = useState<GraphData>({ nodes: [], edges: [] });
   const [inputText, setInputText] = useState('');
@@ -77,6 +79,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
   );
 
   const ws = useRef<WebSocket | null>(null);
+  const revisionRef = useRef(0); // Última revisión del grafo aplicada en este cliente
   const graphRef = useRef<GraphVisualizationHandle>(null);
 
   // --- EFECTOS ---
@@ -141,6 +144,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
       try {
         const data = await api.getGraphHistory(user_id);
         setGraphs(data.graphs || []);
+        setHistoryCursor(data.next_cursor);
       } catch (err: any) {
         setError(err.message || 'Error cargando historial de grafos.');
       } finally { setLoading(false); }
@@ -148,6 +152,19 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
     loadGraphs();
   }, [user_id]);
 
+  // Siguiente página del historial
+  const loadMoreGraphs = async () => {
+    if (!user_id || !historyCursor) return;
+    setLoading(true);
+    try {
+      const data = await api.getGraphHistory(user_id, { cursor: historyCursor });
+      setGraphs(prev => [...prev, ...data.graphs.filter(g => !prev.some(p => p.id === g.id))]);
+      setHistoryCursor(data.next_cursor);
+    } catch (err: any) {
+      setError(err.message || 'Error cargando historial de grafos.');
+    } finally { setLoading(false); }
+  };
+
   // 6. WebSocket y Carga de Grafo Seleccionado
   useEffect(() => {
     const connectWebSocket = (graphId: string) => {
@@ -158,19 +175,33 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
 
       ws.current.onopen = () => console.log(`WebSocket conectado: ${graphId}`);
 
+      // Si llega una revisión con hueco, pedir los parches que faltan (o una instantánea)
+      const resync = async () => {
+        try {
+          const data = await api.getGraphChanges(graphId, revisionRef.current);
+          if (data.snapshot) {
+            setGraphData(data.snapshot);
+          } else if (data.changes && data.changes.length > 0) {
+            setGraphData(prev => data.changes!.reduce((g, change) => applyPatches(g, change.patches), prev));
+          }
+          revisionRef.current = data.revision;
+        } catch (e) { console.error("Error resincronizando:", e); }
+      };
+
       ws.current.onmessage = (event) => {
         try {
           const data = JSON.parse(event.data);
           if (data.type === 'update' && data.graph) {
             setGraphData(data.graph);
-            // Actualizar modal si está abierto
-            setModalNode(prevNode => {
-              if (prevNode) {
-                const updatedNode = data.graph.nodes.find((n: NodeType) => n.id === prevNode.id);
-                return updatedNode || null;
-              }
-              return null;
-            });
+          } else if (data.type === 'resync') {
+            resync(); // El servidor descartó mensajes porque íbamos atrasados
+          } else if (data.type === 'patch' && Array.isArray(data.patches)) {
+            if (data.revision <= revisionRef.current) return; // Ya aplicado
+            // Un mensaje fusionado cubre base_revision..revision
+            const firstRevision = data.base_revision ?? data.revision;
+            if (firstRevision > revisionRef.current + 1) { resync(); return; }
+            revisionRef.current = data.revision;
+            setGraphData(prev => applyPatches(prev, data.patches));
           }
         } catch (e) { console.error("Error WS:", e); }
       };
@@ -183,6 +214,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
       try {
         const data = await api.getGraph(graphId);
         setGraphData(data.graph || { nodes: [], edges: [] });
+        revisionRef.current = data.revision || 0;
         connectWebSocket(graphId);
       } catch (err: any) {
         setError(err.message || 'Error cargando datos del grafo');
@@ -196,6 +228,17 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
     return () => { if (ws.current) ws.current.close(); };
   }, [selectedGraph]);
 
+  // Mantener el modal sincronizado con los cambios que llegan por WebSocket
+  useEffect(() => {
+    setModalNode(prevNode => {
+      if (prevNode) {
+        const updatedNode = graphData.nodes.find((n: NodeType) => n.id === prevNode.id);
+        return updatedNode || null;
+      }
+      return null;
+    });
+  }, [graphData]);
+
   // --- NUEVO: Cargar historial de versiones cuando se selecciona un grafo o cambia graphData ---
   useEffect(() => {
     if (!selectedGraph) {
@@ -231,7 +274,8 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
   const handleGenerateGraph = async (
     isNodeExpansion: boolean = false,
     nodeExpandLabel: string = '',
-    contextFileText?: string
+    contextFileText?: string,
+    nodeExpandId?: string
   ) => {
     const textToUse = isNodeExpansion ? `Expandir: ${nodeExpandLabel}` : inputText;
     if (!textToUse.trim()) { setError('Por favor, introduce algún texto'); return; }
@@ -264,7 +308,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
           break;
         case 'focus':
           if (!currentGraphId || !currentGraphData) { setError('Selecciona un grafo para enfocar'); return; }
-          result = await api.expandNode(textToUse, currentGraphId, user_id, currentGraphData, contextFileText);
+          result = await api.expandNode(textToUse, currentGraphId, user_id, currentGraphData, contextFileText, nodeExpandId);
           setGraphData(result.graph);
           break;
       }
@@ -290,7 +334,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
     setLoading(true); setError('');
     try {
       const helpMessage = `Como un ${preferences.persona_type}, necesito ayuda con: ${inputText || 'ayuda general'}`;
-      const result = await api.getContextualHelp(helpMessage, graphData.nodes.length > 0 ? graphData : null, user_id);
+      const result = await api.getContextualHelp(helpMessage, graphData.nodes.length > 0 ? graphData : null, user_id, selectedGraph?.id);
       alert(`Sugerencia para ${preferences.persona_type} (RF07):\n\n${result.help}`);
     } catch (err: any) { setError(err.message || 'Error al obtener ayuda'); }
     finally { setLoading(false); }
@@ -302,9 +346,14 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
     try {
       const result = await api.getAnalytics(selectedGraph.id);
       const analytics = result.analytics || {};
-      const inDegree = analytics.in_degree_centrality || {};
+      const labels = result.labels || {};
+      const ranking = (values: Record<string, number>) => Object.entries(values || {})
+        .sort(([, valA], [, valB]) => valB - valA).slice(0, 10)
+        .map(([nodeId, val]) => `${labels[nodeId] || nodeId}: ${val.toFixed(3)}`).join('\n');
       let analyticsText = "Análisis de Centralidad (RF09):\n\nGrado de Entrada (Importancia):\n";
-      analyticsText += Object.entries(inDegree).sort(([, valA], [, valB]) => (valB as number) - (valA as number)).map(([label, val]) => `${label}: ${(val as number).toFixed(3)}`).join('\n');
+      analyticsText += ranking(analytics.in_degree_centrality);
+      analyticsText += "\n\nPageRank:\n" + ranking(analytics.pagerank);
+      if (analytics.components) analyticsText += `\n\nComponentes conexas: ${analytics.components.count}`;
       alert(analyticsText);
     } catch (err: any) { setError(err.message || 'Error al analizar el grafo'); }
     finally { setLoading(false); }
@@ -398,7 +447,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
     if (!selectedGraph) return;
     setIsRestoring(true);
     try {
-      const result = await api.restoreVersion(versionId);
+      const result = await api.restoreVersion(versionId, user_id);
       if (result?.graph) {
         setGraphData(result.graph);
       }
@@ -582,6 +631,15 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
                     </button>
                     ))}
                     {filteredGraphs.length === 0 && <p className="text-xs text-center text-slate-500 py-2">No se encontraron grafos</p>}
+                    {historyCursor && (
+                      <button
+                        onClick={loadMoreGraphs}
+                        disabled={loading}
+                        className="w-full text-xs text-theme-text-secondary hover:text-theme-text-primary py-2"
+                      >
+                        {loading ? 'Cargando...' : 'Cargar más'}
+                      </button>
+                    )}
                 </div>
              </div>
 
@@ -760,7 +818,7 @@ export function GraphDashboard({ userEmail, onLogout }: GraphDashboardProps) {
           onClose={() => setModalNode(null)}
           onExpandNode={(node, fileContext) => {
             setModalNode(null);
-            handleGenerateGraph(true, node.label, fileContext);
+            handleGenerateGraph(true, node.label, fileContext, node.id);
           }}
           onAddComment={async (text) => {
             if (!user_id || !selectedGraph) return;
@@ -1,5 +1,6 @@
 // src/lib/api.ts
 import { GraphSummary, GraphData, QuizData, UserProfile, Preferences } from './types'; // Importar Preferences
+import { GraphPatch } from './graphPatches';
 
 const BASE_URL = import.meta.env.VITE_BACKEND_URL || 'http://10.1.16.61:8000';
 
@@ -23,17 +24,35 @@ export const createUser = (requestData: { user_id?: string } = {}): Promise<{ us
   });
 };
 
-export const getGraphHistory = (user_id: string): Promise<{ graphs: GraphSummary[] }> => {
-  if (!user_id) return Promise.resolve({ graphs: [] });
-  return fetchApi(`/graph_history/${user_id}`);
+// Historial paginado: pasar `next_cursor` de la respuesta anterior para la siguiente página
+export const getGraphHistory = (
+  user_id: string,
+  options: { cursor?: string; limit?: number; owner?: string; title_prefix?: string; updated_since?: string } = {}
+): Promise<{ graphs: GraphSummary[]; next_cursor: string | null }> => {
+  if (!user_id) return Promise.resolve({ graphs: [], next_cursor: null });
+  const params = new URLSearchParams();
+  Object.entries(options).forEach(([key, value]) => {
+    if (value !== undefined && value !== '') params.set(key, String(value));
+  });
+  const query = params.toString();
+  return fetchApi(`/graph_history/${user_id}${query ? `?${query}` : ''}`);
 };
 
 // --- getGraph (Corregido) ---
-export const getGraph = (graph_id: string): Promise<{ graph: GraphData }> => {
+export const getGraph = (graph_id: string): Promise<{ graph: GraphData; revision: number }> => {
    if (!graph_id) return Promise.reject("Graph ID es requerido");
   return fetchApi(`/get_graph/${graph_id}`);
 };
 
+// Resincronización: parches desde `since` o una instantánea si el cliente quedó muy atrás
+export const getGraphChanges = (graph_id: string, since: number): Promise<{
+  revision: number;
+  changes?: { revision: number; patches: GraphPatch[] }[];
+  snapshot?: GraphData;
+}> => {
+  return fetchApi(`/graph_changes/${graph_id}?since=${since}`);
+};
+
 export const generateGraph = (
   message: string,
   user_id: string,
@@ -49,13 +68,17 @@ export interface GraphVersionSummary {
   id: string;
   created_at: string;
   node_count: number;
+  edge_count?: number;
+  byte_size?: number;
+  author_id?: string | null;
 }
 export const getGraphVersions = (graph_id: string): Promise<{ versions: GraphVersionSummary[] }> => {
   return fetchApi(`/graph_versions/${graph_id}`);
 };
 
-export const restoreVersion = (version_id: string): Promise<{ graph: GraphData }> => {
-  return fetchApi(`/restore_version/${version_id}`, { method: 'POST' });
+export const restoreVersion = (version_id: string, user_id?: string | null): Promise<{ graph: GraphData }> => {
+  const query = user_id ? `?user_id=${encodeURIComponent(user_id)}` : '';
+  return fetchApi(`/restore_version/${version_id}${query}`, { method: 'POST' });
 };
 export const refineGraph = (
   feedback: string,
@@ -73,11 +96,12 @@ export const expandNode = (
   graph_id: string,
   user_id: string,
   previous_graph: GraphData,
-  context?: string
+  context?: string,
+  node_id?: string
 ): Promise<{ graph_id: string; graph: GraphData }> => {
   return fetchApi('/expand_node', {
     method: 'POST',
-    body: JSON.stringify({ message, graph_id, user_id, previous_graph, context }),
+    body: JSON.stringify({ message, graph_id, user_id, previous_graph, context, node_id }),
   });
 };
 
@@ -102,7 +126,23 @@ export const getUserProfile = (user_id: string): Promise<UserProfile> => {
 
 
 
-export const uploadFile = async (file: File): Promise<{ extracted_text: string | null, notification: string | null }> => {
+export interface UploadJob {
+  job_id: string;
+  filename: string;
+  status: 'queued' | 'running' | 'done' | 'failed' | 'cancelled';
+  progress: number;
+  stage: string;
+  extracted_text: string | null;
+  notification: string | null;
+}
+
+const UPLOAD_POLL_MS = 500;
+
+// Sube el archivo (el backend responde con un trabajo) y espera a que termine la extracción
+export const uploadFile = async (
+  file: File,
+  onProgress?: (job: UploadJob) => void
+): Promise<{ extracted_text: string | null, notification: string | null }> => {
   const formData = new FormData();
   formData.append('file', file);
   const response = await fetch(`${BASE_URL}/upload`, { method: 'POST', body: formData });
@@ -110,21 +150,36 @@ export const uploadFile = async (file: File): Promise<{ extracted_text: string |
     const errorData = await response.json().catch(() => ({ detail: response.statusText }));
     throw new Error(errorData.detail || 'Error al subir el archivo');
   }
-  return response.json();
+  let job: UploadJob = await response.json();
+  onProgress?.(job);
+  while (job.status === 'queued' || job.status === 'running') {
+    await new Promise(resolve => setTimeout(resolve, UPLOAD_POLL_MS));
+    job = await fetchApi(`/upload_jobs/${job.job_id}`);
+    onProgress?.(job);
+  }
+  return { extracted_text: job.extracted_text, notification: job.notification };
+};
+
+export const cancelUpload = (job_id: string): Promise<UploadJob> => {
+  return fetchApi(`/upload_jobs/${job_id}`, { method: 'DELETE' });
 };
 
 // --- API calls reactivadas ---
-export const getContextualHelp = (message: string, previous_graph: GraphData | null, user_id: string): Promise<{ help: string }> => {
+export const getContextualHelp = (message: string, previous_graph: GraphData | null, user_id: string, graph_id?: string): Promise<{ help: string }> => {
   return fetchApi('/contextual_help', {
     method: 'POST',
-    body: JSON.stringify({ message, previous_graph, user_id }),
+    body: JSON.stringify({ message, previous_graph, user_id, graph_id }),
   });
 };
 
-export const getAnalytics = (graph_id: string): Promise<{ analytics: any }> => {
+// Métricas por ID de nodo; `labels` traduce IDs a etiquetas para mostrarlas
+export const getAnalytics = (
+  graph_id: string,
+  options: { metrics?: string[]; target?: string; source?: string } = {}
+): Promise<{ revision: number; analytics: any; labels: Record<string, string> }> => {
    return fetchApi('/analyze_graph', {
     method: 'POST',
-    body: JSON.stringify({ graph_id, format: 'json' }),
+    body: JSON.stringify({ graph_id, format: 'json', ...options }),
   });
 };
 
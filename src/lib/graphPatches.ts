@@ -0,0 +1,49 @@
+// src/lib/graphPatches.ts
+// Aplica los parches de colaboración que envía el backend (ver graph_patches.py).
+import { GraphData, Node, Edge } from './types';
+
+export type GraphPatch =
+  | { op: 'node_added' | 'node_updated'; node: Node }
+  | { op: 'node_removed'; id: string }
+  | { op: 'edge_added' | 'edge_removed'; edge: Edge }
+  | { op: 'comment_appended'; node_id: string; comment: NonNullable<Node['comments']>[number] }
+  | { op: 'title_changed'; title: string };
+
+// Dos ejes con el mismo (from, to, label) se distinguen por su ID; sin ID se comparan por firma.
+const sameEdge = (a: Edge, b: Edge) =>
+  a.id && b.id ? a.id === b.id : a.from === b.from && a.to === b.to && a.label === b.label;
+
+// Los parches son idempotentes: aplicar dos veces el mismo cambio no duplica datos.
+export function applyPatches(graph: GraphData, patches: GraphPatch[]): GraphData {
+  let nodes = graph.nodes;
+  let edges = graph.edges;
+  for (const patch of patches) {
+    switch (patch.op) {
+      case 'node_added':
+      case 'node_updated':
+        nodes = [...nodes.filter(n => n.id !== patch.node.id), patch.node];
+        break;
+      case 'node_removed':
+        nodes = nodes.filter(n => n.id !== patch.id);
+        edges = edges.filter(e => e.from !== patch.id && e.to !== patch.id);
+        break;
+      case 'edge_added':
+        if (!edges.some(e => sameEdge(e, patch.edge))) edges = [...edges, patch.edge];
+        break;
+      case 'edge_removed': {
+        const index = edges.findIndex(e => sameEdge(e, patch.edge));
+        if (index !== -1) edges = [...edges.slice(0, index), ...edges.slice(index + 1)];
+        break;
+      }
+      case 'comment_appended':
+        nodes = nodes.map(n => {
+          if (n.id !== patch.node_id) return n;
+          const comments = n.comments || [];
+          if (comments.some(c => c.timestamp === patch.comment.timestamp)) return n;
+          return { ...n, comments: [...comments, patch.comment] };
+        });
+        break;
+    }
+  }
+  return { ...graph, nodes, edges };
+}
@@ -4,6 +4,11 @@
 export interface GraphSummary {
   id: string;
   title: string;
+  user_id?: string;
+  revision?: number;
+  node_count?: number;
+  edge_count?: number;
+  updated_at?: string | null;
 }
 
 // Interfaces para los datos del grafo (de app.py)
@@ -21,6 +26,7 @@ export interface Node {
 }
 
 export interface Edge {
+  id?: string; // ID del eje (los grafos guardados antes no lo traen)
   from: string; // ID del nodo origen
   to: string; // ID del nodo destino
   label: string; // Descripción de la relación
@@ -50,6 +56,7 @@ export interface Question {
 
 export interface QuizData {
   questions: Question[];
+  revision?: number;
 }
 
 export interface UserProfile {
@@ -0,0 +1,98 @@
+# storage.py
+# Motores de base de datos: escritura y lectura separadas.
+#
+# Por defecto todo vive en un fichero SQLite. Cada conexión SQLite se abre en
+# modo WAL (los lectores no bloquean al escritor ni al revés) con los pragmas
+# ajustables por entorno; las conexiones de lectura además son `query_only`.
+# Con DATABASE_URL apuntando a un servidor (PostgreSQL, MySQL...) se usan los
+# mismos modelos y solo se aplica la configuración del pool; DATABASE_READ_URL
+# permite mandar las lecturas a una réplica.
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session
+
+# Pragmas por conexión SQLite (valores de SQLite, ajustables por entorno)
+SQLITE_PRAGMAS: Dict[str, str] = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),   # Seguro con WAL
+    "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-65536"),     # Negativo = KiB (64 MiB)
+    "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", "268435456"),    # 256 MiB
+    "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"),   # ms esperando al escritor
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",  # Para que funcione ON DELETE CASCADE
+}
+
+
+def _sqlite_pragmas(engine: Engine, read_only: bool):
+    pragmas = dict(SQLITE_PRAGMAS)
+    if read_only:
+        pragmas["query_only"] = "ON"
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:")
+
+
+def _make_engine(url: str, read_only: bool) -> Engine:
+    if _is_sqlite_memory(url):
+        # SQLite en memoria: una sola conexión compartida, sin WAL ni pool
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+        _sqlite_pragmas(engine, read_only=False)
+        return engine
+    if make_url(url).get_backend_name() == "sqlite":
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": int(SQLITE_PRAGMAS["busy_timeout"]) / 1000},
+            pool_size=int(os.environ.get("DB_READ_POOL_SIZE" if read_only else "DB_POOL_SIZE", "8" if read_only else "5")),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+        )
+        _sqlite_pragmas(engine, read_only)
+        return engine
+    return create_engine(
+        url,
+        pool_size=int(os.environ.get("DB_READ_POOL_SIZE" if read_only else "DB_POOL_SIZE", "10")),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        pool_pre_ping=True,
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    )
+
+
+def create_engines(url: str, read_url: Optional[str] = None) -> Tuple[Engine, Engine]:
+    """Devuelve (motor de escritura, motor de lectura)."""
+    write_engine = _make_engine(url, read_only=False)
+    if read_url is None and _is_sqlite_memory(url):
+        return write_engine, write_engine  # Otra conexión vería otra DB vacía
+    return write_engine, _make_engine(read_url or url, read_only=True)
+
+
+@contextmanager
+def read_snapshot(db: Session) -> Iterator[None]:
+    """Las consultas del bloque ven todas la misma instantánea de la DB.
+
+    pysqlite no abre transacción para los SELECT (cada uno ve su propia
+    instantánea): en SQLite se emite BEGIN a mano. En otros motores se pide
+    REPEATABLE READ. Al salir se cierra la transacción sin escribir nada.
+    """
+    db.rollback()  # La instantánea empieza aquí, no en una consulta anterior
+    if db.get_bind().dialect.name == "sqlite":
+        conn = db.connection()
+        if not conn.connection.dbapi_connection.in_transaction:
+            conn.exec_driver_sql("BEGIN")
+    else:
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    try:
+        yield
+    finally:
+        db.rollback()
@@ -0,0 +1,16 @@
+# tests/conftest.py
+# Los módulos de la app están en la raíz del repositorio. app.py abre sus
+# bases de datos al importarse: se apuntan a un directorio temporal antes.
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="edumap-tests-")
+for name, filename in (("DATABASE_URL", "knowledge_graphs.db"), ("LLM_CACHE_DB", "llm_cache.db"),
+                       ("EXTRACT_CACHE_DB", "extract_cache.db"), ("COLLAB_PUBSUB_DB", "collab_events.db")):
+    path = os.path.join(_TMP, filename)
+    os.environ.setdefault(name, f"sqlite:///{path}" if name == "DATABASE_URL" else path)
+os.environ.setdefault("GROQ_API_KEY", "test")
@@ -0,0 +1,25 @@
+# tests/test_query_plans.py
+# Regresión de planes de consulta: cada consulta caliente de migrations.HOT_QUERIES
+# debe usar su índice sobre una DB recién migrada, sin recorridos completos.
+import pytest
+from sqlalchemy import create_engine
+
+import app
+from migrations import HOT_QUERIES, plan_problem, query_plan, run_migrations
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    engine = create_engine(f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}")
+    run_migrations(engine, app.Base.metadata)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize("name, sql, index", HOT_QUERIES, ids=[name for name, _, _ in HOT_QUERIES])
+def test_hot_query_uses_its_index(engine, name, sql, index):
+    with engine.connect() as conn:
+        plan = query_plan(conn, sql)
+    assert index in plan, plan
+    assert "SCAN" not in plan, plan
+    assert not plan_problem(plan, index), plan
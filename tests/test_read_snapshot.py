@@ -0,0 +1,69 @@
+# tests/test_read_snapshot.py
+# La analítica se construye con la revisión y las filas de una misma instantánea:
+# una escritura confirmada entre las lecturas no puede colarse en el grafo.
+import pytest
+from sqlalchemy import event
+
+import app
+import graph_sparse
+
+
+@pytest.fixture
+def graph_id():
+    db = app.SessionLocal()
+    user = app.User()
+    db.add(user)
+    db.flush()
+    graph = app.KnowledgeGraph(title="Instantánea", user_id=user.id, revision=1, node_count=2, edge_count=0)
+    db.add(graph)
+    db.flush()
+    for node_id in ("a", "b"):
+        db.add(app.GraphNode(id=f"{graph.id}:{node_id}", label=node_id, node_type="concept",
+                             graph_id=graph.id, owner_id=user.id))
+    db.commit()
+    graph_id = graph.id
+    db.close()
+    return graph_id
+
+
+@pytest.fixture
+def write_before_edges(graph_id):
+    """Confirma una arista nueva (revisión 2) justo antes de leer graph_edges."""
+    done = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if done or "FROM graph_edges" not in statement:
+            return
+        done.append(True)
+        db = app.SessionLocal()
+        db.add(app.GraphEdge(graph_id=graph_id, source_node_id=f"{graph_id}:a", target_node_id=f"{graph_id}:b"))
+        app.bump_revision(db, graph_id, edges=1)
+        db.commit()
+        db.close()
+
+    event.listen(app.read_engine, "before_cursor_execute", before_execute)
+    yield done
+    event.remove(app.read_engine, "before_cursor_execute", before_execute)
+
+
+def test_dense_build_matches_its_revision(graph_id, write_before_edges):
+    db = app.ReadSessionLocal()
+    try:
+        analytics = app.build_analytics(graph_id, 2, db)
+    finally:
+        db.close()
+    assert write_before_edges
+    assert analytics.revision == 1
+    assert analytics.edge_counts == {}
+
+
+@pytest.mark.skipif(not graph_sparse.SPARSE_AVAILABLE, reason="numpy/scipy no instalados")
+def test_sparse_build_matches_its_revision(graph_id, write_before_edges):
+    db = app.ReadSessionLocal()
+    try:
+        analytics = graph_sparse.load_sparse_analytics(db, graph_id)
+    finally:
+        db.close()
+    assert write_before_edges
+    assert analytics.revision == 1
+    assert analytics.A.nnz == 0
@@ -0,0 +1,114 @@
+# text_cache.py
+# Caché en disco del texto extraído de los archivos subidos.
+#
+# Los docentes suben una y otra vez el mismo PDF del temario, las mismas
+# capturas de diapositivas y las mismas grabaciones. La clave es el SHA-256
+# de los bytes del archivo (calculado mientras se vuelca a disco, sin leerlo
+# otra vez) más el extractor y su configuración (idioma de Tesseract, idioma
+# del reconocimiento de voz, versión de PyPDF2): si cambia cualquiera, la
+# entrada deja de coincidir. El texto se guarda comprimido en SQLite y el
+# total se mantiene por debajo de `max_bytes` expulsando lo menos usado. El
+# total se suma en la DB dentro de la transacción de escritura, así que los
+# workers que comparten el fichero respetan un mismo límite.
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+
+def extraction_key(digest: str, extractor: str) -> str:
+    """Clave de caché: hash del contenido + extractor con su configuración."""
+    return hashlib.sha256(f"{extractor}\0{digest}".encode("utf-8")).hexdigest()
+
+
+class ExtractedTextCache:
+    """Texto extraído por hash de contenido, persistente y acotado en bytes (LRU)."""
+
+    def __init__(self, db_path: str = "./extract_cache.db", max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extract_cache ("
+            " key TEXT PRIMARY KEY, extractor TEXT, text BLOB NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        # Cubre el orden LRU y la suma de tamaños sin leer los textos
+        self._conn.execute("DROP INDEX IF EXISTS ix_extract_cache_accessed")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_extract_cache_lru ON extract_cache (accessed_at, size)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM extract_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE extract_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, text: str, extractor: Optional[str] = None):
+        data = zlib.compress(text.encode("utf-8"), 6)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            # Bloqueo de escritura desde el principio: otro worker no inserta ni
+            # expulsa entre la suma y las expulsiones
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO extract_cache (key, extractor, text, size, created_at, accessed_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", (key, extractor, data, len(data), now, now)
+                )
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _total(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extract_cache").fetchone()[0]
+
+    def _evict(self):
+        # Los menos usados recientemente hasta volver al presupuesto
+        total = self._total()
+        while total > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM extract_cache ORDER BY accessed_at LIMIT 32"
+            ).fetchall()
+            if not rows:
+                return
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM extract_cache WHERE key = ?", (key,))
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM extract_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM extract_cache").fetchone()[0]
+            total = self._total()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }